@@ -1,4 +1,6 @@
+import os
 from typing import Annotated
+import jwt
 from fastapi import Header, HTTPException
 
 async def get_token_header(x_token: Annotated[str, Header()]):
@@ -8,4 +10,14 @@ async def get_token_header(x_token: Annotated[str, Header()]):
 
 async def get_query_token(token: str):
     if token != "App-Prove":
-        raise HTTPException(status_code=400, detail="No App-Prove token provided")
\ No newline at end of file
+        raise HTTPException(status_code=400, detail="No App-Prove token provided")
+
+
+def decode_token(token: str) -> dict:
+    """Decode a supabase JWT, raises a jwt.PyJWTError if it is invalid"""
+    return jwt.decode(
+        token,
+        os.getenv("SUPABASE_JWT_SECRET", ""),
+        algorithms=["HS256"],
+        audience="authenticated",
+    )
@@ -2,19 +2,47 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 from pathlib import Path
-import chardet
 import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, BackgroundTasks
 import uvicorn
 from utils.databases import store_data_in_db
 from utils import analysis
-from routers import ws
+from utils import executor
+from utils.job_store import get_job_relay
+from utils.logs import configure_logging
+from utils.outbox import get_offers_writer
+from utils.websocket import WS_PER_MESSAGE_DEFLATE
+from utils.workers import get_worker_pool
+from utils.workspaces import get_workspace_manager
+from routers import stream, ws
 from fastapi.middleware.cors import CORSMiddleware
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s', filename='app.log', filemode='w')
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Configured here rather than on import, workers import this module again
+    configure_logging(filemode="w")
+    # Remove workspaces left behind by a crash
+    await executor.run_io(get_workspace_manager().sweep)
+    # Send results left in the outbox and the new ones
+    offers_writer = get_offers_writer()
+    offers_writer.start()
+    # Analyses run in worker processes, queued ones are picked up again after a restart
+    if executor.ANALYSIS_WORKERS > 0:
+        get_worker_pool().start()
+    yield
+    if executor.ANALYSIS_WORKERS > 0:
+        await get_worker_pool().stop()
+        await get_job_relay().stop()
+    await offers_writer.stop()
+    # Stop the pools running the analysis stages
+    executor.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "*",
@@ -28,6 +56,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 app.include_router(ws.repositories.router)
+app.include_router(stream.repositories.router)
 
 
 def main(git_url: str):
@@ -54,4 +83,4 @@ def read_root(git_url: str, background_tasks: BackgroundTasks):
     return {"message": "Processing repository in the background"}
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, log_level="info", reload=bool(os.getenv('DEV',False)), reload_dirs=["app"])
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, log_level="info", reload=bool(os.getenv('DEV',False)), reload_dirs=["app"], ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
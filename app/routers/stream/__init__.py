@@ -0,0 +1 @@
+from .repositories import *
\ No newline at end of file
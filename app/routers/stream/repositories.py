@@ -1,24 +1,32 @@
 """
-This file contains the code for the websocket endpoint.
-The websocket endpoint is used to create a websocket connection between the client and the server.
-The goal is to update the client frontend based on websocket messages created by events on the server.
+This file contains the code for the Server-Sent Events endpoint.
+The SSE endpoint streams the messages of an analysis to read-only clients, like dashboards,
+with the same messages as the websocket endpoint.
+Every event has the id "<job id>:<sequence>": a client reconnecting with Last-Event-ID (done by
+EventSource on its own) resumes the running analysis after the last event it received.
 """
 
-import json
-from pathlib import Path
-from fastapi import APIRouter, WebSocket, Depends
+import os
+from typing import AsyncIterator, Optional, Tuple
+
+import jwt
+import orjson
+from fastapi import APIRouter, Header, HTTPException, Query
 from fastapi.responses import HTMLResponse, StreamingResponse
 
-from utils import analysis
-from utils.databases import store_data_in_db
+from utils.jobs import Job
+from utils.pipeline import find_job, start_repository_analysis
+from utils.websocket import message_payload
 
-from dependencies import get_token_header
+from dependencies import decode_token
 import logging
 
 logger = logging.getLogger(__name__)
 
-CLONE_DIR: Path = Path("cloned_repo")
-DB_NAME: str = "file_data.db"
+# Delay before EventSource reconnects after losing the connection
+SSE_RETRY_MS: int = int(os.getenv("SSE_RETRY_MS", 3000))
+# Comments are sent when no event came for that many seconds, so proxies keep the connection open
+SSE_KEEPALIVE_SECONDS: float = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
 
 router = APIRouter(
     prefix="/stream/repositories",
@@ -32,64 +40,47 @@ html = """
 <!DOCTYPE html>
 <html>
     <head>
-        <title>Chat</title>
+        <title>Analysis</title>
     </head>
     <body>
-        <h1>WebSocket Chat</h1>
-        <form action="" onsubmit="sendMessage(event)">
-            <input type="text" id="messageText" autocomplete="off"/>
-            <button>Send me</button>
+        <h1>Repository analysis</h1>
+        <form action="" onsubmit="startAnalysis(event)">
+            <input type="text" id="repositoryURL" placeholder="Repository URL" autocomplete="off"/>
+            <input type="text" id="token" placeholder="Token" autocomplete="off"/>
+            <button>Analyse</button>
         </form>
         <ul id='messages'>
         </ul>
         <script>
-            var ws = new WebSocket("ws://localhost:8000/repositories/ws/repository_url");
-            ws.onmessage = function(event) {
+            var eventSource = null;
+            function showMessage(event) {
                 var messages = document.getElementById('messages')
                 var message = document.createElement('li')
-                var content = document.createTextNode(event.data)
+                var content = document.createTextNode(event.type + ' ' + event.data)
                 message.appendChild(content)
                 messages.appendChild(message)
-            };
-            function sendMessage(event) {
-                var input = document.getElementById("messageText")
-                ws.send(input.value)
-                input.value = ''
+            }
+            function startAnalysis(event) {
                 event.preventDefault()
+                if (eventSource !== null) {
+                    eventSource.close()
+                }
+                var params = new URLSearchParams({
+                    repositoryURL: document.getElementById("repositoryURL").value,
+                    auditType: "security",
+                    token: document.getElementById("token").value,
+                })
+                // EventSource reconnects on its own and resumes with Last-Event-ID
+                eventSource = new EventSource('/stream/repositories/analysis?' + params)
+                eventSource.onmessage = showMessage
+                for (const type of ['status', 'relativeFiles', 'repositoryScan', 'sensitiveFiles', 'inDepthAnalysis']) {
+                    eventSource.addEventListener(type, showMessage)
+                }
+                eventSource.addEventListener('end', function (event) {
+                    showMessage(event)
+                    eventSource.close()
+                })
             }
-
-
-// Create EventSource for SSE endpoint
-const eventSource = new EventSource('http://127.0.0.1:8000/stream/repositories/analysis/');
-
-eventSource.onopen = () => {
-    console.log('EventSource connected')
-    //Everytime the connection gets extablished clearing the previous data from UI
-    coordinatesElement.innerText = ''
-}
-
-//eventSource can have event listeners based on the type of event.
-//Bydefault for message type of event it have the onmessage method which can be used directly or this same can be achieved through explicit eventlisteners
-eventSource.addEventListener('locationUpdate', function (event) {
-    coords = JSON.parse(event.data);
-    console.log('LocationUpdate', coords);
-    updateCoordinates(coords)
-});
-
-//In case of any error, if eventSource is not closed explicitely then client will retry the connection a new call to backend will happen and the cycle will go on.
-eventSource.onerror = (error) => {
-    console.error('EventSource failed', error)
-    eventSource.close()
-}
-
-// Function to update and display coordinates
-function updateCoordinates(coordinates) {
-    // Create a new paragraph element for each coordinate and append it
-    const paragraph = document.createElement('p');
-    paragraph.textContent = `Latitude: ${coordinates.lat}, Longitude: ${coordinates.lng}`;
-    coordinatesElement.appendChild(paragraph);
-}
-
         </script>
     </body>
 </html>
@@ -101,64 +92,88 @@ async def get():
     return HTMLResponse(html)
 
 
-@router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    while True:
-        data = await websocket.receive_text()
-        await websocket.send_text(f"Message text was: {data}")
-
-
-@router.get("/analysis/{repository_url}")
-async def ws_repository_analysis(repository_url: str):
+def parse_event_id(event_id: Optional[str]) -> Tuple[Optional[str], int]:
+    """returns the job id and sequence of an event id, (None, 0) if it is missing or invalid"""
+    if not event_id:
+        return None, 0
+    job_id, _, sequence = event_id.partition(":")
+    try:
+        return job_id, int(sequence)
+    except ValueError:
+        return None, 0
+
+
+def format_event(event: str, data: dict, event_id: Optional[str] = None) -> bytes:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    # orjson never emits a newline, so the payload always fits one data line
+    lines.append(f"data: {orjson.dumps(data).decode()}")
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+async def stream_job(job: Job, after: int) -> AsyncIterator[bytes]:
+    """Events of `job` after the sequence `after`, ends with an "end" event"""
+    yield f"retry: {SSE_RETRY_MS}\n\n".encode()
+    subscription = job.subscribe(after=after)
+    try:
+        async for event in subscription.events(keepalive=SSE_KEEPALIVE_SECONDS):
+            if event is None:
+                yield b": keepalive\n\n"
+                continue
+            sequence, message = event
+            yield format_event(
+                message.get("type") or "status",
+                message_payload(**message),
+                f"{job.id}:{sequence}",
+            )
+        yield format_event("end", {"failed": job.failed}, f"{job.id}:{job.last_event_id}")
+    finally:
+        job.unsubscribe(subscription)
+
+
+@router.get("/analysis")
+async def sse_repository_analysis(
+    repository_url: Optional[str] = Query(None, alias="repositoryURL"),
+    audit_type: Optional[str] = Query(None, alias="auditType"),
+    # EventSource can't send an Authorization header
+    token: Optional[str] = Query(None),
+    last_event_id: Optional[str] = Header(None),
+):
     """
-    Websocket endpoint for analysing a repository.
-    Submit data in realtime to the client, in order to update frontend.
+    SSE endpoint for analysing a repository.
+    Streams the messages of the analysis, resuming after Last-Event-ID when the client reconnects.
     """
-    def repository_analysis():
-        yield f"Connected to repository: {repository_url}"
-
-        # Step 1: Clone the repository
-        yield f"Cloning repository: {repository_url}"
-        analysis.clone_repo(repository_url, CLONE_DIR)
-        # Step 2: Process the repository to count files, lines, identify main languages
-        simple_repo_analysis = analysis.get_simple_repository_analysis(CLONE_DIR)
-        (
-            number_of_files,
-            total_line_count,
-            list_of_programming_languages,
-            ready_for_analysis,
-        ) = simple_repo_analysis
-
-        logger.debug(f"Number of files : {number_of_files}")
-        logger.debug(f"Total line count : {total_line_count}")
-        logger.debug(f"Most common programming languages : {list_of_programming_languages}")
-        # > Send data to the client
-        yield json.dumps(
-            {
-                "number_of_files": number_of_files,
-                "total_line_count": total_line_count,
-                "most_common_programming_languages": list_of_programming_languages,
-            })
-        
-
-        yield str(ready_for_analysis)
-        # Step 3: Identify sensitive code (filter unnecessary files with AI)
-        sensitive_files = analysis.get_sensitive_files(ready_for_analysis)
-        yield str(sensitive_files)
-
-        logger.debug(f"Files identified as sensitive : {sensitive_files}")
-
-        # Step 4: Identify changes in the code (check for security issues with AI, and suggest first solutions)
-        in_depth_file_analysis = analysis.get_in_depth_file_analysis(sensitive_files.get("sensitive_files", []))
-        yield str(in_depth_file_analysis)
-
-        logger.debug(f"Changes in code : {in_depth_file_analysis}")
-
-        # Step 3: Store the data in a SQLite database
-        # store_data_in_db(
-        #     DB_NAME, {"file_path": str(repository_url), "line_count": total_line_count}
-        # )
-
-        # logger.info(f"Processed {len(data)} files, representing {total_line_count} lines. Data stored in {db_name}.")
-    return StreamingResponse(repository_analysis(), media_type="text/event-stream")
+    if token is None:
+        raise HTTPException(status_code=401, detail="You should authenticate first")
+    try:
+        payload = decode_token(token)
+    except jwt.PyJWTError as error:
+        raise HTTPException(status_code=401, detail=f"Invalid token : {error}")
+    logger.debug(f"Decoded payload : {payload}")
+
+    job_id, after = parse_event_id(last_event_id)
+    job = await find_job(job_id) if job_id is not None else None
+    if job is None:
+        if repository_url is None or audit_type is None:
+            raise HTTPException(status_code=400, detail="You should create an offer first")
+        try:
+            job, _ = await start_repository_analysis(
+                repository_url=repository_url, audit_type=audit_type
+            )
+        except Exception as error:
+            raise HTTPException(
+                status_code=400,
+                detail=f"An error has occured while reaching the repository : {error}",
+            )
+        # Sequences of another job don't apply to this one
+        after = 0
+    else:
+        logger.debug(f"Resuming job {job.id} after event {after}")
+
+    return StreamingResponse(
+        stream_job(job, after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
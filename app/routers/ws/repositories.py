@@ -5,27 +5,17 @@ The goal is to update the client frontend based on websocket messages created by
 """
 
 import asyncio
-import json
-import jwt
-import os
-from pathlib import Path
-from fastapi import APIRouter, WebSocket, Depends, WebSocketDisconnect
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
-from fastapi.security import OAuth2PasswordBearer
 
-from utils.websocket import WebSocketAPI
-from utils.analysis.files_analyser import format_github_url
-from utils import analysis
-from utils.databases import store_data_in_db
+from utils.websocket import create_websocket_api
+from utils.pipeline import start_repository_analysis
 
-from dependencies import get_token_header
+from dependencies import decode_token
 import logging
 
 logger = logging.getLogger(__name__)
 
-CLONE_DIR: Path = Path("cloned_repo")
-DB_NAME: str = "file_data.db"
-
 router = APIRouter(
     prefix="/ws/repositories",
     tags=["repositories"],
@@ -35,7 +25,6 @@ router = APIRouter(
 from dotenv import load_dotenv
 
 load_dotenv()
-JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET", "")
 
 
 html = """
@@ -109,10 +98,12 @@ async def ws_repository_analysis(websocket: WebSocket):
     Submit data in realtime to the client, in order to update frontend.
     """
     await websocket.accept()
-    websocket_api = WebSocketAPI(websocket)
-    # We should create a queue and start processes in threads to avoid blocking the event loop
     while True:
         data = await websocket.receive_json()
+        # Clients opt in the compact protocol with "protocol": 2
+        websocket_api = create_websocket_api(
+            websocket, data.get("protocol", 1) if isinstance(data, dict) else 1
+        )
         await websocket_api.send(
             status="pending",
             step_name="connecting",
@@ -150,10 +141,7 @@ async def ws_repository_analysis(websocket: WebSocket):
             continue
         # Secure connection using supabase JWT token
         try:
-            logger.error(f"Token : {token}" f"JWT_SECRET : {JWT_SECRET}")
-            payload = jwt.decode(
-                token, JWT_SECRET, algorithms=["HS256"], audience="authenticated"
-            )
+            payload = decode_token(token)
             logger.debug(f"Decoded payload : {payload}")
             user_id = payload.get("sub")
             # Check user_id correspond to the user who created the offer for selected repo
@@ -172,113 +160,32 @@ async def ws_repository_analysis(websocket: WebSocket):
             message=f"Service ready for: {repository_url}",
         )
 
-        # Make sure URL is in the right format
-        repository_url = format_github_url(repository_url)
-
-        # Step 1: Clone the repository
-        await websocket_api.send(
-            status="pending",
-            step_name="cloning",
-            message="Started cloning repository",
-        )
-        CLONE_DIR = Path(repository_url.split("/")[-1])
         try:
-            analysis.clone_repo(repository_url, CLONE_DIR)
+            job, started = await start_repository_analysis(
+                repository_url=repository_url, audit_type=audit_type
+            )
         except Exception as error:
             await websocket_api.send(
                 status="error",
                 step_name="cloning",
-                message=f"An error has occured while cloning the repository : {error}",
+                message=f"An error has occured while reaching the repository : {error}",
             )
             continue
-        await websocket_api.send(
-            step_name="cloning",
-            status="success",
-            message=f"Successfully cloned repository: {repository_url}",
-        )
-
-        await websocket_api.send(
-            status="success",
-            step_name="identifying",
-            message="Started simple repository scan",
-        )
-        # Step 2: Process the repository to count files, lines, identify main languages
-        simple_repo_analysis = analysis.get_simple_repository_analysis(CLONE_DIR)
-        (
-            number_of_files,
-            total_line_count,
-            list_of_programming_languages,
-            ready_for_analysis,
-        ) = simple_repo_analysis
-
-        logger.debug(f"Number of files : {number_of_files}")
-        logger.debug(f"Total line count : {total_line_count}")
-        logger.debug(
-            f"Most common programming languages : {list_of_programming_languages}"
-        )
-        await websocket_api.send(
-            step_name="identifying",
-            status="success",
-            message="Repository scan complete",
-            type="repositoryScan",
-            data={
-                "numberOfFiles": number_of_files,
-                "totalLineCount": total_line_count,
-                "mostCommonProgrammingLanguages": list_of_programming_languages,
-            },
-        )
-
-        await websocket_api.send(
-            step_name="identifying",
-            status="success",
-            message="Identified files relatives to project",
-            type="relativeFiles",
-            data={"relativeFiles": ready_for_analysis},
-        )
-        await websocket_api.send(
-            status="success",
-            step_name='reviewing',
-            message="Started in depth analysis")
-        # Step 3: Identify sensitive code (filter unnecessary files with AI)
-        sensitive_files = analysis.get_sensitive_files(ready_for_analysis)
-        await websocket_api.send(
-            status="success",
-            step_name='reviewing',
-            message="Identified sensitive files for in depth analysis",
-            type="sensitiveFiles",
-            data=sensitive_files,
-        )
-        logger.debug(f"Files identified as relevent : {sensitive_files}")
-
-        # Step 4: Identify changes in the code (check for security issues with AI, and suggest first solutions)
-        in_depth_file_analysis = analysis.get_in_depth_file_analysis(
-            list_files=sensitive_files.get("sensitiveFiles", []), audit_type=audit_type
-        )
-        await websocket_api.send(
-            step_name="reviewing",
-            status="success",
-            message="In depth analysis finished",
-            type="inDepthAnalysis",
-            data=in_depth_file_analysis,
-        )
-
-        # Step 5: Store the data in supabase database
-        store_data_in_db(
-            url=data["repositoryURL"],
-            files_count=number_of_files,
-            lines_count=total_line_count,
-        )
-
-        logger.debug(f"Changes in code : {in_depth_file_analysis}")
-
-        # Remove the cloned repository
-        analysis.clean_dir(CLONE_DIR)
+        if not started:
+            await websocket_api.send(
+                status="success",
+                step_name="connecting",
+                message="Joined an analysis already running for this repository",
+            )
+        subscription = job.subscribe()
+        try:
+            async for message in subscription.messages():
+                await websocket_api.send(**message)
+        finally:
+            job.unsubscribe(subscription)
+        await websocket_api.flush()
+        if job.failed:
+            continue
 
         await websocket.close()
-        # Step 3: Store the data in a SQLite database
-        # store_data_in_db(
-        #     DB_NAME, {"file_path": str(repository_url), "line_count": total_line_count}
-        # )
-
-        # logger.info(f"Processed {len(data)} files, representing {total_line_count} lines. Data stored in {db_name}.")
         return
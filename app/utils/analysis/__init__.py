@@ -1 +1,23 @@
-from .files_analyser import *
\ No newline at end of file
+"""
+Repository analysis.
+
+The names of files_analyser are exposed here, loaded on first access: worker processes which
+only need a light module (scanner, line_counter...) don't import the whole analysis stack.
+"""
+
+import importlib
+import importlib.util
+
+
+def __getattr__(name):
+    # `from utils.analysis import scanner` looks the submodule up here before importing it
+    if importlib.util.find_spec(f"{__name__}.{name}") is not None:
+        return importlib.import_module(f".{name}", __name__)
+    # import_module, not `from . import`, which would look the module up here again if it fails to import
+    files_analyser = importlib.import_module(".files_analyser", __name__)
+    try:
+        value = getattr(files_analyser, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    globals()[name] = value
+    return value
@@ -0,0 +1,254 @@
+"""
+Store of completed audits, used to re-analyse only what changed since the last audit.
+
+For each repository (by normalized URL) and audit type we keep the audited commit and, for every
+file, its blob SHA, its line count and its in depth analysis (when it was analysed). A new audit
+compares the blob SHAs of its tree with the stored ones: unchanged files keep their line count
+and analysis, only added and modified files are counted and sent to GPT again.
+Comparing blob SHAs gives the same result as diffing both commits, without needing the previous
+commit in a shallow clone. Analyses are only carried forward from an audit made with the same
+model version, like stored reports.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from git import Repo
+
+logger = logging.getLogger(__name__)
+
+AUDIT_DB_PATH: str = os.getenv("AUDIT_DB_PATH", "audits.db")
+
+
+@dataclass
+class FileRecord:
+    blob_sha: str
+    line_count: int
+    # In depth analysis of the file, None if the file was not analysed
+    result: Optional[dict] = None
+
+
+@dataclass
+class Audit:
+    commit: str
+    # Keyed by path relative to the repository root
+    files: Dict[str, FileRecord] = field(default_factory=dict)
+    # Version of the model which analysed the files, None for audits stored without it
+    version: Optional[str] = None
+
+
+@dataclass
+class TreeDiff:
+    added: List[str]
+    modified: List[str]
+    deleted: List[str]
+    unchanged: List[str]
+
+    def as_dict(self) -> dict:
+        return {
+            "added": len(self.added),
+            "modified": len(self.modified),
+            "deleted": len(self.deleted),
+            "unchanged": len(self.unchanged),
+        }
+
+
+def tree_blob_shas(git_dir: str, commit: str) -> Dict[str, str]:
+    """Blob SHA of every file of `commit`, keyed by path relative to the repository root"""
+    blob_shas = {}
+    for line in Repo(git_dir).git.ls_tree("-r", "-z", "--full-tree", commit).split("\0"):
+        if not line:
+            continue
+        # <mode> SP <type> SP <object> TAB <file>
+        info, path = line.split("\t", 1)
+        _, object_type, sha = info.split(" ")
+        if object_type == "blob":
+            blob_shas[path] = sha
+    return blob_shas
+
+
+def diff_trees(previous: Dict[str, str], current: Dict[str, str]) -> TreeDiff:
+    """Compare two {path: blob SHA} trees"""
+    added, modified, unchanged = [], [], []
+    for path, sha in current.items():
+        if path not in previous:
+            added.append(path)
+        elif previous[path] != sha:
+            modified.append(path)
+        else:
+            unchanged.append(path)
+    deleted = [path for path in previous if path not in current]
+    return TreeDiff(added=added, modified=modified, deleted=deleted, unchanged=unchanged)
+
+
+@dataclass
+class IncrementalPlan:
+    """What can be carried forward from the previous audit, keyed by path under the clone root"""
+
+    previous_commit: Optional[str]
+    diff: TreeDiff
+    known_line_counts: Dict[str, int]
+    carried_results: Dict[str, dict]
+
+    def as_dict(self) -> dict:
+        return {"previousCommit": self.previous_commit, **self.diff.as_dict()}
+
+
+def plan_incremental_audit(
+    previous: Optional[Audit], blob_shas: Dict[str, str], root: str, version: str
+) -> IncrementalPlan:
+    """Find the files unchanged since `previous` and what we know about them
+
+    Their analyses are only carried forward if `previous` was made with model `version`.
+    """
+    previous_files = previous.files if previous is not None else {}
+    carry_results = previous is not None and previous.version == version
+    if previous is not None and not carry_results:
+        logger.debug(f"Model changed since the audit of {previous.commit}, not carrying its analyses")
+    diff = diff_trees(
+        {path: record.blob_sha for path, record in previous_files.items()}, blob_shas
+    )
+    known_line_counts = {}
+    carried_results = {}
+    for path in diff.unchanged:
+        record = previous_files[path]
+        known_line_counts[os.path.join(root, path)] = record.line_count
+        if carry_results and record.result is not None:
+            carried_results[os.path.join(root, path)] = record.result
+    return IncrementalPlan(
+        previous_commit=previous.commit if previous is not None else None,
+        diff=diff,
+        known_line_counts=known_line_counts,
+        carried_results=carried_results,
+    )
+
+
+def build_audit(
+    commit: str,
+    blob_shas: Dict[str, str],
+    root: str,
+    line_counts: Dict[str, int],
+    results: Dict[str, dict],
+    version: str,
+) -> Audit:
+    """Audit to store once an analysis is complete, `line_counts` and `results` are keyed by path under `root`
+
+    Results of files which were not analysed this time are kept if the file did not change.
+    """
+    audit = Audit(commit=commit, version=version)
+    for path, blob_sha in blob_shas.items():
+        full_path = os.path.join(root, path)
+        result = results.get(full_path)
+        audit.files[path] = FileRecord(
+            blob_sha=blob_sha,
+            line_count=line_counts.get(full_path, 0),
+            result=(
+                {k: v for k, v in result.items() if k not in ("path", "fresh")}
+                if result is not None and not result.get("incomplete")
+                else None
+            ),
+        )
+    return audit
+
+
+class AuditStore:
+    """Last completed audit of each (repository, audit type), stored in SQLite"""
+
+    def __init__(self, db_path: str = AUDIT_DB_PATH) -> None:
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS audits
+                          (url TEXT,
+                           audit_type TEXT,
+                           commit_sha TEXT,
+                           version TEXT,
+                           created_at REAL,
+                           PRIMARY KEY (url, audit_type))"""
+            )
+            # Audits stored before the model version was recorded
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(audits)")]
+            if "version" not in columns:
+                conn.execute("ALTER TABLE audits ADD COLUMN version TEXT")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS audit_files
+                          (url TEXT,
+                           audit_type TEXT,
+                           path TEXT,
+                           blob_sha TEXT,
+                           line_count INTEGER,
+                           result TEXT,
+                           PRIMARY KEY (url, audit_type, path))"""
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Connection committed when the block succeeds, closed in any case"""
+        with closing(sqlite3.connect(self.db_path, timeout=30)) as conn, conn:
+            yield conn
+
+    def load(self, url: str, audit_type: str) -> Optional[Audit]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT commit_sha, version FROM audits WHERE url = ? AND audit_type = ?",
+                (url, audit_type),
+            ).fetchone()
+            if row is None:
+                return None
+            audit = Audit(commit=row[0], version=row[1])
+            for path, blob_sha, line_count, result in conn.execute(
+                "SELECT path, blob_sha, line_count, result FROM audit_files WHERE url = ? AND audit_type = ?",
+                (url, audit_type),
+            ):
+                audit.files[path] = FileRecord(
+                    blob_sha=blob_sha,
+                    line_count=line_count,
+                    result=json.loads(result) if result is not None else None,
+                )
+            return audit
+
+    def save(self, url: str, audit_type: str, audit: Audit) -> None:
+        """Replace the stored audit of the repository"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO audits (url, audit_type, commit_sha, version, created_at) VALUES (?, ?, ?, ?, ?)",
+                (url, audit_type, audit.commit, audit.version, time.time()),
+            )
+            conn.execute(
+                "DELETE FROM audit_files WHERE url = ? AND audit_type = ?",
+                (url, audit_type),
+            )
+            conn.executemany(
+                "INSERT INTO audit_files (url, audit_type, path, blob_sha, line_count, result) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        url,
+                        audit_type,
+                        path,
+                        record.blob_sha,
+                        record.line_count,
+                        json.dumps(record.result) if record.result is not None else None,
+                    )
+                    for path, record in audit.files.items()
+                ],
+            )
+        logger.debug(f"Stored audit of {url} at {audit.commit} ({len(audit.files)} files)")
+
+
+_audit_store: Optional[AuditStore] = None
+
+
+def get_audit_store() -> AuditStore:
+    """Audit store shared by every analysis of the process"""
+    global _audit_store
+    if _audit_store is None:
+        _audit_store = AuditStore()
+    return _audit_store
@@ -0,0 +1,226 @@
+"""
+LLM backends answering the prompts of ChatGPTApi.
+
+LLM_BACKEND selects the backend of the deployment:
+- "openai": the OpenAI API, LLM_MODEL (gpt-3.5-turbo-0125 by default)
+- "compatible": any OpenAI-compatible endpoint (vLLM, llama.cpp, Ollama, a proxy...) at
+  LLM_BASE_URL, with LLM_API_KEY and LLM_MODEL. Set LLM_JSON_MODE=0 if it does not support
+  response_format
+- "cassette": record/replay. In "record" mode (LLM_CASSETTE_MODE) the answers of
+  LLM_CASSETTE_RECORD_BACKEND are appended to LLM_CASSETTE_PATH, in "replay" mode they are served
+  instantly from it. With LLM_CASSETTE_MATCH=prompt, a request matches any recorded answer to
+  the same system prompt, so load tests can run on files that were never recorded.
+
+Every backend has a version identifying the model answering, part of the analysis cache keys.
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Iterator, List, Optional
+
+from .prompts import estimate_tokens
+from .ratelimit import RateLimitedScheduler, get_scheduler
+
+logger = logging.getLogger(__name__)
+
+LLM_BACKEND: str = os.getenv("LLM_BACKEND", "openai")
+LLM_MODEL: str = os.getenv("LLM_MODEL", "gpt-3.5-turbo-0125")
+LLM_BASE_URL: Optional[str] = os.getenv("LLM_BASE_URL")
+LLM_API_KEY: str = os.getenv("LLM_API_KEY", "not-needed")
+LLM_JSON_MODE: bool = os.getenv("LLM_JSON_MODE", "1") not in ("0", "false", "False")
+LLM_CASSETTE_PATH: str = os.getenv("LLM_CASSETTE_PATH", "llm_cassette.jsonl")
+LLM_CASSETTE_MODE: str = os.getenv("LLM_CASSETTE_MODE", "replay")
+LLM_CASSETTE_MATCH: str = os.getenv("LLM_CASSETTE_MATCH", "exact")
+LLM_CASSETTE_RECORD_BACKEND: str = os.getenv("LLM_CASSETTE_RECORD_BACKEND", "openai")
+# Tokens reserved for the answer of a request, corrected with the real usage once it is known
+COMPLETION_TOKENS_ESTIMATE: int = int(os.getenv("COMPLETION_TOKENS_ESTIMATE", 1000))
+
+
+class CassetteMiss(KeyError):
+    """No recorded answer for a request"""
+
+
+class LLMBackend(ABC):
+    # Identifies the model answering
+    version: str
+
+    @abstractmethod
+    def complete(self, messages: List[dict]) -> str:
+        """Answer of the model to a chat, as a JSON string"""
+
+    @abstractmethod
+    async def acomplete(self, messages: List[dict]) -> str:
+        """Same as `complete` without blocking the event loop"""
+
+
+class OpenAIBackend(LLMBackend):
+    """Chat completions of the OpenAI API, rate limited by the shared scheduler"""
+
+    def __init__(
+        self,
+        model: str = LLM_MODEL,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        json_mode: bool = True,
+        scheduler: Optional[RateLimitedScheduler] = None,
+    ) -> None:
+        from openai import AsyncOpenAI, OpenAI
+
+        if api_key is None:
+            assert (
+                os.getenv("OPENAI_API_KEY") is not None
+            ), "No API key detected, please setup your API key as an environement variable under the name OPENAI_API_KEY"
+        self.model = model
+        self.json_mode = json_mode
+        # Retries are made by the scheduler, which knows about every call of the process
+        self.client = OpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+        self.async_client = AsyncOpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+        self.scheduler = scheduler or get_scheduler()
+        self.version = model
+
+    def _request(self, messages: List[dict]) -> dict:
+        request = {"model": self.model, "messages": messages}
+        if self.json_mode:
+            request["response_format"] = {"type": "json_object"}
+        return request
+
+    def estimate_tokens(self, messages: List[dict]) -> int:
+        """Token cost of a request, used to reserve it in the tokens per minute budget"""
+        return sum(estimate_tokens(entry["content"]) for entry in messages) + COMPLETION_TOKENS_ESTIMATE
+
+    def _record_usage(self, estimated_tokens: int, response) -> None:
+        usage = getattr(response, "usage", None)
+        self.scheduler.record_usage(estimated_tokens, usage.total_tokens if usage is not None else None)
+
+    def complete(self, messages: List[dict]) -> str:
+        estimated_tokens = self.estimate_tokens(messages)
+        response = self.scheduler.run_sync(
+            lambda: self.client.chat.completions.create(**self._request(messages)),
+            estimated_tokens,
+        )
+        self._record_usage(estimated_tokens, response)
+        logger.debug(response)
+        return str(response.choices[0].message.content)
+
+    async def acomplete(self, messages: List[dict]) -> str:
+        estimated_tokens = self.estimate_tokens(messages)
+        response = await self.scheduler.run(
+            lambda: self.async_client.chat.completions.create(**self._request(messages)),
+            estimated_tokens,
+        )
+        self._record_usage(estimated_tokens, response)
+        logger.debug(response)
+        return str(response.choices[0].message.content)
+
+
+class CompatibleBackend(OpenAIBackend):
+    """OpenAI-compatible endpoint, with its own rate limits"""
+
+    def __init__(
+        self,
+        base_url: Optional[str] = LLM_BASE_URL,
+        model: str = LLM_MODEL,
+        api_key: str = LLM_API_KEY,
+        json_mode: bool = LLM_JSON_MODE,
+    ) -> None:
+        assert base_url, "No LLM_BASE_URL detected, the compatible backend needs the URL of the endpoint"
+        super().__init__(
+            model=model,
+            base_url=base_url,
+            api_key=api_key,
+            json_mode=json_mode,
+            scheduler=RateLimitedScheduler(),
+        )
+        self.version = f"{base_url}:{model}"
+
+
+def request_key(messages: List[dict], match: str) -> str:
+    """Key of a request in a cassette, `match` is "exact" or "prompt" (system prompt only)"""
+    if match == "prompt":
+        messages = [message for message in messages if message["role"] == "system"]
+    return hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+
+
+class CassetteBackend(LLMBackend):
+    """Record answers of another backend to a JSON lines file, or replay them"""
+
+    def __init__(
+        self,
+        path: str = LLM_CASSETTE_PATH,
+        mode: str = LLM_CASSETTE_MODE,
+        match: str = LLM_CASSETTE_MATCH,
+        inner: Optional[LLMBackend] = None,
+    ) -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode {mode}, expected record or replay")
+        self.path = path
+        self.mode = mode
+        self.match = match
+        self.inner = inner
+        if mode == "record" and inner is None:
+            self.inner = create_backend(LLM_CASSETTE_RECORD_BACKEND)
+        self._lock = threading.Lock()
+        # Answers by request key, with a cycle over them for "prompt" matching
+        self.answers: Dict[str, List[str]] = {}
+        self._cycles: Dict[str, Iterator[str]] = {}
+        self.version = self.inner.version if mode == "record" else f"cassette:{os.path.basename(path)}"
+        if mode == "replay":
+            self._load()
+
+    def _load(self) -> None:
+        with open(self.path) as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = request_key(entry["messages"], self.match)
+                self.answers.setdefault(key, []).append(entry["answer"])
+        logger.debug(f"Loaded {sum(map(len, self.answers.values()))} recorded answers from {self.path}")
+
+    def _replay(self, messages: List[dict]) -> str:
+        key = request_key(messages, self.match)
+        with self._lock:
+            if key not in self.answers:
+                raise CassetteMiss(f"No recorded answer for request {key[:12]} in {self.path}")
+            if key not in self._cycles:
+                self._cycles[key] = itertools.cycle(self.answers[key])
+            return next(self._cycles[key])
+
+    def _record(self, messages: List[dict], answer: str) -> None:
+        with self._lock, open(self.path, "a") as file:
+            file.write(json.dumps({"messages": messages, "answer": answer}) + "\n")
+
+    def complete(self, messages: List[dict]) -> str:
+        if self.mode == "replay":
+            return self._replay(messages)
+        answer = self.inner.complete(messages)
+        self._record(messages, answer)
+        return answer
+
+    async def acomplete(self, messages: List[dict]) -> str:
+        if self.mode == "replay":
+            return self._replay(messages)
+        answer = await self.inner.acomplete(messages)
+        self._record(messages, answer)
+        return answer
+
+
+BACKENDS = {
+    "openai": OpenAIBackend,
+    "compatible": CompatibleBackend,
+    "cassette": CassetteBackend,
+}
+
+
+def create_backend(name: str = LLM_BACKEND) -> LLMBackend:
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown LLM backend {name}, expected one of {', '.join(BACKENDS)}") from None
+    logger.debug(f"Using {name} LLM backend")
+    return backend_class()
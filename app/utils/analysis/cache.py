@@ -0,0 +1,170 @@
+"""
+Persistent cache for GPT file analyses.
+
+Entries are content addressed: the key is built from the git blob SHA of the analysed file,
+its language, the audit type and the prompt/model version, so an unchanged file is never
+sent twice to GPT, whatever the repository or the commit it comes from.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH: str = os.getenv("ANALYSIS_CACHE_PATH", "analysis_cache.db")
+CACHE_MAX_ENTRIES: int = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 100_000))
+CACHE_MAX_BYTES: int = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+CACHE_MAX_AGE: float = float(os.getenv("ANALYSIS_CACHE_MAX_AGE_DAYS", 30)) * 24 * 3600
+
+
+def git_blob_sha(content: bytes) -> str:
+    """SHA-1 git gives to a blob with this content (same as `git hash-object`)"""
+    header = f"blob {len(content)}\0".encode()
+    return hashlib.sha1(header + content).hexdigest()
+
+
+def cache_key(blob_sha: str, language: str, audit_type: str, version: str) -> str:
+    """Build the key of an analysis from everything that changes GPT answer"""
+    return hashlib.sha256(
+        "\0".join([blob_sha, language, audit_type, version]).encode()
+    ).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    """Hits and misses of a single analysis, reported to the client"""
+
+    hits: int = 0
+    misses: int = 0
+
+    def record(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def as_dict(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class CacheBackend(ABC):
+    """Storage used by the analysis cache, implement it to plug another store"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached value or None"""
+
+    @abstractmethod
+    def set(self, key: str, value: str) -> None:
+        """Store a value, may evict older entries"""
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Local SQLite store with age, size and entry count based eviction
+
+    Least recently used entries are evicted first once a bound is exceeded.
+    """
+
+    def __init__(
+        self,
+        db_path: str = CACHE_PATH,
+        *,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES,
+        max_age: float = CACHE_MAX_AGE,
+    ) -> None:
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS analyses
+                          (key TEXT PRIMARY KEY,
+                           value TEXT,
+                           size INTEGER,
+                           created_at REAL,
+                           accessed_at REAL)"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS analyses_accessed_at ON analyses (accessed_at)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Connection committed when the block succeeds, closed in any case"""
+        with closing(sqlite3.connect(self.db_path, timeout=30)) as conn, conn:
+            yield conn
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, created_at FROM analyses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.max_age:
+                conn.execute("DELETE FROM analyses WHERE key = ?", (key,))
+                return None
+            conn.execute(
+                "UPDATE analyses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode()), now, now),
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM analyses WHERE created_at < ?", (now - self.max_age,))
+        count, total_size = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses"
+        ).fetchone()
+        if count <= self.max_entries and total_size <= self.max_bytes:
+            return
+        # Walk entries from least recently used and drop them until both bounds are met
+        evicted = 0
+        for key, size in conn.execute(
+            "SELECT key, size FROM analyses ORDER BY accessed_at ASC"
+        ).fetchall():
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM analyses WHERE key = ?", (key,))
+            count -= 1
+            total_size -= size
+            evicted += 1
+        logger.debug(f"Evicted {evicted} entries from analysis cache")
+
+
+_cache: Optional[CacheBackend] = None
+
+
+def get_analysis_cache() -> CacheBackend:
+    """Cache shared by every analysis of the process"""
+    global _cache
+    if _cache is None:
+        _cache = SQLiteCacheBackend()
+    return _cache
+
+
+def set_analysis_cache(cache: CacheBackend) -> None:
+    """Replace the cache backend used by the analyses"""
+    global _cache
+    _cache = cache
@@ -0,0 +1,141 @@
+"""
+Clone strategies used to fetch a repository before the analysis.
+
+The analysis only ever looks at the working tree of HEAD, so fetching the whole history is
+usually wasted time and disk. Available strategies:
+- full: plain clone with all history
+- shallow: depth 1 clone of the default branch
+- blobless: partial clone (`--filter=blob:none`), blobs are fetched for HEAD only on checkout
+- sparse: depth 1 blobless clone with a sparse checkout limited to supported extensions
+- mirror: incremental fetch of a cached bare mirror and checkout of HEAD from it (see mirrors.py),
+  the checkout has no .git directory
+
+Depth and filters are ignored by git for plain local paths, use `file://` URLs to clone local
+bare repositories (the bare repository needs `uploadpack.allowFilter=true` for filters).
+"""
+
+import logging
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List, Literal, Optional, get_args
+
+from git import Git, Repo
+
+from .languages import LANGUAGE_INDEX
+from .mirrors import get_mirror_cache
+
+logger = logging.getLogger(__name__)
+
+CloneStrategy = Literal["full", "shallow", "blobless", "sparse", "mirror"]
+CLONE_STRATEGIES: tuple = get_args(CloneStrategy)
+CLONE_STRATEGY: str = os.getenv("CLONE_STRATEGY", "mirror")
+
+
+@dataclass
+class CloneReport:
+    """What a clone cost"""
+
+    strategy: str
+    duration: float
+    bytes_transferred: int
+    # Cloned commit and git directory holding its objects (the mirror when no .git was checked out)
+    commit: str = ""
+    git_dir: str = ""
+
+    def as_dict(self) -> dict:
+        return {
+            "strategy": self.strategy,
+            "duration": self.duration,
+            "bytesTransferred": self.bytes_transferred,
+            "commit": self.commit,
+        }
+
+
+def supported_extensions() -> List[str]:
+    """Extensions listed in supported_extensions.csv"""
+    return sorted(LANGUAGE_INDEX.languages_by_extension)
+
+
+def sparse_patterns(extensions: Iterable[str]) -> List[str]:
+    """Non cone sparse checkout patterns matching the extensions anywhere in the tree"""
+    return [f"*{extension}" for extension in extensions]
+
+
+def objects_size(clone_dir: Path) -> int:
+    """Size of the object database, i.e. what was received from the remote"""
+    total_size = 0
+    for root, _, files in os.walk(Path(clone_dir) / ".git" / "objects"):
+        for file in files:
+            total_size += os.path.getsize(os.path.join(root, file))
+    return total_size
+
+
+def clone_with_strategy(
+    repo_url: str,
+    clone_dir: Path,
+    strategy: str = CLONE_STRATEGY,
+    checkout: bool = True,
+    max_bytes: Optional[int] = None,
+) -> CloneReport:
+    """Clone `repo_url` into `clone_dir` (which must not exist or be empty) with `strategy`
+
+    Without `checkout` only the object database is written, blobless and sparse clones need a
+    checkout as their blobs would otherwise be fetched one by one when read.
+    The mirror strategy raises RepositoryTooLarge before writing more than `max_bytes` into
+    `clone_dir`, the other ones fetch straight into it and can't know the size beforehand.
+    """
+    if strategy not in CLONE_STRATEGIES:
+        raise ValueError(f"Unknown clone strategy {strategy}, expected one of {CLONE_STRATEGIES}")
+    if not checkout and strategy in ("blobless", "sparse"):
+        raise ValueError(f"Clone strategy {strategy} needs a checkout")
+    start = time.perf_counter()
+    bytes_transferred = None
+    git_dir = str(clone_dir)
+    commit = None
+    if strategy == "mirror":
+        mirror_cache = get_mirror_cache()
+        if checkout:
+            bytes_transferred, commit = mirror_cache.checkout(repo_url, clone_dir, max_bytes=max_bytes)
+            git_dir = str(mirror_cache.mirror_path(repo_url))
+        else:
+            bytes_transferred = mirror_cache.clone(repo_url, clone_dir, max_bytes=max_bytes)
+    elif strategy == "full":
+        Repo.clone_from(repo_url, clone_dir, no_checkout=not checkout)
+    elif strategy == "shallow":
+        Repo.clone_from(
+            repo_url, clone_dir, depth=1, single_branch=True, no_checkout=not checkout
+        )
+    elif strategy == "blobless":
+        Repo.clone_from(repo_url, clone_dir, multi_options=["--filter=blob:none"])
+    else:
+        repo = Repo.clone_from(
+            repo_url,
+            clone_dir,
+            depth=1,
+            single_branch=True,
+            multi_options=["--filter=blob:none", "--no-checkout"],
+        )
+        repo.git.sparse_checkout("set", "--no-cone", *sparse_patterns(supported_extensions()))
+        # Only blobs matching the sparse patterns are fetched here
+        repo.git.checkout()
+    report = CloneReport(
+        strategy=strategy,
+        duration=time.perf_counter() - start,
+        bytes_transferred=(
+            objects_size(clone_dir) if bytes_transferred is None else bytes_transferred
+        ),
+        commit=commit if commit is not None else Repo(git_dir).head.commit.hexsha,
+        git_dir=git_dir,
+    )
+    logger.info(f"Cloned {repo_url} : {report}")
+    return report
+
+
+def resolve_head(repo_url: str) -> str:
+    """Commit HEAD of the remote points to, without cloning"""
+    output = Git().ls_remote(repo_url, "HEAD")
+    if not output:
+        raise ValueError(f"Could not resolve HEAD of {repo_url}")
+    return output.split()[0]
@@ -0,0 +1,193 @@
+"""
+Files left out of the scan: vendored, generated and ignored code no one wants audited.
+
+A path is excluded when it matches:
+- a .gitignore of the repository (nested .gitignore files apply to their directory, deeper
+  files take precedence like in git)
+- a `linguist-vendored`, `linguist-generated` or `linguist-documentation` attribute of the root
+  .gitattributes. Setting one of the first two to false keeps paths the built-in patterns of the
+  same kind would exclude
+- the built-in vendor, generated and lockfile patterns below. Directory names which are also
+  common source directory names (build/, dist/, out/, target/, external/) only match at the
+  root of the repository, like gitignore patterns starting with `/`
+
+Directories are matched while walking the tree, an excluded directory is never entered.
+The report counts excluded files and pruned directories by reason, and pruned directories by
+the built-in pattern which matched them.
+Set SCAN_EXCLUSIONS=0 to scan everything.
+"""
+
+import fnmatch
+import logging
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import pathspec
+
+logger = logging.getLogger(__name__)
+
+SCAN_EXCLUSIONS: bool = os.getenv("SCAN_EXCLUSIONS", "1") not in ("0", "false", "False")
+
+BUILTIN_PATTERNS: Dict[str, List[str]] = {
+    "vendored": [
+        "node_modules/", "bower_components/", "jspm_packages/", "vendor/", "third_party/",
+        "third-party/", "/external/", "Pods/", "Carthage/", ".venv/", "venv/", "site-packages/",
+        "__pycache__/", ".tox/", ".nox/", ".mypy_cache/", ".pytest_cache/", ".gradle/",
+        ".idea/", ".vscode/",
+    ],
+    "generated": [
+        "/dist/", "/build/", "/out/", "/target/", ".next/", ".nuxt/", ".svelte-kit/", "coverage/",
+        "htmlcov/", "*.min.js", "*.min.css", "*.js.map", "*.css.map", "*.bundle.js",
+        "*.pb.go", "*_pb2.py", "*_pb2_grpc.py", "*.pb.cc", "*.pb.h", "*.generated.*",
+        "*.g.dart", "*.freezed.dart", "*.Designer.cs", "*.pyc", "*.class",
+    ],
+    "lockfile": [
+        "package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml",
+        "bun.lockb", "Pipfile.lock", "poetry.lock", "pdm.lock", "uv.lock", "Cargo.lock",
+        "composer.lock", "Gemfile.lock", "go.sum", "mix.lock", "pubspec.lock",
+        "Podfile.lock", "packages.lock.json", "flake.lock",
+    ],
+}
+
+# Built-in patterns only name directories (trailing /) or files, wherever they are unless they
+# start with /. Excluded directories are pruned, so a directory is matched on its name and a
+# file on its base name
+BUILTIN_DIRECTORIES: Dict[str, Tuple[str, str]] = {
+    pattern.rstrip("/"): (reason, pattern)
+    for reason, patterns in BUILTIN_PATTERNS.items()
+    for pattern in patterns
+    if pattern.endswith("/") and not pattern.startswith("/")
+}
+# Directories only excluded at the root of the repository
+BUILTIN_ROOT_DIRECTORIES: Dict[str, Tuple[str, str]] = {
+    pattern.strip("/"): (reason, pattern)
+    for reason, patterns in BUILTIN_PATTERNS.items()
+    for pattern in patterns
+    if pattern.endswith("/") and pattern.startswith("/")
+}
+BUILTIN_FILE_REGEX = re.compile(
+    "|".join(
+        f"(?P<{reason}>{'|'.join(fnmatch.translate(pattern) for pattern in file_patterns)})"
+        for reason, patterns in BUILTIN_PATTERNS.items()
+        if (file_patterns := [pattern for pattern in patterns if not pattern.endswith("/")])
+    )
+)
+# Reason reported for paths excluded by .gitattributes, by attribute
+LINGUIST_ATTRIBUTES: Dict[str, str] = {
+    "linguist-vendored": "vendored",
+    "linguist-generated": "generated",
+    "linguist-documentation": "documentation",
+}
+
+
+@dataclass
+class ExclusionReport:
+    """Excluded files and pruned directories, by reason"""
+
+    files: Counter = field(default_factory=Counter)
+    directories: Counter = field(default_factory=Counter)
+    # Directories pruned by a built-in pattern, by pattern
+    directory_patterns: Counter = field(default_factory=Counter)
+
+    def as_dict(self) -> dict:
+        return {
+            "files": dict(self.files),
+            "directories": dict(self.directories),
+            "directoryPatterns": dict(self.directory_patterns),
+        }
+
+
+def parse_gitattributes(text: str) -> List[Tuple[pathspec.PathSpec, Dict[str, bool]]]:
+    """Linguist attributes of each .gitattributes line, True when set and False when unset"""
+    rules = []
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
+            continue
+        attributes = {}
+        for attribute in fields[1:]:
+            name, _, value = attribute.lstrip("-!").partition("=")
+            if name in LINGUIST_ATTRIBUTES:
+                attributes[name] = not attribute.startswith(("-", "!")) and value not in ("false", "0")
+        if attributes:
+            rules.append((pathspec.GitIgnoreSpec.from_lines([fields[0]]), attributes))
+    return rules
+
+
+class ExclusionRules:
+    """Decide which paths of a repository are excluded, paths are relative to its root with `/`"""
+
+    def __init__(self, gitattributes: str = "") -> None:
+        self.attribute_rules = parse_gitattributes(gitattributes)
+        # .gitignore of each directory, "" for the root
+        self.gitignores: Dict[str, pathspec.PathSpec] = {}
+        self.report = ExclusionReport()
+
+    def add_gitignore(self, directory: str, text: str) -> None:
+        self.gitignores[directory.strip("/")] = pathspec.GitIgnoreSpec.from_lines(text.splitlines())
+
+    def _ignored(self, path: str) -> bool:
+        ignored = False
+        parts = path.rstrip("/").split("/")
+        # Root first, the deepest .gitignore matching the path decides
+        for depth in range(len(parts)):
+            directory = "/".join(parts[:depth])
+            spec = self.gitignores.get(directory)
+            if spec is None:
+                continue
+            result = spec.check_file(path[len(directory) + 1:] if directory else path)
+            if result.include is not None:
+                ignored = result.include
+        return ignored
+
+    def _attributes(self, path: str) -> Dict[str, bool]:
+        attributes: Dict[str, bool] = {}
+        for spec, line_attributes in self.attribute_rules:
+            # Later lines override earlier ones
+            if spec.match_file(path):
+                attributes.update(line_attributes)
+        return attributes
+
+    def reason(self, path: str, is_dir: bool = False) -> Optional[str]:
+        """Why `path` is excluded, None if it is kept"""
+        return self._match(path, is_dir)[0]
+
+    def _match(self, path: str, is_dir: bool) -> Tuple[Optional[str], Optional[str]]:
+        """Why `path` is excluded and the built-in directory pattern which matched it, if any"""
+        if is_dir:
+            path = path.rstrip("/") + "/"
+        if self.gitignores and self._ignored(path):
+            return "ignored", None
+        attributes = self._attributes(path) if self.attribute_rules else {}
+        for attribute, reason in LINGUIST_ATTRIBUTES.items():
+            if attributes.get(attribute):
+                return reason, None
+        directory, _, name = path.rstrip("/").rpartition("/")
+        pattern = None
+        if is_dir:
+            builtin = BUILTIN_DIRECTORIES.get(name)
+            if builtin is None and not directory:
+                builtin = BUILTIN_ROOT_DIRECTORIES.get(name)
+            reason, pattern = builtin or (None, None)
+        else:
+            match = BUILTIN_FILE_REGEX.match(name)
+            reason = match.lastgroup if match is not None else None
+        # Kept on purpose by the repository
+        if reason == "vendored" and attributes.get("linguist-vendored") is False:
+            return None, None
+        if reason in ("generated", "lockfile") and attributes.get("linguist-generated") is False:
+            return None, None
+        return reason, pattern
+
+    def excludes(self, path: str, is_dir: bool = False) -> bool:
+        """Whether `path` is excluded, counted in the report when it is"""
+        reason, pattern = self._match(path, is_dir)
+        if reason is None:
+            return False
+        (self.report.directories if is_dir else self.report.files)[reason] += 1
+        if pattern is not None:
+            self.report.directory_patterns[pattern] += 1
+        return True
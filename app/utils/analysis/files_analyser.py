@@ -1,68 +1,213 @@
+import asyncio
 import json
 import os
 import logging
-import pandas as pd
-import chardet
+import shutil
 
 from pathlib import Path
-from typing import List, Tuple, Dict
-from collections import Counter
-from .ml import ChatGPTApi
-from git import Repo
+from typing import AsyncIterator, List, Optional, Tuple, Dict
+from collections import deque
+from concurrent.futures import Executor
+from .cache import CacheStats, cache_key, get_analysis_cache, git_blob_sha
+from ..executor import CPU_WORKERS, get_cpu_pool, run_io
+from ..services import get_model
+from .urls import format_github_url, normalize_repository_url
+from .cloning import CLONE_STRATEGY, CloneReport, clone_with_strategy
+from .line_counter import count_lines
+from .languages import LANGUAGE_INDEX, ExtensionCount, file_suffix, suffix_counts
+from .patterns import collect_findings
+from .prompts import FileCode, PlanTracker, PromptRequest, plan_prompts
+from .ranking import select_candidates
+from .scanner import INLINE_SCAN_THRESHOLD, ScanResult, StageTimer
+from .sources import SCAN_BACKEND, FileSource, GitTreeSource, WorkingTreeSource, open_file_source
 
 
-logging.basicConfig(
-    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
-)
 logger = logging.getLogger(__name__)
 
 
-config_path = "app/utils/analysis/config/supported_extensions.csv"
+# Maximum number of GPT calls in flight for a single in depth analysis
+MAX_CONCURRENT_ANALYSES = int(os.getenv("MAX_CONCURRENT_ANALYSES", 8))
+# Best ranked candidates of a batch kept when GPT answer for it can't be used
+SENSITIVE_FALLBACK_FILES = int(os.getenv("SENSITIVE_FALLBACK_FILES", 10))
 
-logger.debug("Loading GPT Model")
-model = ChatGPTApi()
-logger.debug("Model loaded")
 
-
-def get_important_programming_language(list_files: List[Path]) -> pd.DataFrame:
-    """Returns common extensions for the detected programming language"""
-    logger.debug("No extensions detected")
-    suffix_counts = Counter(map(lambda x: x.suffix, list_files))
-    most_common_suffix_list = suffix_counts.most_common()
-    logger.debug(f"Most common suffixes : {most_common_suffix_list}")
-    df = pd.read_csv(config_path)
-    # Find extensions which are in the list of supported extensions
-    # Count number of file for each extension
-    df["count"] = df["extension"].apply(
-        lambda x: suffix_counts[x] if x in suffix_counts else 0
-    )
-    df = df.sort_values(by="count", ascending=False)
-    # Remove extensions that are not in the list of supported extensions
-    df = df[df["count"] > 0]
-    logger.debug(df)
-    return df
+def get_important_programming_language(list_files: List[str]) -> List[ExtensionCount]:
+    """Returns common extensions for the detected programming language, most common first"""
+    counts = suffix_counts(map(str, list_files))
+    logger.debug(f"Most common suffixes : {counts.most_common()}")
+    # Keep extensions which are in the list of supported extensions
+    important_programming_language = LANGUAGE_INDEX.classify(counts)
+    logger.debug(important_programming_language)
+    return important_programming_language
 
 
-def get_sensitive_files(list_files: List[dict[str,str]]) -> dict[str, List[dict[str, str]]]:
+def get_sensitive_files(
+    list_files: List[dict[str,str]],
+    cache_stats: Optional[CacheStats] = None,
+    source: Optional[FileSource] = None,
+    line_counts: Optional[Dict[str, int]] = None,
+    pattern_findings: Optional[Dict[str, List[dict]]] = None,
+) -> dict[str, List[dict[str, str]]]:
     """Identify sensitive files using GPT
-    
+
+    Candidates are ranked locally first, only the best ones are sent to GPT in batches of bounded
+    size (see ranking.py), files with findings of the pattern scanner first. Batches are sent in
+    rank order and their answers merged.
+
     return list of files {sensitiveFiles:[{"path": str, "language": str},]}
     """
-    logger.debug("Loading GPT Model")
-    logger.debug("Model loaded")
-    sensitive_files = model.identify_sensitive_files(list_files)
+    # GPT sees paths relative to the clone, the answer (and its cache entry) doesn't depend on
+    # the workspace the repository was cloned in
+    root = source.root.rstrip("/") + "/" if source is not None else ""
+    sensitive_files: Dict[str, dict] = {}
+    for batch in select_candidates(list_files, source, line_counts, pattern_findings=pattern_findings):
+        for file_data in identify_sensitive_batch(batch, cache_stats, root):
+            sensitive_files.setdefault(str(file_data.get("path")), file_data)
+    logger.debug("All files analysed")
+    return {"sensitiveFiles": list(sensitive_files.values())}
+
+
+def identify_sensitive_batch(
+    batch: List[dict[str, str]], cache_stats: Optional[CacheStats] = None, root: str = ""
+) -> List[dict[str, str]]:
+    """Sensitive files of a batch of candidates, GPT may only pick files of the batch
+
+    Paths are sent to GPT without `root`. When GPT answer can't be used, the best ranked files of
+    the batch are kept so the audit never silently covers nothing.
+    """
+    candidates = {}
+    for file_data in batch:
+        path = str(file_data.get("path"))
+        candidates[path[len(root):] if root and path.startswith(root) else path] = file_data
+    prompt_files = [
+        {"path": path, "language": file_data.get("language")}
+        for path, file_data in candidates.items()
+    ]
+    cache = get_analysis_cache()
+    # The list of candidates is the content GPT sees, so it is hashed like a blob
+    key = cache_key(
+        git_blob_sha(str(prompt_files).encode()), "", "sensitiveFiles", get_model().version
+    )
+    cached_sensitive_files = cache.get(key)
+    if cache_stats is not None:
+        cache_stats.record(cached_sensitive_files is not None)
+    if cached_sensitive_files is not None:
+        logger.debug("Sensitive files found in cache")
+        return [candidates[path] for path in json.loads(cached_sensitive_files) if path in candidates]
     try:
         # Try to format the data in json
-        sensitive_files = json.loads(str(sensitive_files))
-        logger.debug("All files analysed")
-        return sensitive_files
+        answer = json.loads(str(get_model().identify_sensitive_files(prompt_files)))["sensitiveFiles"]
+        # Keep the language detected by the scan, drop paths GPT made up
+        sensitive_paths = list(dict.fromkeys(
+            str(file_data.get("path"))
+            for file_data in answer
+            if isinstance(file_data, dict) and str(file_data.get("path")) in candidates
+        ))
     except Exception as error:
         logger.error(f"When identifying sensitive files an error has occured (likely GPT forgetting sensitive_files key) : {error}")
-        return {"sensitiveFiles": []}
+        return batch[:SENSITIVE_FALLBACK_FILES]
+    cache.set(key, json.dumps(sensitive_paths))
+    return [candidates[path] for path in sensitive_paths]
+
+
+def read_file_lines(file_path: str, source: Optional[FileSource] = None) -> Tuple[str, List[str]]:
+    """Read a file from `source`, the working tree by default
+
+    returns the git blob SHA of the file and its lines
+    """
+    logger.info(f"Reading file : {file_path}")
+    if source is None:
+        source = WorkingTreeSource(os.path.dirname(file_path))
+    raw_data = source.read(file_path)
+    blob_sha = source.blob_sha(file_path) if isinstance(source, GitTreeSource) else git_blob_sha(raw_data)
+    return blob_sha, raw_data.decode(errors="replace").splitlines(keepends=True)
+
+
+def parse_issues(in_depth_result: str) -> Optional[List[dict]]:
+    """Format GPT answer in json, we should get something like {"issues":[]}"""
+    try:
+        issues = json.loads(in_depth_result)["issues"]
+        if not isinstance(issues, list):
+            raise ValueError("issues is not a list")
+    except Exception as error:
+        logger.error(f"When identifying in depth file analysis an error has occured (likely GPT forgetting issues key) : {error}")
+        return None
+    if issues:
+        logger.warning(f"Sensitive code found : {issues}")
+    return issues
+
+
+def load_cached_analysis(
+    key: str, file_path: str, cache_stats: Optional[CacheStats] = None
+) -> Optional[dict]:
+    """Return the cached in depth analysis of a file, None on a miss"""
+    cached_result = get_analysis_cache().get(key)
+    if cache_stats is not None:
+        cache_stats.record(cached_result is not None)
+    if cached_result is None:
+        return None
+    logger.debug(f"In depth analysis found in cache : {file_path}")
+    in_depth_result = json.loads(cached_result)
+    in_depth_result["path"] = file_path
+    return in_depth_result
+
+
+def store_cached_analysis(key: str, in_depth_result: dict) -> None:
+    """Cache an in depth analysis, the path is left out as the same blob may live anywhere"""
+    get_analysis_cache().set(
+        key, json.dumps({k: v for k, v in in_depth_result.items() if k != "path"})
+    )
+
+
+def prepare_in_depth_analysis(
+    list_files: List[dict[str, str]],
+    audit_type: str = 'security',
+    cache_stats: Optional[CacheStats] = None,
+    source: Optional[FileSource] = None,
+) -> Tuple[List[dict], Dict[str, str], List[FileCode]]:
+    """Read files and look them up in the analysis cache
+
+    returns the results already known (cached, empty or unreadable files), the cache key of each
+    file and the files left to send to GPT
+    """
+    known_results = []
+    keys = {}
+    files_to_analyse = []
+    version = get_model().version
+    for file_data in list_files:
+        file_path = str(file_data.get("path"))
+        language = str(file_data.get("language"))
+        try:
+            blob_sha, lines = read_file_lines(file_path, source)
+        except Exception as error:
+            logger.error(f"An error has occured for file : {file_path} : {error}")
+            known_results.append({"issues": [], "path": file_path, "incomplete": True})
+            continue
+        if not lines:
+            known_results.append({"issues": [], "path": file_path})
+            continue
+        keys[file_path] = cache_key(blob_sha, language, audit_type, version)
+        in_depth_result = load_cached_analysis(keys[file_path], file_path, cache_stats)
+        if in_depth_result is not None:
+            known_results.append(in_depth_result)
+        else:
+            files_to_analyse.append(FileCode(path=file_path, language=language, lines=lines))
+    return known_results, keys, files_to_analyse
+
 
+def complete_in_depth_result(keys: Dict[str, str], in_depth_result: dict) -> None:
+    """Cache the result of a file once all its requests are done"""
+    if not in_depth_result.get("incomplete"):
+        store_cached_analysis(keys[in_depth_result["path"]], in_depth_result)
 
-def get_in_depth_file_analysis(list_files: List[dict[str,str]], audit_type: str = 'security') -> List[dict[str, str]]:
-    """Asynchronously analyse each file with GPT to locate sensitive code
+
+def get_in_depth_file_analysis(
+    list_files: List[dict[str,str]],
+    audit_type: str = 'security',
+    cache_stats: Optional[CacheStats] = None,
+    source: Optional[FileSource] = None,
+) -> List[dict[str, str]]:
+    """Analyse each file with GPT to locate sensitive code
     For each file it returns a list of issues which are dict with keys:
     - lineNumber
     - initialCode
@@ -70,138 +215,191 @@ def get_in_depth_file_analysis(list_files: List[dict[str,str]], audit_type: str
     - comment
     - suggestion
 
+    Files are chunked or packed together into requests sized for the model (see prompts.py).
     We have to ensure we lead an analysis on relevent files (files that are likely to contain sensitive code)
     """
-    in_depth_results = []
-    # Limit the number of files to 5 for testing
-    list_files = list_files[:5]
-    for file_data in list_files:
-        logger.error(file_data)
-        file_path = str(file_data.get("path"))
+    in_depth_results, keys, files_to_analyse = prepare_in_depth_analysis(
+        list_files, audit_type, cache_stats, source
+    )
+    requests = deque(plan_prompts(files_to_analyse))
+    tracker = PlanTracker(list(requests))
+    while requests:
+        request = requests.popleft()
         try:
-            with open(file_path, "r") as file:
-                logger.info(f"Reading file : {file_path}")
-                # Put line numbers before each line so GPT can understand the context
-                content = list(
-                    map(
-                        lambda line: f"{line[0]}. {line[1]}" if line[1] != "" else None,
-                        enumerate(file.readlines(), 1),
-                    )
+            issues = parse_issues(
+                get_model().in_depth_analysis(
+                    request.code, request.language, audit_type, request.multiple_files
                 )
-                code = "".join([line for line in content if line is not None])
-                logger.info(f"Code to analyze : {code}")
-                in_depth_result = model.in_depth_analysis(
-                    code, str(file_data.get("language")),audit_type
-                )
-                try:
-                    # Try to format the data in json
-                    in_depth_result = json.loads(in_depth_result)
-                    # We should get something like {"issues":[]}
-                except Exception as error:
-                    logger.error(f"When identifying in depth file analysis an error has occured (likely GPT forgetting issues key) : {error}")
-                    continue # Goes to next file
-                logger.warning(f"Sensitive code found in file : {file_path}")
-                logger.warning(in_depth_result)
-                in_depth_result["path"] = file_path
-                in_depth_results.append(in_depth_result) # Add the analysis to the list
+            )
         except Exception as error:
-            logger.error(f"An error has occured for file : {file_path} : {error}")
+            logger.error(f"An error has occured for files : {request.paths} : {error}")
+            issues = None
+        retries, completed = tracker.record(request, issues)
+        requests.extend(retries)
+        for in_depth_result in completed:
+            complete_in_depth_result(keys, in_depth_result)
+            in_depth_results.append(in_depth_result) # Add the analysis to the list
     return in_depth_results
 
 
-def format_github_url(url: str) -> str:
-    """Format the URL to be used with the Github API"""
-    # Make sure there is github.com in the URL
-    if "github.com" not in url:
-        url = f"github.com/{url}"
-    # Make sure there is https:// in the URL
-    if "https://" not in url:
-        url = f"https://{url}"
-    return url
+async def iter_in_depth_file_analysis(
+    list_files: List[dict[str, str]],
+    audit_type: str = 'security',
+    max_concurrency: int = MAX_CONCURRENT_ANALYSES,
+    cache_stats: Optional[CacheStats] = None,
+    source: Optional[FileSource] = None,
+) -> AsyncIterator[dict]:
+    """Analyse all files concurrently and yield each result as soon as it is available
+
+    Cached results come first. The other files are chunked or packed together into requests
+    sized for the model (see prompts.py), at most `max_concurrency` requests are in flight.
+    """
+    known_results, keys, files_to_analyse = await run_io(
+        prepare_in_depth_analysis, list_files, audit_type, cache_stats, source
+    )
+    for in_depth_result in known_results:
+        yield in_depth_result
+
+    requests = plan_prompts(files_to_analyse)
+    tracker = PlanTracker(requests)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def send_request(request: PromptRequest) -> Tuple[PromptRequest, Optional[List[dict]]]:
+        async with semaphore:
+            try:
+                in_depth_result = await get_model().ain_depth_analysis(
+                    request.code, request.language, audit_type, request.multiple_files
+                )
+            except Exception as error:
+                logger.error(f"An error has occured for files : {request.paths} : {error}")
+                return request, None
+        return request, parse_issues(in_depth_result)
+
+    pending = {asyncio.create_task(send_request(request)) for request in requests}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                retries, completed = tracker.record(*task.result())
+                pending |= {asyncio.create_task(send_request(retry)) for retry in retries}
+                for in_depth_result in completed:
+                    await run_io(complete_in_depth_result, keys, in_depth_result)
+                    yield in_depth_result
+    finally:
+        # Client went away or caller stopped iterating, don't keep paying for GPT calls
+        for task in pending:
+            task.cancel()
+
+
+def clone_repo(
+    repo_url,
+    clone_dir,
+    strategy: str = CLONE_STRATEGY,
+    checkout: bool = True,
+    max_bytes: Optional[int] = None,
+) -> CloneReport:
+    """Clone the repository with the selected strategy (see cloning.py)
 
-def clone_repo(repo_url, clone_dir):
+    Without checkout only the object database is written, to be read with a GitTreeSource.
+    With `max_bytes`, mirror clones bigger than that are rejected before being written.
+    """
     if not os.path.exists(clone_dir):
         os.makedirs(clone_dir)
     # Remove all files in the directory
     clean_dir(clone_dir)
     # Clone the repository
-    Repo.clone_from(repo_url, clone_dir)
+    return clone_with_strategy(repo_url, clone_dir, strategy, checkout, max_bytes)
 
 
 def clean_dir(clone_dir):
-    # Remove all files in the directory
-    for root, dirs, files in os.walk(clone_dir, topdown=False, followlinks=True):
-        for file in files:
-            logger.debug(f"Removing file {file}")
-            os.remove(os.path.join(root, file))
-        for dir in dirs:
-            logger.debug(f"Removing dir {dir}")
-            os.rmdir(os.path.join(root, dir))
-    os.rmdir(clone_dir)
-
-
-# Function to count lines in a file
-def count_lines(file_path):
-    try:
-        with open(file_path, "rb") as file:
-            # TODO: Call GPT to identify not handled errors
-            raw_data = file.read()
-            result = chardet.detect(raw_data)
-            encoding = result["encoding"]
-            text = raw_data.decode(str(encoding))
-            lines = text.splitlines()
-            return len(lines)
-    except Exception as e:
-        print(f"Error reading {file_path}: {e}")
-        return 0
+    # Remove the directory and everything in it
+    shutil.rmtree(clone_dir)
 
 
-def get_simple_repository_analysis(
+def scan_repository(
     clone_dir: Path,
-) -> Tuple[int, int, List[str], List[dict]]:
-    """Analyse the repository
+    pool: Optional[Executor] = None,
+    source: Optional[FileSource] = None,
+    known_line_counts: Optional[Dict[str, int]] = None,
+    patterns: bool = False,
+) -> ScanResult:
+    """Analyse the repository, read from `source` (the working tree of `clone_dir` by default)
+
+    Files listed in `known_line_counts` (unchanged since a previous audit) are not counted again.
+    With `patterns`, every file is also searched for secrets and dangerous code (see patterns.py).
 
-    - Get the list of files
+    - Get the list of files, without vendored, generated and ignored ones (see exclusions.py)
     - Count number of files
-    - Count number of lines
+    - Count number of lines (in parallel on `pool`, the shared CPU pool by default)
+    - Search files for secrets and dangerous patterns, when asked
     - Identify most common extensions
     - Filter files with selected extensions
 
-    returns number_of_files, total_line_count, most_common_programming_languages, code_which_may_throw_error
+    returns the result of each step and the time spent in each stage
     """
-    if type(clone_dir) == str:
-        clone_dir = Path(clone_dir)
-    list_files_paths = list(clone_dir.rglob("*.*"))
-    number_of_files = len(list_files_paths)
-    total_line_count = 0
-    for file_path in list_files_paths:
-        total_line_count += count_lines(file_path)
-    important_programming_language = get_important_programming_language(
-        list_files_paths
+    timer = StageTimer()
+    if source is None:
+        source = WorkingTreeSource(str(clone_dir))
+    list_files = source.list_files()
+    number_of_files = len(list_files)
+    timer.lap("walk")
+    known_line_counts = known_line_counts or {}
+    files_to_count = [file for file in list_files if file not in known_line_counts]
+    if pool is None and len(files_to_count) >= INLINE_SCAN_THRESHOLD:
+        pool = get_cpu_pool()
+    line_counts = dict(
+        zip(files_to_count, source.count_lines(files_to_count, pool, CPU_WORKERS))
+    )
+    line_counts.update(
+        (file, known_line_counts[file]) for file in list_files if file in known_line_counts
     )
-    list_of_important_extensions = important_programming_language["extension"].to_list()
+    total_line_count = sum(line_counts.values())
+    timer.lap("count")
+    pattern_findings = {}
+    if patterns:
+        if pool is None and len(list_files) >= INLINE_SCAN_THRESHOLD:
+            pool = get_cpu_pool()
+        pattern_findings = collect_findings(
+            list_files, source.scan_patterns(list_files, pool, CPU_WORKERS)
+        )
+        logger.debug(f"Pattern findings in {len(pattern_findings)} files")
+        timer.lap("patterns")
+    important_programming_language = get_important_programming_language(list_files)
+    language_by_extension = {
+        entry.extension: entry.language for entry in important_programming_language
+    }
+    logger.debug(f"Selected extensions : {list(language_by_extension)}")
     # List of programming languages are going to be used for keywords
-    list_of_programming_languages = important_programming_language["name"].to_list()
-    logger.debug(f"Selected extensions : {list_of_important_extensions}")
-    # Filter files with selected extensions
-    selected_files = list(
-        filter(lambda x: x.suffix in list_of_important_extensions, list_files_paths)
+    list_of_programming_languages = list(
+        dict.fromkeys(entry.language for entry in important_programming_language)
     )
-    logger.debug(f"Selected files : {selected_files}")
-    # Change list to dict with filepath and programming language as keys
+    # Change list to dict with filepath and programming language as keys, for files with selected extensions
     ready_for_analysis = [
-        {
-            "path": str(file),
-            "language": important_programming_language[
-                important_programming_language["extension"] == file.suffix
-            ]["name"].values[0],
-        }
-        for file in selected_files
+        {"path": file, "language": language_by_extension[suffix]}
+        for file in list_files
+        if (suffix := file_suffix(file)) in language_by_extension
     ]
+    logger.debug(f"Selected files : {ready_for_analysis}")
+    timer.lap("classify")
+    logger.debug(f"Scan timings : {timer.timings}")
 
-    return (
-        number_of_files,
-        total_line_count,
-        list_of_programming_languages,
-        ready_for_analysis,
+    return ScanResult(
+        number_of_files=number_of_files,
+        total_line_count=total_line_count,
+        list_of_programming_languages=list_of_programming_languages,
+        ready_for_analysis=ready_for_analysis,
+        timings=timer.timings,
+        line_counts=line_counts,
+        excluded=source.exclusions.as_dict() if source.exclusions is not None else {},
+        pattern_findings=pattern_findings,
     )
+
+
+def get_simple_repository_analysis(
+    clone_dir: Path,
+) -> Tuple[int, int, List[str], List[dict]]:
+    """Analyse the repository, see scan_repository
+
+    returns number_of_files, total_line_count, most_common_programming_languages, code_which_may_throw_error
+    """
+    return scan_repository(clone_dir).as_tuple()
@@ -0,0 +1,94 @@
+"""
+Extension to programming language index.
+
+supported_extensions.csv is compiled once, at import, into immutable mappings so classifying a
+file is a dict lookup. Some extensions belong to several languages (`.h` is listed for C, C++
+and Objective-C), they are resolved per repository: the candidate whose unambiguous extensions
+are the most frequent in the repository wins, ties go to the first language listed in the CSV.
+"""
+
+import csv
+import os
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from types import MappingProxyType
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+SUPPORTED_EXTENSIONS_PATH = Path(__file__).parent / "config" / "supported_extensions.csv"
+
+
+class ExtensionCount(NamedTuple):
+    extension: str
+    language: str
+    count: int
+
+
+@dataclass(frozen=True)
+class LanguageIndex:
+    # Candidate languages of each extension, in CSV order
+    languages_by_extension: Mapping[str, Tuple[str, ...]]
+    extensions_by_language: Mapping[str, Tuple[str, ...]]
+    # Position of each extension in the CSV, used to break ties deterministically
+    extension_order: Mapping[str, int]
+
+    def resolve(self, extension: str, suffix_counts: Mapping[str, int]) -> Optional[str]:
+        """Language of `extension` in a repository with these extension counts"""
+        candidates = self.languages_by_extension.get(extension)
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0]
+
+        def evidence(language: str) -> int:
+            return sum(
+                suffix_counts.get(other, 0)
+                for other in self.extensions_by_language[language]
+                if len(self.languages_by_extension[other]) == 1
+            )
+
+        # max keeps the first of equal candidates, i.e. CSV order
+        return max(candidates, key=evidence)
+
+    def classify(self, suffix_counts: Mapping[str, int]) -> List[ExtensionCount]:
+        """Supported extensions found in a repository, most common first"""
+        found = [
+            ExtensionCount(extension, language, count)
+            for extension, count in suffix_counts.items()
+            if count > 0
+            and (language := self.resolve(extension, suffix_counts)) is not None
+        ]
+        return sorted(found, key=lambda entry: (-entry.count, self.extension_order[entry.extension]))
+
+
+def load_language_index(path: Path = SUPPORTED_EXTENSIONS_PATH) -> LanguageIndex:
+    languages_by_extension: Dict[str, List[str]] = {}
+    extensions_by_language: Dict[str, List[str]] = {}
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            languages_by_extension.setdefault(row["extension"], []).append(row["name"])
+            extensions_by_language.setdefault(row["name"], []).append(row["extension"])
+    return LanguageIndex(
+        languages_by_extension=MappingProxyType(
+            {extension: tuple(languages) for extension, languages in languages_by_extension.items()}
+        ),
+        extensions_by_language=MappingProxyType(
+            {language: tuple(extensions) for language, extensions in extensions_by_language.items()}
+        ),
+        extension_order=MappingProxyType(
+            {extension: position for position, extension in enumerate(languages_by_extension)}
+        ),
+    )
+
+
+LANGUAGE_INDEX = load_language_index()
+
+
+def file_suffix(path: str) -> str:
+    """Extension of a file, like Path.suffix but without building a Path"""
+    return os.path.splitext(path)[1]
+
+
+def suffix_counts(paths: Iterable[str]) -> Counter:
+    """Number of files for each extension"""
+    return Counter(map(file_suffix, paths))
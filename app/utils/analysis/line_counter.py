@@ -0,0 +1,124 @@
+"""
+Streaming line counter used by the repository scan.
+
+Only "\\n", "\\r\\n" and lone "\\r" end a line, like in files opened in text mode. Unlike
+`str.splitlines`, the other Unicode line boundaries (\\x0b, \\x0c, \\x1c-\\x1e, \\x85, U+2028,
+U+2029) don't. Lines are counted on raw bytes read in fixed size buffers, which works for every
+ASCII compatible encoding (UTF-8, latin-1, cp1252...) without detecting the encoding nor
+decoding the file.
+Only files which look like UTF-16/32 (BOM or NUL byte pattern), where a newline is not a single
+byte, are decoded, and counted the same way.
+Binary files are detected from the first buffer and count as 0 lines.
+"""
+
+import codecs
+import io
+import logging
+from typing import BinaryIO, Optional
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1024 * 1024
+SAMPLE_SIZE = 8192
+
+# UTF-32 BOMs first, the UTF-32-LE one starts with the UTF-16-LE one
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+
+def wide_encoding(sample: bytes) -> Optional[str]:
+    """Return the encoding of a UTF-16/32 looking sample, None for ASCII compatible ones"""
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+    if b"\0" not in sample:
+        return None
+    # Without BOM, mostly ASCII UTF-16 text has NUL high bytes on one parity only
+    half = len(sample) // 2
+    if half < 4:
+        return None
+    even_nul = sample[0::2].count(0)
+    odd_nul = sample[1::2].count(0)
+    if odd_nul > 0.7 * half and even_nul < 0.1 * half:
+        return "utf-16-le"
+    if even_nul > 0.7 * half and odd_nul < 0.1 * half:
+        return "utf-16-be"
+    return None
+
+
+def is_binary(sample: bytes) -> bool:
+    """Files with NUL bytes which are not UTF-16/32 text are considered binary"""
+    return b"\0" in sample
+
+
+class LineCounter:
+    """Incremental line counter, feed it buffers in order and read `lines` at the end
+
+    Counts "\\n", "\\r\\n" and lone "\\r" as line breaks plus a final unterminated line.
+    """
+
+    def __init__(self) -> None:
+        self.breaks = 0
+        self.previous_cr = False
+        self.last_byte = b""
+
+    def feed(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        self.breaks += chunk.count(b"\n") + chunk.count(b"\r") - chunk.count(b"\r\n")
+        # "\r\n" split between two buffers was counted twice
+        if self.previous_cr and chunk[:1] == b"\n":
+            self.breaks -= 1
+        self.previous_cr = chunk[-1:] == b"\r"
+        self.last_byte = chunk[-1:]
+
+    @property
+    def lines(self) -> int:
+        if self.last_byte and self.last_byte not in (b"\n", b"\r"):
+            return self.breaks + 1
+        return self.breaks
+
+
+def decode_and_count(data: bytes, encoding: str) -> int:
+    # Counted as UTF-8 so the same line breaks count as in other files
+    counter = LineCounter()
+    counter.feed(data.decode(encoding, errors="replace").encode())
+    return counter.lines
+
+
+def count_lines_in_stream(stream: BinaryIO) -> int:
+    """Count lines of a binary stream, reading it in buffers of BUFFER_SIZE bytes"""
+    chunk = stream.read(BUFFER_SIZE)
+    sample = chunk[:SAMPLE_SIZE]
+    encoding = wide_encoding(sample)
+    if encoding is not None:
+        return decode_and_count(chunk + stream.read(), encoding)
+    if is_binary(sample):
+        # Consume the stream anyway, git object streams must be read to the end
+        while stream.read(BUFFER_SIZE):
+            pass
+        return 0
+    counter = LineCounter()
+    while chunk:
+        counter.feed(chunk)
+        chunk = stream.read(BUFFER_SIZE)
+    return counter.lines
+
+
+def count_lines_in_bytes(data: bytes) -> int:
+    """Count lines of an in-memory file"""
+    return count_lines_in_stream(io.BytesIO(data))
+
+
+def count_lines(file_path) -> int:
+    """Count lines of a file"""
+    try:
+        with open(file_path, "rb") as file:
+            return count_lines_in_stream(file)
+    except Exception as e:
+        logger.error(f"Error reading {file_path}: {e}")
+        return 0
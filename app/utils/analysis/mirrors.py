@@ -0,0 +1,206 @@
+"""
+Persistent cache of bare mirror repositories.
+
+Each repository is mirrored once under MIRROR_CACHE_DIR, keyed by its normalized URL.
+Repeat analyses only run an incremental `git fetch` and check HEAD out of the mirror into
+their workspace, which is much faster than a fresh clone.
+
+Every mirror has a lock file, held exclusively while the mirror is created, fetched or evicted
+and shared while it is read, so concurrent jobs on the same repository safely share one mirror.
+The lock file modification time records the last use, mirrors are evicted least recently used
+first once the cache exceeds MIRROR_CACHE_MAX_BYTES.
+The size of a commit is known from the mirror before it is checked out, so a job's disk quota is
+checked before anything is written to its workspace.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from git import Repo
+
+from .urls import normalize_repository_url
+
+logger = logging.getLogger(__name__)
+
+MIRROR_CACHE_DIR: str = os.getenv("MIRROR_CACHE_DIR", "mirrors")
+MIRROR_CACHE_MAX_BYTES: int = int(
+    os.getenv("MIRROR_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024)
+)
+
+
+class RepositoryTooLarge(Exception):
+    pass
+
+
+def directory_size(path: Path) -> int:
+    total_size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total_size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                # File removed by a concurrent gc/fetch
+                continue
+    return total_size
+
+
+class MirrorCache:
+    """Bare mirrors shared by every analysis, with a disk budget and LRU eviction"""
+
+    def __init__(self, root: str = MIRROR_CACHE_DIR, max_bytes: int = MIRROR_CACHE_MAX_BYTES) -> None:
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def mirror_path(self, repo_url: str) -> Path:
+        """Directory of the mirror of `repo_url`, readable name followed by a hash of the URL"""
+        normalized_url = normalize_repository_url(repo_url)
+        digest = hashlib.sha256(normalized_url.encode()).hexdigest()[:16]
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", normalized_url.rsplit("/", 1)[-1])[:64]
+        return self.root / f"{name}-{digest}.git"
+
+    @contextmanager
+    def lock(self, mirror: Path, *, exclusive: bool, blocking: bool = True) -> Iterator[bool]:
+        """Hold the lock of a mirror, yields False if `blocking` is False and the lock is busy
+
+        flock locks belong to the open file, so threads of the same process exclude each other too.
+        """
+        lock_path = mirror.with_suffix(".lock")
+        with open(lock_path, "a") as lock_file:
+            flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def update(self, repo_url: str) -> int:
+        """Create or fetch the mirror of `repo_url`, returns the number of bytes received"""
+        mirror = self.mirror_path(repo_url)
+        with self.lock(mirror, exclusive=True):
+            size_before = directory_size(mirror) if mirror.exists() else 0
+            if mirror.exists():
+                logger.debug(f"Fetching mirror {mirror}")
+                Repo(mirror).git.fetch("--prune", "origin")
+            else:
+                logger.debug(f"Creating mirror {mirror}")
+                # Clone next to the final path and rename, so a crash never leaves a half mirror
+                tmp_mirror = mirror.with_suffix(f".tmp-{os.getpid()}")
+                shutil.rmtree(tmp_mirror, ignore_errors=True)
+                Repo.clone_from(repo_url, tmp_mirror, mirror=True)
+                os.rename(tmp_mirror, mirror)
+            os.utime(mirror.with_suffix(".lock"))
+            return max(directory_size(mirror) - size_before, 0)
+
+    @staticmethod
+    def _check_size(size: int, max_bytes: Optional[int]) -> None:
+        if max_bytes is not None and size > max_bytes:
+            raise RepositoryTooLarge(
+                f"Repository uses {size} bytes, more than the {max_bytes} bytes allowed"
+            )
+
+    def checkout(
+        self, repo_url: str, dest: Path, rev: str = "HEAD", max_bytes: Optional[int] = None
+    ) -> Tuple[int, str]:
+        """Update the mirror and check `rev` out into `dest`
+
+        Files are written like a clone writes them: export attributes don't apply and symlinks
+        are kept as is. Raises RepositoryTooLarge without writing anything if the files of `rev`
+        take more than `max_bytes`. returns the number of bytes received and the commit checked out
+        """
+        bytes_transferred = self.update(repo_url)
+        mirror = self.mirror_path(repo_url)
+        with self.lock(mirror, exclusive=False):
+            repo = Repo(mirror)
+            commit = repo.commit(rev).hexsha
+            if max_bytes is not None:
+                self._check_size(tree_size(repo, commit), max_bytes)
+            Path(dest).mkdir(parents=True, exist_ok=True)
+            # With an index of its own, concurrent checkouts never write into the shared mirror
+            with tempfile.TemporaryDirectory() as index_dir:
+                repo.git.checkout(
+                    commit,
+                    "--",
+                    ".",
+                    env={
+                        "GIT_INDEX_FILE": os.path.join(index_dir, "index"),
+                        "GIT_WORK_TREE": str(Path(dest).resolve()),
+                    },
+                )
+        self.evict(keep=mirror)
+        return bytes_transferred, commit
+
+    def clone(self, repo_url: str, dest: Path, max_bytes: Optional[int] = None) -> int:
+        """Update the mirror and clone it into `dest` without checkout, returns the number of bytes received
+
+        Objects are hardlinked from the mirror, the clone stays valid if the mirror is evicted.
+        Raises RepositoryTooLarge without cloning if the objects take more than `max_bytes`.
+        """
+        bytes_transferred = self.update(repo_url)
+        mirror = self.mirror_path(repo_url)
+        with self.lock(mirror, exclusive=False):
+            self._check_size(directory_size(mirror / "objects"), max_bytes)
+            Repo.clone_from(str(mirror), dest, local=True, no_checkout=True)
+        self.evict(keep=mirror)
+        return bytes_transferred
+
+    def evict(self, keep: Optional[Path] = None) -> None:
+        """Remove least recently used mirrors until the cache fits in its budget
+
+        Mirrors currently in use are skipped.
+        """
+        mirrors = [
+            (mirror.with_suffix(".lock").stat().st_mtime, mirror, directory_size(mirror))
+            for mirror in self.root.glob("*.git")
+            if mirror.with_suffix(".lock").exists()
+        ]
+        total_size = sum(size for _, _, size in mirrors)
+        for _, mirror, size in sorted(mirrors, key=lambda entry: entry[0]):
+            if total_size <= self.max_bytes:
+                break
+            if mirror == keep:
+                continue
+            with self.lock(mirror, exclusive=True, blocking=False) as locked:
+                if not locked:
+                    continue
+                logger.info(f"Evicting mirror {mirror} ({size} bytes)")
+                shutil.rmtree(mirror, ignore_errors=True)
+                total_size -= size
+
+
+def tree_size(repo: Repo, commit: str) -> int:
+    """Size of the files of `commit`, what checking it out writes"""
+    total_size = 0
+    for line in repo.git.ls_tree("-r", "-l", "-z", "--full-tree", commit).split("\0"):
+        if not line:
+            continue
+        # <mode> SP <type> SP <object> SP <size> TAB <file>, size is "-" for submodules
+        size = line.split("\t", 1)[0].split()[3]
+        if size != "-":
+            total_size += int(size)
+    return total_size
+
+
+_mirror_cache: Optional[MirrorCache] = None
+
+
+def get_mirror_cache() -> MirrorCache:
+    """Mirror cache shared by every analysis of the process"""
+    global _mirror_cache
+    if _mirror_cache is None:
+        _mirror_cache = MirrorCache()
+    return _mirror_cache
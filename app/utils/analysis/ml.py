@@ -1,29 +1,28 @@
-import os
 import logging
-from openai import OpenAI
-from typing import List
+from typing import List, Optional
 
+from .backends import LLMBackend, create_backend
 
 logger = logging.getLogger(__name__)
 
+# Bump when prompts change, cached analyses made with other prompts are ignored
+PROMPT_VERSION = "1"
+
 
 class ChatGPTApi:
-    """Class that is used to call chatgpt, you need to have your openai API key as an environemnt variable named OPENAI_API_KEY"""
+    """Class that is used to call the LLM, the backend is selected with LLM_BACKEND (see backends.py)"""
 
-    def __init__(self) -> None:
-        assert (
-            os.getenv("OPENAI_API_KEY") is not None
-        ), "No API key detected, please setup your API key as an environement variable under the name OPENAI_API_KEY"
-        self.client = OpenAI()
+    def __init__(self, backend: Optional[LLMBackend] = None) -> None:
+        self.backend = backend or create_backend()
+        # Identifies the prompts and model answering them, used to key cached analyses
+        self.version = f"{self.backend.version}:{PROMPT_VERSION}"
 
     def call(self, *, message) -> str:
-        response = self.client.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            response_format={"type": "json_object"},
-            messages=message,
-        )
-        logger.debug(response)
-        return str(response.choices[0].message.content)
+        return self.backend.complete(message)
+
+    async def acall(self, *, message) -> str:
+        """Same as `call` but without blocking the event loop, so many calls can run concurrently"""
+        return await self.backend.acomplete(message)
 
     def identify_sensitive_files(self, files: List[dict]) -> str:
         """Identify sensitive files using GPT"""
@@ -60,11 +59,44 @@ class ChatGPTApi:
         return self.call(message=message)
 
     def in_depth_analysis(
-        self, code: str, language: str = "python", audit_type: str = "security"
+        self,
+        code: str,
+        language: str = "python",
+        audit_type: str = "security",
+        multiple_files: bool = False,
     ) -> str:
         """Analyse code in depth using GPT"""
         if code is None or code == "":
             return ""
+        return self.call(
+            message=self.in_depth_messages(code, language, audit_type, multiple_files)
+        )
+
+    async def ain_depth_analysis(
+        self,
+        code: str,
+        language: str = "python",
+        audit_type: str = "security",
+        multiple_files: bool = False,
+    ) -> str:
+        """Analyse code in depth using GPT without blocking the event loop"""
+        if code is None or code == "":
+            return ""
+        return await self.acall(
+            message=self.in_depth_messages(code, language, audit_type, multiple_files)
+        )
+
+    def in_depth_messages(
+        self,
+        code: str,
+        language: str = "python",
+        audit_type: str = "security",
+        multiple_files: bool = False,
+    ) -> List[dict]:
+        """Build the prompt used for the in depth analysis of a piece of code
+
+        With `multiple_files` the code packs several files, each one preceded by a header line.
+        """
         if audit_type == "security":
             message = [
                 {
@@ -106,10 +138,16 @@ class ChatGPTApi:
                     ),
                 },
             ]
+        if multiple_files:
+            message[0]["content"] += (
+                "The code contains several files, each one starts with a line '### File: <path>', "
+                "line numbers continue from one file to the next, "
+                "add to each issue a key path, which is the path of the file where the issue occurs"
+            )
         message.append(
             {
                 "role": "user",
                 "content": code,
             },
         )
-        return self.call(message=message)
+        return message
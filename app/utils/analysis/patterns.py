@@ -0,0 +1,264 @@
+"""
+Local scanner for secrets and dangerous code patterns, run over every file during the scan.
+
+Hardcoded keys, eval, shell injection or disabled TLS verification don't need GPT to be found.
+Each rule has a regex and the literal keywords it can't match without. A file is lowercased once
+and searched for the keywords, and rules only run their regex on the lines holding one of their
+keywords, so a file costs a few substring searches plus the regexes of a handful of lines.
+Substring searches are several times faster than one regex alternating every keyword, Python's
+re tries the alternatives one by one at every position. Rules match within a line.
+
+Findings have the shape of the issues of the in depth analysis (lineNumber, initialCode, comment,
+suggestion) plus the id of the rule. Every secret of a line is masked in the initialCode of all its
+findings, whichever rule they come from.
+Files with findings are ranked first when selecting sensitive files (see ranking.py).
+"""
+
+import logging
+import re
+from bisect import bisect_right
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from .scanner import CHUNKS_PER_WORKER, INLINE_SCAN_THRESHOLD, chunked
+
+logger = logging.getLogger(__name__)
+
+# Bigger files are not scanned, they are rarely hand written
+PATTERN_MAX_FILE_BYTES = 1024 * 1024
+# Findings kept per file, a generated file can match thousands of times
+PATTERN_MAX_FINDINGS = 20
+MAX_CODE_LENGTH = 200
+SAMPLE_SIZE = 8192
+# Values of secret-looking assignments which are obviously not secrets
+PLACEHOLDER_VALUES = {
+    b"password", b"changeme", b"change_me", b"secret", b"example", b"your_password",
+    b"your-secret", b"none", b"null", b"undefined", b"required", b"test", b"dummy",
+}
+
+
+@dataclass(frozen=True)
+class PatternRule:
+    id: str
+    regex: "re.Pattern[bytes]"
+    # At least one of them is in every match
+    keywords: Tuple[bytes, ...]
+    comment: str
+    suggestion: str
+    # The value of the `secret` group is masked in the reported code
+    secret: bool = False
+
+
+def pattern_rule(
+    id: str, pattern: bytes, keywords: Tuple[bytes, ...], comment: str, suggestion: str, secret: bool = False
+) -> PatternRule:
+    return PatternRule(
+        id, re.compile(pattern), tuple(dict.fromkeys(keyword.lower() for keyword in keywords)), comment, suggestion, secret
+    )
+
+
+SECRET_SUGGESTION = (
+    "Revoke this credential, remove it from the code and its git history, "
+    "and load it from an environment variable or a secret manager"
+)
+
+PATTERN_RULES: List[PatternRule] = [
+    # Secrets
+    pattern_rule("aws-access-key", rb"\b(?P<secret>(?:AKIA|ASIA)[0-9A-Z]{16})\b", (b"AKIA", b"ASIA"),
+         "Hardcoded AWS access key", SECRET_SUGGESTION, secret=True),
+    pattern_rule("github-token", rb"\b(?P<secret>gh[pousr]_[A-Za-z0-9]{36,}|github_pat_[A-Za-z0-9_]{22,})",
+         (b"ghp_", b"gho_", b"ghu_", b"ghs_", b"ghr_", b"github_pat_"),
+         "Hardcoded GitHub token", SECRET_SUGGESTION, secret=True),
+    pattern_rule("slack-token", rb"\b(?P<secret>xox[abprs]-[A-Za-z0-9-]{10,})", (b"xox",),
+         "Hardcoded Slack token", SECRET_SUGGESTION, secret=True),
+    pattern_rule("openai-key", rb"\b(?P<secret>sk-(?:proj-)?[A-Za-z0-9_-]{32,})", (b"sk-",),
+         "Hardcoded OpenAI API key", SECRET_SUGGESTION, secret=True),
+    pattern_rule("stripe-key", rb"\b(?P<secret>(?:sk|rk)_live_[0-9A-Za-z]{16,})", (b"_live_",),
+         "Hardcoded Stripe live key", SECRET_SUGGESTION, secret=True),
+    pattern_rule("google-api-key", rb"\b(?P<secret>AIza[0-9A-Za-z_-]{35})", (b"AIza",),
+         "Hardcoded Google API key", SECRET_SUGGESTION, secret=True),
+    pattern_rule("private-key", rb"-----BEGIN (?:[A-Z]+ )?PRIVATE KEY-----", (b"PRIVATE KEY-----",),
+         "Private key committed to the repository", SECRET_SUGGESTION),
+    pattern_rule("hardcoded-password",
+         rb"(?i)(?:password|passwd|secret|api_?key|access_?token|auth_?token)\w*"
+         rb"[\"']?\s*[:=]\s*[\"'](?P<secret>[^\"'\s$<{%]{8,})[\"']",
+         (b"password", b"passwd", b"secret", b"api_key", b"apikey", b"access_token", b"accesstoken",
+          b"auth_token", b"authtoken"),
+         "Hardcoded credential", SECRET_SUGGESTION, secret=True),
+    # Code execution
+    pattern_rule("eval", rb"(?<![\w.$])eval\s*\(", (b"eval",),
+         "eval executes arbitrary code, an attacker controlling its input controls the application",
+         "Parse the data with a dedicated parser (json, ast.literal_eval...) instead of evaluating it"),
+    pattern_rule("python-exec", rb"(?<![\w.$])exec\s*\((?!\s*\))", (b"exec",),
+         "exec runs arbitrary code, an attacker controlling its input controls the application",
+         "Remove the dynamic execution or restrict it to a fixed set of operations"),
+    pattern_rule("shell-true", rb"\bshell\s*=\s*True\b", (b"shell",),
+         "Command run through a shell, arguments built from user input allow command injection",
+         "Pass the command as a list of arguments without shell=True"),
+    pattern_rule("os-system", rb"\bos\.(?:system|popen)\s*\(", (b"os.system", b"os.popen"),
+         "Command run through a shell, arguments built from user input allow command injection",
+         "Use subprocess.run with a list of arguments"),
+    pattern_rule("node-exec", rb"\b(?:child_process\.)?exec(?:Sync)?\s*\(\s*(?:`[^`]*\$\{|[^,)]*\+)", (b"exec",),
+         "Shell command built from a string, variables in it allow command injection",
+         "Use execFile or spawn with an array of arguments"),
+    pattern_rule("php-exec", rb"\b(?:shell_exec|passthru|system|proc_open|popen)\s*\(\s*\$",
+         (b"shell_exec", b"passthru", b"system", b"proc_open", b"popen"),
+         "Shell command built from a variable, user input in it allows command injection",
+         "Escape arguments with escapeshellarg or avoid calling a shell"),
+    # Deserialization
+    pattern_rule("pickle", rb"\b(?:c?[Pp]ickle|dill|joblib)\.loads?\s*\(", (b"ickle.load", b"dill.load", b"joblib.load"),
+         "Unpickling untrusted data executes arbitrary code",
+         "Only unpickle trusted data, use json for data coming from users"),
+    pattern_rule("yaml-load", rb"\byaml\.load\s*\((?![^)\n]*Loader\s*=\s*(?:yaml\.)?(?:Safe|CSafe|Base)Loader)", (b"yaml.load",),
+         "yaml.load without a safe loader can build arbitrary Python objects",
+         "Use yaml.safe_load"),
+    # TLS
+    pattern_rule("tls-verify-disabled",
+         rb"\bverify\s*=\s*False\b|rejectUnauthorized\s*:\s*false|InsecureSkipVerify\s*:\s*true"
+         rb"|NODE_TLS_REJECT_UNAUTHORIZED\s*=\s*[\"']?0|CURLOPT_SSL_VERIFYPEER\s*,\s*(?:false|0)"
+         rb"|ssl\._create_unverified_context|check_hostname\s*=\s*False",
+         (b"verify", b"rejectUnauthorized", b"InsecureSkipVerify", b"NODE_TLS_REJECT_UNAUTHORIZED",
+          b"CURLOPT_SSL_VERIFYPEER", b"_create_unverified_context", b"check_hostname"),
+         "TLS certificate verification is disabled, connections can be intercepted",
+         "Keep certificate verification enabled, configure the CA bundle if a private CA is used"),
+    # Injection
+    pattern_rule("sql-formatting", rb"\.execute\s*\(\s*(?:f[\"']|[\"'][^\"'\n]*[\"']\s*(?:%|\+|\.format\b))", (b"execute",),
+         "SQL query built with string formatting, user input in it allows SQL injection",
+         "Pass values as query parameters"),
+    pattern_rule("inner-html", rb"\.innerHTML\s*=(?!=)|\bdangerouslySetInnerHTML\b|\bdocument\.write\s*\(",
+         (b"innerHTML", b"dangerouslySetInnerHTML", b"document.write"),
+         "HTML inserted without escaping, user input in it allows cross-site scripting",
+         "Use textContent or sanitize the HTML"),
+    # Memory safety
+    pattern_rule("unsafe-c-function", rb"\b(?:gets|strcpy|strcat|sprintf)\s*\(", (b"gets", b"strcpy", b"strcat", b"sprintf"),
+         "Function without bounds checking, it can overflow its destination buffer",
+         "Use fgets, strncpy/strlcpy, strncat/strlcat or snprintf"),
+    # Configuration
+    pattern_rule("debug-enabled", rb"(?m)^\s*DEBUG\s*=\s*True\b|\.run\([^)\n]*\bdebug\s*=\s*True", (b"debug",),
+         "Debug mode exposes stack traces and sometimes an interactive console",
+         "Disable debug mode in production, read it from the environment"),
+    pattern_rule("weak-hash", rb"\bhashlib\.(?:md5|sha1)\s*\(|\bcreateHash\s*\(\s*[\"'](?:md5|sha1)[\"']",
+         (b"hashlib.md5", b"hashlib.sha1", b"createHash"),
+         "MD5 and SHA-1 are broken, they must not protect passwords or signatures",
+         "Use SHA-256 for integrity and bcrypt, scrypt or argon2 for passwords"),
+]
+
+
+def mask_secret(code: bytes, secret: bytes) -> bytes:
+    return code.replace(secret, secret[:4] + b"*" * min(len(secret) - 4, 16))
+
+
+def is_placeholder(value: bytes) -> bool:
+    return value.lower() in PLACEHOLDER_VALUES or len(set(value.lower())) <= 2
+
+
+def keyword_lines(content: bytes, lowered: bytes, keyword: bytes) -> List[Tuple[int, int]]:
+    """Start and end offsets of the lines of `content` holding `keyword`"""
+    lines = []
+    position = lowered.find(keyword)
+    while position != -1:
+        line_start = content.rfind(b"\n", 0, position) + 1
+        line_end = content.find(b"\n", position)
+        if line_end == -1:
+            line_end = len(content)
+        lines.append((line_start, line_end))
+        position = lowered.find(keyword, line_end)
+    return lines
+
+
+def scan_content(content: bytes) -> List[dict]:
+    """Issues found in the content of a file, binary files have none"""
+    if b"\0" in content[:SAMPLE_SIZE]:
+        return []
+    lowered = content.lower()
+    lines_by_keyword: Dict[bytes, List[Tuple[int, int]]] = {}
+    newlines: Optional[List[int]] = None
+    # Rule, line number and offsets of the line of every finding
+    findings: List[Tuple[PatternRule, int, int, int]] = []
+    # Code of the lines holding secrets with every secret of the line masked, secret rules come
+    # first so the findings of every rule on these lines report the masked code
+    masked_lines: Dict[int, bytes] = {}
+    for rule in PATTERN_RULES:
+        lines = set()
+        for keyword in rule.keywords:
+            if keyword not in lines_by_keyword:
+                lines_by_keyword[keyword] = keyword_lines(content, lowered, keyword)
+            lines.update(lines_by_keyword[keyword])
+        if not lines:
+            continue
+        if newlines is None:
+            newlines = [match.start() for match in re.finditer(b"\n", content)]
+        for line_start, line_end in sorted(lines):
+            # The same line is reported once per rule
+            match = rule.regex.search(content, line_start, line_end)
+            if match is None:
+                continue
+            line_number = bisect_right(newlines, line_start - 1) + 1
+            if rule.secret:
+                secrets = [
+                    secret_match.group("secret")
+                    for secret_match in rule.regex.finditer(content, line_start, line_end)
+                    if not is_placeholder(secret_match.group("secret"))
+                ]
+                if not secrets:
+                    continue
+                # Secrets of a line are reported once, a more generic rule only masks its own
+                reported = line_number in masked_lines
+                code = masked_lines.get(line_number, content[line_start:line_end].strip())
+                for secret in secrets:
+                    code = mask_secret(code, secret)
+                masked_lines[line_number] = code
+                if reported:
+                    continue
+            findings.append((rule, line_number, line_start, line_end))
+            if len(findings) >= PATTERN_MAX_FINDINGS:
+                break
+        if len(findings) >= PATTERN_MAX_FINDINGS:
+            break
+    issues = []
+    for rule, line_number, line_start, line_end in findings:
+        code = masked_lines.get(line_number, content[line_start:line_end].strip())
+        issues.append(
+            {
+                "lineNumber": line_number,
+                "initialCode": code[:MAX_CODE_LENGTH].decode(errors="replace"),
+                "comment": rule.comment,
+                "suggestion": rule.suggestion,
+                "rule": rule.id,
+            }
+        )
+    issues.sort(key=lambda issue: issue["lineNumber"])
+    return issues
+
+
+def scan_file(path: str) -> List[dict]:
+    try:
+        with open(path, "rb") as file:
+            content = file.read(PATTERN_MAX_FILE_BYTES + 1)
+    except OSError as error:
+        logger.error(f"Error reading {path}: {error}")
+        return []
+    if len(content) > PATTERN_MAX_FILE_BYTES:
+        return []
+    return scan_content(content)
+
+
+def scan_files_chunk(paths: List[str]) -> List[List[dict]]:
+    """Scan a chunk of files, runs in the CPU pool workers"""
+    return [scan_file(path) for path in paths]
+
+
+def collect_findings(paths: List[str], issues_by_file: List[List[dict]]) -> Dict[str, List[dict]]:
+    """Issues of the files which have some, keyed by path"""
+    return {path: issues for path, issues in zip(paths, issues_by_file) if issues}
+
+
+def scan_files_patterns(paths: List[str], pool: Optional[Executor] = None, workers: int = 1) -> List[List[dict]]:
+    """Issues of every file, on `pool` when the repository is big enough"""
+    if pool is None or len(paths) < INLINE_SCAN_THRESHOLD:
+        return scan_files_chunk(paths)
+    issues_by_file = []
+    for chunk_issues in pool.map(scan_files_chunk, chunked(paths, workers * CHUNKS_PER_WORKER)):
+        issues_by_file.extend(chunk_issues)
+    return issues_by_file
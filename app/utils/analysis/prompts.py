@@ -0,0 +1,235 @@
+"""
+Planner turning the files to review into in depth analysis requests sized for the model.
+
+- Files bigger than MAX_CHUNK_TOKENS are split into overlapping line ranges, every line keeps its
+  original number so the issues GPT returns point at the right line.
+- Small files of the same language are packed into one request until PACK_TARGET_TOKENS, each
+  file starts with a `### File: <path>` header and lines are numbered across the whole request,
+  so a returned lineNumber identifies both the file and the line.
+
+Tokens are estimated from the number of characters, which is close enough to size requests.
+"""
+
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# gpt-3.5-turbo-0125 has a 16k context, keep room for the system prompt and the answer
+MAX_CHUNK_TOKENS: int = int(os.getenv("MAX_CHUNK_TOKENS", 8000))
+PACK_TARGET_TOKENS: int = int(os.getenv("PACK_TARGET_TOKENS", 3000))
+CHUNK_OVERLAP_LINES: int = int(os.getenv("CHUNK_OVERLAP_LINES", 20))
+CHARS_PER_TOKEN = 4
+
+FILE_HEADER = "### File: {path}\n"
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+@dataclass
+class FileCode:
+    path: str
+    language: str
+    # Lines of the file, with their line endings
+    lines: List[str]
+
+    @property
+    def tokens(self) -> int:
+        return sum(estimate_tokens(line) + 1 for line in self.lines)
+
+
+@dataclass
+class Segment:
+    path: str
+    # Original number of the first line
+    start: int
+    lines: List[str]
+    # Number of the first line in the request
+    prompt_start: int = 0
+
+    def contains(self, prompt_line: int) -> bool:
+        return self.prompt_start <= prompt_line < self.prompt_start + len(self.lines)
+
+
+@dataclass
+class PromptRequest:
+    language: str
+    segments: List[Segment] = field(default_factory=list)
+
+    @property
+    def multiple_files(self) -> bool:
+        return len(self.segments) > 1
+
+    @property
+    def paths(self) -> List[str]:
+        return list(dict.fromkeys(segment.path for segment in self.segments))
+
+    @property
+    def code(self) -> str:
+        """Numbered code sent to GPT"""
+        parts = []
+        for segment in self.segments:
+            if self.multiple_files:
+                parts.append(FILE_HEADER.format(path=segment.path))
+            parts.extend(
+                f"{number}. {line}"
+                for number, line in enumerate(segment.lines, segment.prompt_start)
+            )
+            # The last line of a file may have no line ending, the next header starts its own line
+            if parts and not parts[-1].endswith("\n"):
+                parts.append("\n")
+        return "".join(parts)
+
+    def locate(self, issue: dict) -> Tuple[str, Optional[int]]:
+        """File and original line of an issue returned by GPT"""
+        prompt_line = parse_line_number(issue.get("lineNumber"))
+        if prompt_line is not None:
+            for segment in self.segments:
+                if segment.contains(prompt_line):
+                    return segment.path, segment.start + prompt_line - segment.prompt_start
+        # GPT returned a line outside of the request, fall back on the path it may have given
+        path = issue.get("path")
+        if path in self.paths:
+            return str(path), prompt_line
+        return self.segments[0].path, prompt_line
+
+
+def parse_line_number(line_number) -> Optional[int]:
+    """GPT returns numbers, strings like "12" or ranges like "12-15" """
+    if isinstance(line_number, int):
+        return line_number
+    match = re.match(r"\s*(\d+)", str(line_number))
+    return int(match.group(1)) if match else None
+
+
+def chunk_file(file_code: FileCode, max_tokens: int, overlap: int) -> List[Segment]:
+    """Split a file into overlapping line ranges of at most `max_tokens`"""
+    segments = []
+    start = 0
+    while start < len(file_code.lines):
+        end = start
+        tokens = 0
+        while end < len(file_code.lines):
+            line_tokens = estimate_tokens(file_code.lines[end]) + 1
+            if tokens + line_tokens > max_tokens and end > start:
+                break
+            tokens += line_tokens
+            end += 1
+        segments.append(
+            Segment(path=file_code.path, start=start + 1, lines=file_code.lines[start:end])
+        )
+        if end >= len(file_code.lines):
+            break
+        start = max(end - overlap, start + 1)
+    return segments
+
+
+def plan_prompts(
+    files: List[FileCode],
+    max_chunk_tokens: int = MAX_CHUNK_TOKENS,
+    pack_target_tokens: int = PACK_TARGET_TOKENS,
+    overlap: int = CHUNK_OVERLAP_LINES,
+) -> List[PromptRequest]:
+    """Group files into as few requests as possible without exceeding the token budgets"""
+    requests: List[PromptRequest] = []
+    packs: Dict[str, Tuple[PromptRequest, int]] = {}
+    for file_code in files:
+        if not file_code.lines:
+            continue
+        tokens = file_code.tokens
+        if tokens > max_chunk_tokens:
+            for segment in chunk_file(file_code, max_chunk_tokens, overlap):
+                requests.append(PromptRequest(language=file_code.language, segments=[segment]))
+            continue
+        request, pack_tokens = packs.get(file_code.language, (None, 0))
+        if request is None or pack_tokens + tokens > pack_target_tokens:
+            request, pack_tokens = PromptRequest(language=file_code.language), 0
+            requests.append(request)
+        request.segments.append(Segment(path=file_code.path, start=1, lines=file_code.lines))
+        packs[file_code.language] = (request, pack_tokens + tokens)
+    for request in requests:
+        number_segments(request)
+    logger.debug(f"Planned {len(requests)} requests for {len(files)} files")
+    return requests
+
+
+def number_segments(request: PromptRequest) -> None:
+    """A lone segment keeps its original numbers, packed files are numbered one after the other"""
+    if not request.multiple_files:
+        request.segments[0].prompt_start = request.segments[0].start
+        return
+    prompt_start = 1
+    for segment in request.segments:
+        segment.prompt_start = prompt_start
+        prompt_start += len(segment.lines)
+
+
+class PlanTracker:
+    """Collect issues of planned requests and tell when each file is complete
+
+    A packed request which fails is planned again file by file, a file whose own request fails
+    is reported as incomplete instead of being dropped.
+    """
+
+    def __init__(self, requests: List[PromptRequest]) -> None:
+        self.remaining: Dict[str, int] = {}
+        self.issues: Dict[str, List[dict]] = {}
+        self.failed: Dict[str, bool] = {}
+        for request in requests:
+            self._track(request)
+
+    def _track(self, request: PromptRequest) -> None:
+        for path in request.paths:
+            self.remaining[path] = self.remaining.get(path, 0) + 1
+            self.issues.setdefault(path, [])
+            self.failed.setdefault(path, False)
+
+    def record(
+        self, request: PromptRequest, issues: Optional[List[dict]]
+    ) -> Tuple[List[PromptRequest], List[dict]]:
+        """Record the issues of a request, None if it failed
+
+        returns the requests to send again and the results of the files now complete
+        """
+        retries: List[PromptRequest] = []
+        if issues is None and request.multiple_files:
+            for segment in request.segments:
+                retry = PromptRequest(
+                    language=request.language,
+                    segments=[Segment(path=segment.path, start=segment.start, lines=segment.lines)],
+                )
+                number_segments(retry)
+                self._track(retry)
+                retries.append(retry)
+        elif issues is None:
+            for path in request.paths:
+                self.failed[path] = True
+        else:
+            for issue in issues:
+                path, line_number = request.locate(issue)
+                if line_number is not None:
+                    issue["lineNumber"] = line_number
+                issue.pop("path", None)
+                self.issues.setdefault(path, []).append(issue)
+        completed = []
+        for path in request.paths:
+            self.remaining[path] -= 1
+            if self.remaining[path] == 0:
+                completed.append(self.result(path))
+        return retries, completed
+
+    def result(self, path: str) -> dict:
+        # Overlapping chunks may report the same issue twice
+        unique_issues = {
+            (str(issue.get("lineNumber")), str(issue.get("initialCode"))): issue
+            for issue in self.issues[path]
+        }
+        result = {"issues": list(unique_issues.values()), "path": path}
+        if self.failed[path]:
+            result["incomplete"] = True
+        return result
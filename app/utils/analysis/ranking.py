@@ -0,0 +1,237 @@
+"""
+Local ranking of the files to send to the sensitive files prompt.
+
+Every candidate of the scan gets a score from:
+- its path: words like auth, password or api raise it, tests, docs, examples or vendored code
+  lower it
+- its size: tiny files hold little logic, very large ones are usually generated
+- the dangerous APIs (command execution, eval, deserialization, SQL, cryptography...) named in its
+  first RANK_CONTENT_BYTES. Only the RANK_CONTENT_FILES best files by path and size are read, so
+  the cost stays bounded on large repositories
+- the findings of the local pattern scanner (see patterns.py), a file with a hardcoded secret or
+  a shell=True is worth showing to GPT whatever its path
+
+Only the SENSITIVE_TOP_K best files are sent to GPT, split into batches of at most
+SENSITIVE_BATCH_TOKENS tokens, so the prompt size does not depend on the size of the repository.
+"""
+
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional
+
+from .prompts import estimate_tokens
+from .sources import FileSource
+
+logger = logging.getLogger(__name__)
+
+SENSITIVE_TOP_K: int = int(os.getenv("SENSITIVE_TOP_K", 400))
+SENSITIVE_BATCH_TOKENS: int = int(os.getenv("SENSITIVE_BATCH_TOKENS", 4000))
+RANK_CONTENT_FILES: int = int(os.getenv("RANK_CONTENT_FILES", 2000))
+RANK_CONTENT_BYTES: int = int(os.getenv("RANK_CONTENT_BYTES", 16 * 1024))
+# Files bigger than this are not read, they are ranked on their path and size only
+RANK_MAX_FILE_BYTES = 1024 * 1024
+
+# Weight of the words found in a path, a word matches path words starting with it (auth -> authentication)
+PATH_WORD_WEIGHTS: Dict[str, float] = {
+    **dict.fromkeys(
+        ["auth", "login", "password", "passwd", "secret", "token", "credential", "crypt",
+         "security", "permission", "session", "oauth", "jwt", "admin", "payment", "billing"],
+        3.0,
+    ),
+    **dict.fromkeys(
+        ["api", "route", "router", "controller", "handler", "view", "middleware", "server",
+         "upload", "download", "db", "database", "sql", "query", "model", "user", "account",
+         "config", "setting", "webhook", "request"],
+        2.0,
+    ),
+    **dict.fromkeys(["main", "app", "index", "service", "manage", "cli"], 1.0),
+}
+# Longest keywords first so "router" is matched rather than "route"
+PATH_WORD_PATTERN = re.compile("|".join(sorted(PATH_WORD_WEIGHTS, key=len, reverse=True)))
+# Path words of code which is not part of the application
+EXCLUDED_PATH_WORDS = {
+    "test", "tests", "testing", "spec", "specs", "mock", "mocks", "fixture", "fixtures",
+    "example", "examples", "sample", "samples", "demo", "docs", "doc", "migration",
+    "migrations", "vendor", "node", "modules", "third", "party", "dist", "build",
+    "generated", "stories", "benchmark", "benchmarks",
+}
+EXCLUDED_PATH_WEIGHT = -4.0
+GENERATED_SUFFIXES = (".min.js", ".min.css", ".d.ts", ".pb.go", "_pb2.py", ".generated.cs")
+
+# Dangerous APIs, each category found in a file adds its weight once
+DANGEROUS_API_WEIGHTS: Dict[str, float] = {
+    "command": 3.0,
+    "evaluation": 3.0,
+    "deserialization": 3.0,
+    "sql": 2.0,
+    "crypto": 2.0,
+    "filesystem": 1.0,
+    "network": 1.0,
+    "html": 1.0,
+    "memory": 2.0,
+}
+# Identifiers revealing each category, dotted names are matched as written in the code
+DANGEROUS_API_IDENTIFIERS: Dict[str, FrozenSet[str]] = {
+    category: frozenset(identifiers)
+    for category, identifiers in {
+        "command": ["subprocess", "os.system", "os.popen", "os.execv", "os.execvp", "os.spawnl",
+                    "child_process", "execSync", "spawnSync", "ProcessBuilder", "shell_exec",
+                    "passthru", "exec.Command", "Runtime.getRuntime"],
+        "evaluation": ["eval", "exec", "__import__", "vm.runInContext", "vm.runInNewContext"],
+        "deserialization": ["pickle", "marshal", "yaml.load", "yaml.unsafe_load", "unserialize",
+                            "ObjectInputStream", "BinaryFormatter"],
+        "sql": ["SELECT", "cursor", "execute", "executemany", "sqlite3", "psycopg", "psycopg2",
+                "mysql", "knex", "sequelize"],
+        "crypto": ["hashlib", "md5", "sha1", "crypto", "bcrypt", "jwt", "Cipher", "random.random",
+                   "random.randint", "Math.random"],
+        "filesystem": ["open", "shutil", "fs.readFile", "fs.writeFile", "readFileSync",
+                       "writeFileSync", "os.remove", "os.unlink", "os.chmod"],
+        "network": ["requests", "urllib", "http.client", "fetch", "axios", "socket"],
+        "html": ["innerHTML", "dangerouslySetInnerHTML", "document.write", "mark_safe"],
+        "memory": ["strcpy", "strcat", "sprintf", "gets", "memcpy", "unsafe"],
+    }.items()
+}
+# Added once to files with findings of the pattern scanner
+PATTERN_FINDINGS_WEIGHT = 5.0
+# Identifiers and dotted names, like os.system
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][\w.]*")
+
+
+@dataclass
+class RankedFile:
+    file: dict
+    score: float = 0.0
+    # Dangerous API categories found in the file
+    categories: List[str] = field(default_factory=list)
+
+
+def path_words(path: str) -> List[str]:
+    """Lower case words of a path, camelCase and snake_case are split"""
+    return [
+        word.lower()
+        for word in re.findall(r"[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])", path)
+    ]
+
+
+def path_score(path: str) -> float:
+    if path.lower().endswith(GENERATED_SUFFIXES):
+        return EXCLUDED_PATH_WEIGHT
+    score = 0.0
+    matched = set()
+    for word in path_words(path):
+        if word in EXCLUDED_PATH_WORDS or word.startswith("test"):
+            return EXCLUDED_PATH_WEIGHT
+        match = PATH_WORD_PATTERN.match(word)
+        if match is not None and match.group() not in matched:
+            matched.add(match.group())
+            score += PATH_WORD_WEIGHTS[match.group()]
+    return score
+
+
+def size_score(line_count: Optional[int]) -> float:
+    if line_count is None:
+        return 0.0
+    if line_count < 5:
+        return -2.0
+    if line_count > 5000:
+        return -1.0
+    # 10 lines -> 1, 100 lines -> 2, capped at 2.5
+    return min(2.5, math.log10(line_count))
+
+
+def dangerous_api_categories(content: bytes) -> List[str]:
+    """Categories of the dangerous APIs used in `content`
+
+    Identifiers are compared with sets rather than matched with one regex per API, reading a file
+    costs about as much as tokenizing it.
+    """
+    identifiers = set()
+    for identifier in IDENTIFIER_PATTERN.findall(content.decode(errors="replace")):
+        identifiers.add(identifier)
+        if "." in identifier:
+            # subprocess.run -> subprocess, foo.os.system is not os.system but is close enough
+            parts = identifier.split(".")
+            identifiers.update(parts)
+            identifiers.update(".".join(parts[i : i + 2]) for i in range(len(parts) - 1))
+    return [
+        category
+        for category, category_identifiers in DANGEROUS_API_IDENTIFIERS.items()
+        if not identifiers.isdisjoint(category_identifiers)
+    ]
+
+
+def rank_files(
+    list_files: List[dict],
+    source: Optional[FileSource] = None,
+    line_counts: Optional[Dict[str, int]] = None,
+    content_files: int = RANK_CONTENT_FILES,
+    pattern_findings: Optional[Dict[str, List[dict]]] = None,
+) -> List[RankedFile]:
+    """Candidates of the scan, most likely to be sensitive first"""
+    line_counts = line_counts or {}
+    pattern_findings = pattern_findings or {}
+    root = source.root.rstrip("/") + "/" if source is not None else ""
+    ranked = []
+    for file in list_files:
+        path = str(file.get("path"))
+        relative_path = path[len(root):] if root and path.startswith(root) else path
+        ranked.append(
+            RankedFile(
+                file=file,
+                score=path_score(relative_path)
+                + size_score(line_counts.get(path))
+                + (PATTERN_FINDINGS_WEIGHT if pattern_findings.get(path) else 0.0),
+            )
+        )
+    ranked.sort(key=lambda entry: -entry.score)
+    if source is not None:
+        for entry in ranked[:content_files]:
+            path = str(entry.file.get("path"))
+            try:
+                if source.size(path) > RANK_MAX_FILE_BYTES:
+                    continue
+                entry.categories = dangerous_api_categories(source.read_head(path, RANK_CONTENT_BYTES))
+            except Exception as error:
+                logger.debug(f"Could not read {path} to rank it : {error}")
+                continue
+            entry.score += sum(DANGEROUS_API_WEIGHTS[category] for category in entry.categories)
+        ranked.sort(key=lambda entry: -entry.score)
+    return ranked
+
+
+def batch_files(files: List[dict], max_tokens: int = SENSITIVE_BATCH_TOKENS) -> List[List[dict]]:
+    """Split files into batches whose prompt stays under `max_tokens`, in order"""
+    batches: List[List[dict]] = []
+    batch: List[dict] = []
+    tokens = 0
+    for file in files:
+        file_tokens = estimate_tokens(str(file))
+        if batch and tokens + file_tokens > max_tokens:
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(file)
+        tokens += file_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def select_candidates(
+    list_files: List[dict],
+    source: Optional[FileSource] = None,
+    line_counts: Optional[Dict[str, int]] = None,
+    top_k: int = SENSITIVE_TOP_K,
+    max_tokens: int = SENSITIVE_BATCH_TOKENS,
+    pattern_findings: Optional[Dict[str, List[dict]]] = None,
+) -> List[List[dict]]:
+    """Batches of the `top_k` best ranked files, to send to the sensitive files prompt"""
+    ranked = rank_files(list_files, source, line_counts, pattern_findings=pattern_findings)
+    selected = [entry.file for entry in ranked[:top_k]]
+    batches = batch_files(selected, max_tokens)
+    logger.debug(
+        f"Ranked {len(ranked)} candidates, sending {len(selected)} in {len(batches)} batches"
+    )
+    return batches
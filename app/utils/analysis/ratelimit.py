@@ -0,0 +1,277 @@
+"""
+Process-wide scheduler in front of the OpenAI API.
+
+Every GPT call of the process goes through the same scheduler:
+- two token buckets enforce the requests per minute and tokens per minute limits of the account,
+  each request reserves its estimated token cost, corrected with the real usage afterwards
+- an adaptive concurrency limit (AIMD) halves on every 429 and grows slowly while latency stays
+  under target, so all sessions together stay at the highest throughput without errors
+- rate limited and transient errors are retried with exponential backoff and full jitter,
+  honouring the Retry-After header when there is one
+
+The limits are those of the account. Processes sharing it, like the analysis workers, each take
+an equal share of them with `split_budget` (see workers.py).
+
+Point OPENAI_BASE_URL at a local fake server returning 429s to exercise it.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+OPENAI_RPM: float = float(os.getenv("OPENAI_RPM", 3500))
+OPENAI_TPM: float = float(os.getenv("OPENAI_TPM", 160_000))
+OPENAI_MAX_RETRIES: int = int(os.getenv("OPENAI_MAX_RETRIES", 6))
+OPENAI_MIN_CONCURRENCY: int = int(os.getenv("OPENAI_MIN_CONCURRENCY", 1))
+OPENAI_MAX_CONCURRENCY: int = int(os.getenv("OPENAI_MAX_CONCURRENCY", 64))
+OPENAI_TARGET_LATENCY: float = float(os.getenv("OPENAI_TARGET_LATENCY", 30))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+# 429s received within this many seconds of a decrease come from the same burst
+DECREASE_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """Bucket refilled at `rate` per second up to `capacity`, shared by threads and coroutines
+
+    Reservations are taken immediately and may overdraw the bucket, the caller then waits the
+    returned delay. Requests are served in order and never starve.
+    """
+
+    def __init__(self, capacity: float, rate: float) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` from the bucket, returns the number of seconds to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # A request bigger than the bucket would never fit, let it through once the bucket is full
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level / self.rate)
+
+    def give_back(self, amount: float) -> None:
+        """Correct a reservation, negative amounts take more"""
+        with self._lock:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class AdaptiveConcurrency:
+    """Async concurrency limit adjusted from rate limit and latency feedback
+
+    The limit belongs to the event loop using it, one at a time: it is bound to the first loop
+    which enters it, and to a new one once that loop is closed. Feedback coming from other
+    threads is applied in that loop.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, target_latency: float) -> None:
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._condition: Optional[asyncio.Condition] = None
+        # Guards updates made while no loop uses the limit
+        self._lock = threading.Lock()
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            if self._loop is not None and not self._loop.is_closed():
+                raise RuntimeError("Concurrency limit already used by another event loop")
+            self._loop = loop
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def __aenter__(self) -> None:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _call_in_loop(self, callback: Callable[..., None], *args) -> None:
+        """Run `callback` in the loop of the limit, right away when called from it or when no
+        loop uses the limit"""
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                in_loop = asyncio.get_running_loop() is loop
+            except RuntimeError:
+                in_loop = False
+            if in_loop:
+                callback(*args)
+                return
+            try:
+                loop.call_soon_threadsafe(callback, *args)
+                return
+            except RuntimeError:
+                # Closed in the meantime
+                pass
+        with self._lock:
+            callback(*args)
+
+    def on_success(self, latency: float) -> None:
+        self._call_in_loop(self._adjust, latency)
+
+    def on_rate_limited(self) -> None:
+        self._call_in_loop(self._decrease, time.monotonic())
+
+    def _adjust(self, latency: float) -> None:
+        if latency > self.target_latency:
+            self.limit = max(self.minimum, self.limit * 0.9)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def _decrease(self, now: float) -> None:
+        if now - self.decreased_at < DECREASE_INTERVAL:
+            return
+        self.decreased_at = now
+        self.limit = max(self.minimum, self.limit / 2)
+        logger.warning(f"Rate limited by OpenAI, concurrency limit lowered to {int(self.limit)}")
+
+
+def is_rate_limit(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+def is_transient(error: Exception) -> bool:
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code >= 500
+    # Connection errors and timeouts have no status code
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    """Exponential backoff with full jitter, at least the delay the server asked for"""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+    return max(delay, retry_after(error) or 0.0)
+
+
+class RateLimitedScheduler:
+    def __init__(
+        self,
+        rpm: float = OPENAI_RPM,
+        tpm: float = OPENAI_TPM,
+        max_retries: int = OPENAI_MAX_RETRIES,
+        min_concurrency: int = OPENAI_MIN_CONCURRENCY,
+        max_concurrency: int = OPENAI_MAX_CONCURRENCY,
+        target_latency: float = OPENAI_TARGET_LATENCY,
+    ) -> None:
+        # Buckets hold one minute of budget
+        self.requests = TokenBucket(rpm, rpm / 60)
+        self.tokens = TokenBucket(tpm, tpm / 60)
+        self.max_retries = max_retries
+        self.concurrency = AdaptiveConcurrency(
+            initial=max(min_concurrency, max_concurrency // 4),
+            minimum=min_concurrency,
+            maximum=max_concurrency,
+            target_latency=target_latency,
+        )
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+
+    def record_usage(self, estimated_tokens: int, used_tokens: Optional[int]) -> None:
+        """Correct the token bucket with the real cost of a request"""
+        if used_tokens is not None:
+            self.tokens.give_back(estimated_tokens - used_tokens)
+
+    def _should_retry(self, attempt: int, error: Exception) -> bool:
+        return attempt < self.max_retries and (is_rate_limit(error) or is_transient(error))
+
+    async def run(self, call: Callable[[], Awaitable[T]], estimated_tokens: int) -> T:
+        """Await `call()` within the limits, retrying rate limited and transient errors"""
+        attempt = 0
+        while True:
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with self.concurrency:
+                start = time.monotonic()
+                try:
+                    result = await call()
+                except Exception as error:
+                    if not self._should_retry(attempt, error):
+                        raise
+                    if is_rate_limit(error):
+                        self.concurrency.on_rate_limited()
+                    failure = error
+                else:
+                    self.concurrency.on_success(time.monotonic() - start)
+                    return result
+            delay = backoff_delay(attempt, failure)
+            logger.warning(f"OpenAI call failed ({failure}), retry {attempt + 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def run_sync(self, call: Callable[[], T], estimated_tokens: int) -> T:
+        """Blocking version of `run` for calls made from threads, rate limits and retries apply
+        but not the concurrency limit, which belongs to the event loop"""
+        attempt = 0
+        while True:
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                return call()
+            except Exception as error:
+                if not self._should_retry(attempt, error):
+                    raise
+                if is_rate_limit(error):
+                    self.concurrency.on_rate_limited()
+                delay = backoff_delay(attempt, error)
+                logger.warning(f"OpenAI call failed ({error}), retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+
+_scheduler: Optional[RateLimitedScheduler] = None
+
+
+def get_scheduler() -> RateLimitedScheduler:
+    """Scheduler shared by every GPT call of the process"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RateLimitedScheduler()
+    return _scheduler
+
+
+def split_budget(parts: int) -> RateLimitedScheduler:
+    """Give the scheduler of the process 1/parts of the account limits, for `parts` processes
+    sharing the account"""
+    global _scheduler
+    _scheduler = RateLimitedScheduler(rpm=OPENAI_RPM / parts, tpm=OPENAI_TPM / parts)
+    return _scheduler
@@ -0,0 +1,179 @@
+"""
+Store of complete analysis reports, replayed when a repository is submitted again unchanged.
+
+A report is the sequence of messages sent by an analysis, keyed by the normalized repository
+URL, the commit analysed, the audit type and the version of the model. HEAD is resolved with
+`git ls-remote` before anything is cloned, so resubmitting a repository whose HEAD did not move
+replays its report without cloning, scanning or calling GPT.
+Reports expire after REPORT_CACHE_MAX_AGE_HOURS (0 disables the store), least recently used
+reports are evicted once REPORT_CACHE_MAX_ENTRIES or REPORT_CACHE_MAX_BYTES is exceeded.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing, contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+REPORT_CACHE_PATH: str = os.getenv("REPORT_CACHE_PATH", "report_cache.db")
+REPORT_CACHE_MAX_ENTRIES: int = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", 1000))
+REPORT_CACHE_MAX_BYTES: int = int(os.getenv("REPORT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+REPORT_CACHE_MAX_AGE: float = float(os.getenv("REPORT_CACHE_MAX_AGE_HOURS", 24)) * 3600
+
+
+@dataclass
+class Report:
+    commit: str
+    # Keyword arguments of every message sent by the analysis, in order
+    messages: List[dict] = field(default_factory=list)
+    created_at: float = 0.0
+
+
+class ReportRecorder:
+    """Emitter relaying messages to another emitter and keeping them to build a report"""
+
+    def __init__(self, emitter) -> None:
+        self.emitter = emitter
+        self.messages: List[dict] = []
+        self.failed = False
+
+    async def send(self, **message) -> None:
+        if message.get("status") == "error":
+            self.failed = True
+        self.messages.append(message)
+        await self.emitter.send(**message)
+
+    @property
+    def complete(self) -> bool:
+        """Whether the analysis went through without errors, only complete reports are stored"""
+        if self.failed or not self.messages:
+            return False
+        return not any(
+            message.get("type") == "inDepthAnalysis" and (message.get("data") or {}).get("incomplete")
+            for message in self.messages
+        )
+
+
+class ReportStore:
+    """Complete reports stored in SQLite, compressed"""
+
+    def __init__(
+        self,
+        db_path: str = REPORT_CACHE_PATH,
+        *,
+        max_entries: int = REPORT_CACHE_MAX_ENTRIES,
+        max_bytes: int = REPORT_CACHE_MAX_BYTES,
+        max_age: float = REPORT_CACHE_MAX_AGE,
+    ) -> None:
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS reports
+                          (url TEXT,
+                           commit_sha TEXT,
+                           audit_type TEXT,
+                           version TEXT,
+                           messages BLOB,
+                           size INTEGER,
+                           created_at REAL,
+                           accessed_at REAL,
+                           PRIMARY KEY (url, commit_sha, audit_type, version))"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS reports_accessed_at ON reports (accessed_at)"
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age > 0
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Connection committed when the block succeeds, closed in any case"""
+        with closing(sqlite3.connect(self.db_path, timeout=30)) as conn, conn:
+            yield conn
+
+    def load(self, url: str, commit: str, audit_type: str, version: str) -> Optional[Report]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        key = (url, commit, audit_type, version)
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT messages, created_at FROM reports WHERE url = ? AND commit_sha = ? AND audit_type = ? AND version = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                return None
+            messages, created_at = row
+            if now - created_at > self.max_age:
+                conn.execute(
+                    "DELETE FROM reports WHERE url = ? AND commit_sha = ? AND audit_type = ? AND version = ?",
+                    key,
+                )
+                return None
+            conn.execute(
+                "UPDATE reports SET accessed_at = ? WHERE url = ? AND commit_sha = ? AND audit_type = ? AND version = ?",
+                (now, *key),
+            )
+        return Report(
+            commit=commit,
+            messages=json.loads(zlib.decompress(messages)),
+            created_at=created_at,
+        )
+
+    def save(self, url: str, audit_type: str, version: str, report: Report) -> None:
+        if not self.enabled:
+            return
+        now = time.time()
+        messages = zlib.compress(json.dumps(report.messages).encode())
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO reports (url, commit_sha, audit_type, version, messages, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, report.commit, audit_type, version, messages, len(messages), now, now),
+            )
+            self._evict(conn, now)
+        logger.debug(f"Stored report of {url} at {report.commit} ({len(report.messages)} messages, {len(messages)} bytes)")
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM reports WHERE created_at < ?", (now - self.max_age,))
+        count, total_size = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM reports"
+        ).fetchone()
+        if count <= self.max_entries and total_size <= self.max_bytes:
+            return
+        # Walk reports from least recently used and drop them until both bounds are met
+        evicted = 0
+        for rowid, size in conn.execute(
+            "SELECT rowid, size FROM reports ORDER BY accessed_at ASC"
+        ).fetchall():
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM reports WHERE rowid = ?", (rowid,))
+            count -= 1
+            total_size -= size
+            evicted += 1
+        logger.debug(f"Evicted {evicted} reports from report cache")
+
+
+_report_store: Optional[ReportStore] = None
+
+
+def get_report_store() -> ReportStore:
+    """Report store shared by every analysis of the process"""
+    global _report_store
+    if _report_store is None:
+        _report_store = ReportStore()
+    return _report_store
@@ -0,0 +1,124 @@
+"""
+Parallel repository scanner.
+
+The tree is walked once with os.scandir, then line counting is fanned out to the shared CPU
+process pool in chunks of files. Small repositories are counted inline, sending them to other
+processes would cost more than counting them.
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from .exclusions import ExclusionRules
+from .line_counter import count_lines
+
+logger = logging.getLogger(__name__)
+
+# Directories which are never part of the analysed sources
+SKIPPED_DIRECTORIES = {".git"}
+# Below this number of files, lines are counted in the calling process
+INLINE_SCAN_THRESHOLD = int(os.getenv("INLINE_SCAN_THRESHOLD", 512))
+# Number of chunks submitted per worker, more chunks balance uneven file sizes better
+CHUNKS_PER_WORKER = 4
+
+
+@dataclass
+class ScanResult:
+    """Result of the simple repository analysis"""
+
+    number_of_files: int
+    total_line_count: int
+    list_of_programming_languages: List[str]
+    ready_for_analysis: List[dict]
+    # Seconds spent in each stage of the scan
+    timings: Dict[str, float] = field(default_factory=dict)
+    # Number of lines of each file
+    line_counts: Dict[str, int] = field(default_factory=dict)
+    # Files and directories left out of the scan, by reason (see exclusions.py)
+    excluded: dict = field(default_factory=dict)
+    # Secrets and dangerous code patterns of the files which have some (see patterns.py)
+    pattern_findings: Dict[str, List[dict]] = field(default_factory=dict)
+
+    def as_tuple(self) -> Tuple[int, int, List[str], List[dict]]:
+        return (
+            self.number_of_files,
+            self.total_line_count,
+            self.list_of_programming_languages,
+            self.ready_for_analysis,
+        )
+
+
+def walk_files(root: str, rules: Optional[ExclusionRules] = None) -> List[str]:
+    """List every regular file under `root`, symbolic links are not followed
+
+    With `rules`, excluded directories are not entered and the .gitignore files found on the
+    way are added to the rules.
+    """
+    files = []
+    # Directories to list, with their path relative to the root
+    directories = [(str(root), "")]
+    while directories:
+        directory, relative_directory = directories.pop()
+        try:
+            with os.scandir(directory) as iterator:
+                entries = list(iterator)
+        except OSError as error:
+            logger.error(f"Error listing {directory}: {error}")
+            continue
+        if rules is not None:
+            for entry in entries:
+                if entry.name == ".gitignore" and entry.is_file(follow_symlinks=False):
+                    with open(entry.path, errors="replace") as gitignore:
+                        rules.add_gitignore(relative_directory, gitignore.read())
+        for entry in entries:
+            relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in SKIPPED_DIRECTORIES:
+                    continue
+                if rules is not None and rules.excludes(relative_path, is_dir=True):
+                    continue
+                directories.append((entry.path, relative_path))
+            elif entry.is_file(follow_symlinks=False):
+                if rules is not None and rules.excludes(relative_path):
+                    continue
+                files.append(entry.path)
+    return files
+
+
+def count_lines_chunk(paths: List[str]) -> List[int]:
+    """Count lines of a chunk of files, runs in the CPU pool workers"""
+    return [count_lines(path) for path in paths]
+
+
+def chunked(paths: List[str], number_of_chunks: int) -> List[List[str]]:
+    chunk_size = max(1, -(-len(paths) // number_of_chunks))
+    return [paths[i : i + chunk_size] for i in range(0, len(paths), chunk_size)]
+
+
+def count_files_lines(paths: List[str], pool: Optional[Executor] = None, workers: int = 1) -> List[int]:
+    """Count lines of every file, on `pool` when the repository is big enough"""
+    if pool is None or len(paths) < INLINE_SCAN_THRESHOLD:
+        return count_lines_chunk(paths)
+    line_counts = []
+    for chunk_line_counts in pool.map(
+        count_lines_chunk, chunked(paths, workers * CHUNKS_PER_WORKER)
+    ):
+        line_counts.extend(chunk_line_counts)
+    return line_counts
+
+
+class StageTimer:
+    """Record the duration of consecutive stages"""
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.timings[stage] = now - self._start
+        self._start = now
@@ -0,0 +1,235 @@
+"""
+Sources the analysis reads repository files from.
+
+- WorkingTreeSource reads a checked out working tree from disk.
+- GitTreeSource reads the tree of a commit straight from the git object database, so the
+  repository can be cloned without a checkout. Blob sizes and SHAs come from the tree and
+  object headers, contents are streamed from the object database.
+
+Both sources name files `<root>/<path in repository>`, so results look the same whatever the
+backend. Vendored, generated and ignored files are left out while listing (see exclusions.py).
+"""
+
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from typing import Dict, List, Literal, Optional, Tuple, get_args
+
+from git import Repo
+
+from .cache import git_blob_sha
+from .exclusions import SCAN_EXCLUSIONS, ExclusionReport, ExclusionRules
+from .line_counter import count_lines_in_stream
+from .patterns import PATTERN_MAX_FILE_BYTES, scan_content, scan_files_patterns
+from .scanner import CHUNKS_PER_WORKER, INLINE_SCAN_THRESHOLD, chunked, count_files_lines, walk_files
+
+logger = logging.getLogger(__name__)
+
+ScanBackend = Literal["worktree", "gitdb"]
+SCAN_BACKENDS: tuple = get_args(ScanBackend)
+SCAN_BACKEND: str = os.getenv("SCAN_BACKEND", "worktree")
+
+# Mode of symbolic links in git trees, their blob is the link target
+SYMLINK_MODE = 0o120000
+
+
+class FileSource(ABC):
+    def __init__(self, root: str, exclude: bool = SCAN_EXCLUSIONS) -> None:
+        self.root = str(root)
+        self.exclude = exclude
+        # Files left out by the last listing, None when exclusions are disabled
+        self.exclusions: Optional[ExclusionReport] = None
+
+    @abstractmethod
+    def list_files(self) -> List[str]:
+        """Every regular file of the repository"""
+
+    @abstractmethod
+    def read(self, path: str) -> bytes:
+        """Content of a file"""
+
+    def read_head(self, path: str, size: int) -> bytes:
+        """First `size` bytes of a file"""
+        return self.read(path)[:size]
+
+    @abstractmethod
+    def size(self, path: str) -> int:
+        """Size of a file in bytes"""
+
+    def blob_sha(self, path: str) -> str:
+        """Git blob SHA of a file"""
+        return git_blob_sha(self.read(path))
+
+    @abstractmethod
+    def count_lines(self, paths: List[str], pool: Optional[Executor] = None, workers: int = 1) -> List[int]:
+        """Number of lines of each file"""
+
+    @abstractmethod
+    def scan_patterns(self, paths: List[str], pool: Optional[Executor] = None, workers: int = 1) -> List[List[dict]]:
+        """Secrets and dangerous code patterns found in each file (see patterns.py)"""
+
+
+class WorkingTreeSource(FileSource):
+    def list_files(self) -> List[str]:
+        if not self.exclude:
+            return walk_files(self.root)
+        gitattributes = os.path.join(self.root, ".gitattributes")
+        if os.path.isfile(gitattributes):
+            with open(gitattributes, errors="replace") as file:
+                rules = ExclusionRules(file.read())
+        else:
+            rules = ExclusionRules()
+        files = walk_files(self.root, rules)
+        self.exclusions = rules.report
+        return files
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as file:
+            return file.read()
+
+    def read_head(self, path: str, size: int) -> bytes:
+        with open(path, "rb") as file:
+            return file.read(size)
+
+    def size(self, path: str) -> int:
+        return os.path.getsize(path)
+
+    def count_lines(self, paths: List[str], pool: Optional[Executor] = None, workers: int = 1) -> List[int]:
+        return count_files_lines(paths, pool, workers)
+
+    def scan_patterns(self, paths: List[str], pool: Optional[Executor] = None, workers: int = 1) -> List[List[dict]]:
+        return scan_files_patterns(paths, pool, workers)
+
+
+# Repositories opened by each CPU pool worker, keyed by path
+_worker_repos: Dict[str, Repo] = {}
+
+
+def count_blob_lines_chunk(repo_path: str, hexshas: List[str]) -> List[int]:
+    """Count lines of a chunk of blobs, runs in the CPU pool workers"""
+    repo = _worker_repo(repo_path)
+    return [count_lines_in_stream(repo.odb.stream(bytes.fromhex(hexsha))) for hexsha in hexshas]
+
+
+def _worker_repo(repo_path: str) -> Repo:
+    repo = _worker_repos.get(repo_path)
+    if repo is None:
+        repo = _worker_repos[repo_path] = Repo(repo_path)
+    return repo
+
+
+def scan_blob_patterns_chunk(repo_path: str, blobs: List[Tuple[str, int]]) -> List[List[dict]]:
+    """Scan a chunk of blobs for patterns, runs in the CPU pool workers"""
+    repo = _worker_repo(repo_path)
+    return [
+        scan_content(repo.odb.stream(bytes.fromhex(hexsha)).read()) if size <= PATTERN_MAX_FILE_BYTES else []
+        for hexsha, size in blobs
+    ]
+
+
+class GitTreeSource(FileSource):
+    """Files of the tree of `rev`, `root` is a repository which may have no checkout (or be bare)"""
+
+    def __init__(self, root: str, rev: str = "HEAD", exclude: bool = SCAN_EXCLUSIONS) -> None:
+        super().__init__(root, exclude)
+        self.repo = Repo(self.root)
+        self.commit = self.repo.commit(rev)
+        self._blobs: Optional[Dict[str, Tuple[str, int]]] = None
+        # The object database talks to a single `git cat-file` process
+        self._lock = threading.Lock()
+
+    @property
+    def blobs(self) -> Dict[str, Tuple[str, int]]:
+        """SHA and size of each file, read from the tree objects once"""
+        if self._blobs is None:
+            self._blobs = self._walk_tree()
+        return self._blobs
+
+    def _read_text(self, tree, name: str) -> Optional[str]:
+        """Text of the blob `name` of `tree`, None if there is none"""
+        for blob in tree.blobs:
+            if blob.name == name:
+                with self._lock:
+                    return blob.data_stream.read().decode(errors="replace")
+        return None
+
+    def _walk_tree(self) -> Dict[str, Tuple[str, int]]:
+        """Walk the trees of the commit, excluded trees are not read"""
+        rules = None
+        if self.exclude:
+            rules = ExclusionRules(self._read_text(self.commit.tree, ".gitattributes") or "")
+        blobs = {}
+        trees = [self.commit.tree]
+        while trees:
+            tree = trees.pop()
+            if rules is not None:
+                gitignore = self._read_text(tree, ".gitignore")
+                if gitignore is not None:
+                    rules.add_gitignore(tree.path, gitignore)
+            for blob in tree.blobs:
+                if blob.mode == SYMLINK_MODE or (rules is not None and rules.excludes(blob.path)):
+                    continue
+                blobs[os.path.join(self.root, blob.path)] = (blob.hexsha, blob.size)
+            for subtree in tree.trees:
+                if rules is None or not rules.excludes(subtree.path, is_dir=True):
+                    trees.append(subtree)
+        if rules is not None:
+            self.exclusions = rules.report
+        return blobs
+
+    def list_files(self) -> List[str]:
+        return list(self.blobs)
+
+    def read(self, path: str) -> bytes:
+        hexsha, _ = self.blobs[path]
+        with self._lock:
+            return self.repo.odb.stream(bytes.fromhex(hexsha)).read()
+
+    def size(self, path: str) -> int:
+        return self.blobs[path][1]
+
+    def blob_sha(self, path: str) -> str:
+        return self.blobs[path][0]
+
+    def count_lines(self, paths: List[str], pool: Optional[Executor] = None, workers: int = 1) -> List[int]:
+        hexshas = [self.blobs[path][0] for path in paths]
+        if pool is None or len(paths) < INLINE_SCAN_THRESHOLD:
+            with self._lock:
+                return [
+                    count_lines_in_stream(self.repo.odb.stream(bytes.fromhex(hexsha)))
+                    for hexsha in hexshas
+                ]
+        line_counts = []
+        chunks = chunked(hexshas, workers * CHUNKS_PER_WORKER)
+        for chunk_line_counts in pool.map(
+            count_blob_lines_chunk, [self.root] * len(chunks), chunks
+        ):
+            line_counts.extend(chunk_line_counts)
+        return line_counts
+
+    def scan_patterns(self, paths: List[str], pool: Optional[Executor] = None, workers: int = 1) -> List[List[dict]]:
+        blobs = [self.blobs[path] for path in paths]
+        if pool is None or len(paths) < INLINE_SCAN_THRESHOLD:
+            with self._lock:
+                return [
+                    scan_content(self.repo.odb.stream(bytes.fromhex(hexsha)).read())
+                    if size <= PATTERN_MAX_FILE_BYTES
+                    else []
+                    for hexsha, size in blobs
+                ]
+        issues_by_file = []
+        chunks = chunked(blobs, workers * CHUNKS_PER_WORKER)
+        for chunk_issues in pool.map(scan_blob_patterns_chunk, [self.root] * len(chunks), chunks):
+            issues_by_file.extend(chunk_issues)
+        return issues_by_file
+
+
+def open_file_source(root: str, backend: str = SCAN_BACKEND) -> FileSource:
+    """Source reading `root` with the selected backend"""
+    if backend not in SCAN_BACKENDS:
+        raise ValueError(f"Unknown scan backend {backend}, expected one of {SCAN_BACKENDS}")
+    if backend == "gitdb":
+        return GitTreeSource(root)
+    return WorkingTreeSource(root)
@@ -0,0 +1,22 @@
+from urllib.parse import urlsplit, urlunsplit
+
+
+def format_github_url(url: str) -> str:
+    """Format the URL to be used with the Github API"""
+    # Make sure there is github.com in the URL
+    if "github.com" not in url:
+        url = f"github.com/{url}"
+    # Make sure there is https:// in the URL
+    if "https://" not in url:
+        url = f"https://{url}"
+    return url
+
+
+def normalize_repository_url(url: str) -> str:
+    """Canonical form of a repository URL, used as key for everything cached per repository
+
+    Scheme and host are lowercased, trailing slashes and `.git` suffix are removed.
+    """
+    parts = urlsplit(url.strip())
+    path = parts.path.rstrip("/").removesuffix(".git").rstrip("/")
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, "", ""))
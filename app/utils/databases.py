@@ -1,17 +1,9 @@
-import os
 import sqlite3
 import logging
-from supabase import Client, create_client
 
-logger = logging.getLogger(__name__)
-
-url: str = os.environ.get("SUPABASE_URL",'')
-key: str = os.environ.get("SUPABASE_KEY",'')
+from .services import get_supabase
 
-assert url != '', "No SUPABASE_URL detected"
-assert key != '', "No SUPABASE_KEY detected"
-
-supabase: Client = create_client(url, key)
+logger = logging.getLogger(__name__)
 
 
 def store_data_in_sqlite_db(db_name: str, data: dict):
@@ -31,13 +23,14 @@ def store_data_in_sqlite_db(db_name: str, data: dict):
     conn.close()
 
 
+def update_offer(url: str, values: dict):
+    """Update the offer of `url` in supabase, blocking"""
+    response = get_supabase().table("offers").update(values).eq("url", url).execute()
+    logger.debug(f"Response from database: {response}")
+    return response
+
+
 # Function to store data in a supabase database
 def store_data_in_db(*, url: str, files_count: int, lines_count: int):
-    logger.error(f"Storing data in database: {url}, {files_count}, {lines_count}")
-    response = (
-        supabase.table("offers")
-        .update({"files_count": files_count, "lines_count": lines_count})
-        .eq("url", url)
-        .execute()
-    )
-    logger.error(f"Response from database: {response}")
\ No newline at end of file
+    logger.debug(f"Storing data in database: {url}, {files_count}, {lines_count}")
+    return update_offer(url, {"files_count": files_count, "lines_count": lines_count})
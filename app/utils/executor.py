@@ -0,0 +1,89 @@
+"""
+Execution layer used to run the blocking analysis stages outside of the event loop.
+
+I/O bound stages (cloning, GPT calls, database writes, cleanup) run on a thread pool,
+CPU bound stages (walking the repository, counting lines) run on a process pool.
+Both pools are shared by every analysis running in the process, handlers only await them.
+With ANALYSIS_WORKERS > 0, analyses run in worker processes which have their own pools
+(see workers.py), the API process only relays their messages.
+"""
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+IO_WORKERS: int = int(os.getenv("ANALYSIS_IO_WORKERS", 32))
+CPU_WORKERS: int = int(os.getenv("ANALYSIS_CPU_WORKERS", os.cpu_count() or 1))
+# Workers are forked from a small server process rather than from the app, which runs threads
+# and holds every client. "fork" is faster to start but copies the whole app.
+CPU_START_METHOD: str = os.getenv(
+    "ANALYSIS_CPU_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn",
+)
+# Processes running the analyses out of the API process, 0 runs them in the API process
+ANALYSIS_WORKERS: int = int(os.getenv("ANALYSIS_WORKERS", 2))
+# Modules the CPU workers need, imported once by the fork server
+CPU_PRELOAD_MODULES = ["utils.analysis.scanner", "utils.analysis.patterns", "utils.analysis.sources"]
+
+_io_pool: Optional[ThreadPoolExecutor] = None
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_io_pool() -> ThreadPoolExecutor:
+    """Thread pool for stages waiting on network or disk"""
+    global _io_pool
+    if _io_pool is None:
+        logger.debug(f"Starting I/O pool with {IO_WORKERS} threads")
+        _io_pool = ThreadPoolExecutor(
+            max_workers=IO_WORKERS, thread_name_prefix="analysis-io"
+        )
+    return _io_pool
+
+
+def get_cpu_pool() -> ProcessPoolExecutor:
+    """Process pool for stages bound by the interpreter"""
+    global _cpu_pool
+    if _cpu_pool is None:
+        logger.debug(f"Starting CPU pool with {CPU_WORKERS} processes ({CPU_START_METHOD})")
+        context = multiprocessing.get_context(CPU_START_METHOD)
+        if CPU_START_METHOD == "forkserver":
+            context.set_forkserver_preload(CPU_PRELOAD_MODULES)
+        _cpu_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=context)
+    return _cpu_pool
+
+
+async def _run(pool: Executor, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
+
+
+async def run_io(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Await `func` running on the I/O thread pool"""
+    return await _run(get_io_pool(), func, *args, **kwargs)
+
+
+async def run_cpu(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Await `func` running on the CPU process pool
+
+    `func`, its arguments and its result must be picklable.
+    """
+    return await _run(get_cpu_pool(), func, *args, **kwargs)
+
+
+def shutdown(wait: bool = True) -> None:
+    """Stop both pools, called when the application stops"""
+    global _io_pool, _cpu_pool
+    if _io_pool is not None:
+        _io_pool.shutdown(wait=wait, cancel_futures=True)
+        _io_pool = None
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=wait, cancel_futures=True)
+        _cpu_pool = None
@@ -0,0 +1,414 @@
+"""
+Persistent queue of analysis jobs, shared by the API and the worker processes (see workers.py).
+
+The API enqueues jobs into SQLite, workers claim them with a lease of JOB_LEASE_SECONDS which
+they renew while the job runs. A running job whose lease expired (its worker died or hung) is
+claimed again by another worker, up to JOB_MAX_ATTEMPTS times, then it fails.
+A job is identified by (normalized repository URL, commit, audit type) like in-process jobs,
+requesting a job which is queued or running returns it instead of enqueuing another one.
+
+Messages sent by a job are appended to the job_events table with their sequence number, only by
+the worker holding its lease. A job ends with an event without message. JobRelay tails the
+events of the jobs followed by the clients of an API process and relays them to local Jobs, so
+clients subscribe to them like to in-process jobs.
+Every claim of a job starts a new run, its events are tagged with it. Only the events of the
+last run are read: a job claimed again restarts from the beginning, and its subscribers are
+not replayed the scan and results of the interrupted run. Sequence numbers keep increasing
+across runs so clients resume after the last event they received.
+Finished jobs and their events are removed JOB_RETENTION_SECONDS after they finished.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from utils import executor
+from utils.jobs import JOB_RETENTION_SECONDS, Job, JobKey, JobRegistry, job_registry
+
+logger = logging.getLogger(__name__)
+
+JOB_STORE_PATH: str = os.getenv("JOB_STORE_PATH", "jobs.db")
+JOB_LEASE_SECONDS: float = float(os.getenv("JOB_LEASE_SECONDS", 30))
+JOB_MAX_ATTEMPTS: int = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# Delay between two reads of the events of the followed jobs
+JOB_EVENTS_POLL_INTERVAL: float = float(os.getenv("JOB_EVENTS_POLL_INTERVAL", 0.05))
+
+# A stored event: sequence number, run of the job and message, None as message ends the job
+StoredEvent = Tuple[int, int, Optional[dict]]
+
+
+@dataclass
+class StoredJob:
+    id: str
+    key: JobKey
+    # Keyword arguments of replay_or_run_repository_analysis
+    params: dict
+    state: str
+    attempts: int
+
+
+class JobStore:
+    """Analysis jobs and their events, stored in SQLite"""
+
+    def __init__(
+        self,
+        db_path: str = JOB_STORE_PATH,
+        *,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+    ) -> None:
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs
+                          (id TEXT PRIMARY KEY,
+                           url TEXT,
+                           commit_sha TEXT,
+                           audit_type TEXT,
+                           params TEXT,
+                           state TEXT,
+                           attempts INTEGER,
+                           runs INTEGER,
+                           lease_owner TEXT,
+                           lease_expires_at REAL,
+                           created_at REAL,
+                           finished_at REAL)"""
+            )
+            # Single-flight across processes, a key has at most one queued or running job
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_key ON jobs (url, commit_sha, audit_type) WHERE state IN ('queued', 'running')"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS job_events
+                          (job_id TEXT,
+                           seq INTEGER,
+                           run INTEGER,
+                           message TEXT,
+                           PRIMARY KEY (job_id, seq))"""
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Connection committed when the block succeeds, closed in any case"""
+        with closing(sqlite3.connect(self.db_path, timeout=30)) as conn:
+            # Events are appended one by one, WAL stays consistent without syncing every commit
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+
+    def enqueue(self, key: JobKey, params: dict) -> Tuple[str, bool]:
+        """Queue a job for `key`, unless one is already queued or running
+
+        returns the id of the job and whether it was queued by this call
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE url = ? AND commit_sha = ? AND audit_type = ? AND state IN ('queued', 'running')",
+                key,
+            ).fetchone()
+            if row is not None:
+                return row[0], False
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, url, commit_sha, audit_type, params, state, attempts, runs, created_at) VALUES (?, ?, ?, ?, ?, 'queued', 0, 0, ?)",
+                (job_id, *key, json.dumps(params), now),
+            )
+        logger.debug(f"Queued job {job_id} for {key}")
+        return job_id, True
+
+    def find(self, job_id: str) -> Optional[StoredJob]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, url, commit_sha, audit_type, params, state, attempts FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        return self._stored_job(row) if row is not None else None
+
+    @staticmethod
+    def _stored_job(row: tuple) -> StoredJob:
+        job_id, url, commit, audit_type, params, state, attempts = row
+        return StoredJob(
+            id=job_id,
+            key=(url, commit, audit_type),
+            params=json.loads(params),
+            state=state,
+            attempts=attempts,
+        )
+
+    def claim(self, worker_id: str, lease_seconds: float = JOB_LEASE_SECONDS) -> Optional[StoredJob]:
+        """Take the oldest queued job, or a running one whose lease expired, for `lease_seconds`"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            # Idle workers poll often, an empty queue is found without taking the write lock
+            claimable = conn.execute(
+                "SELECT 1 FROM jobs WHERE state = 'queued' OR (state = 'running' AND lease_expires_at < ?) LIMIT 1",
+                (now,),
+            ).fetchone()
+            if claimable is None:
+                return None
+            conn.execute("BEGIN IMMEDIATE")
+            # Jobs which keep killing their worker are not retried forever
+            for (job_id,) in conn.execute(
+                "SELECT id FROM jobs WHERE state = 'running' AND lease_expires_at < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            ).fetchall():
+                logger.warning(f"Job {job_id} failed after {self.max_attempts} attempts")
+                self._append(
+                    conn,
+                    job_id,
+                    {
+                        "status": "error",
+                        "step_name": "reviewing",
+                        "message": f"The analysis stopped {self.max_attempts} times before finishing, giving up",
+                    },
+                )
+                self._end(conn, job_id, "failed", now)
+            row = conn.execute(
+                """SELECT id, url, commit_sha, audit_type, params, state, attempts FROM jobs
+                   WHERE state = 'queued' OR (state = 'running' AND lease_expires_at < ?)
+                   ORDER BY created_at LIMIT 1""",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            job = self._stored_job(row)
+            job.state = "running"
+            job.attempts += 1
+            # Released jobs don't use an attempt but start a new run all the same
+            conn.execute(
+                "UPDATE jobs SET state = 'running', attempts = ?, runs = runs + 1, lease_owner = ?, lease_expires_at = ? WHERE id = ?",
+                (job.attempts, worker_id, now + lease_seconds, job.id),
+            )
+        logger.debug(f"Worker {worker_id} claimed job {job.id} (attempt {job.attempts})")
+        return job
+
+    def renew(self, job_id: str, worker_id: str, lease_seconds: float = JOB_LEASE_SECONDS) -> bool:
+        """Extend the lease of a job, False if `worker_id` doesn't hold it anymore"""
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                (time.time() + lease_seconds, job_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def release(self, job_id: str, worker_id: str) -> None:
+        """Put back a job its worker stops running, the attempt doesn't count"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'queued', attempts = attempts - 1, lease_owner = NULL, lease_expires_at = NULL WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                (job_id, worker_id),
+            )
+
+    def expire(self, worker_id: str) -> int:
+        """Expire the leases of a worker known to be dead, its jobs can be claimed at once"""
+        with self._lock, self._connect() as conn:
+            return conn.execute(
+                "UPDATE jobs SET lease_expires_at = 0 WHERE lease_owner = ? AND state = 'running'",
+                (worker_id,),
+            ).rowcount
+
+    def append_events(self, job_id: str, worker_id: str, messages: List[dict]) -> bool:
+        """Append messages sent by a job, False if `worker_id` doesn't hold its lease anymore"""
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if not self._holds_lease(conn, job_id, worker_id):
+                return False
+            for message in messages:
+                self._append(conn, job_id, message)
+            return True
+
+    def finish(self, job_id: str, worker_id: str, failed: bool) -> bool:
+        """Mark a job done or failed and end its events, False if `worker_id` doesn't hold its lease"""
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if not self._holds_lease(conn, job_id, worker_id):
+                return False
+            self._end(conn, job_id, "failed" if failed else "done", time.time())
+            return True
+
+    @staticmethod
+    def _holds_lease(conn: sqlite3.Connection, job_id: str, worker_id: str) -> bool:
+        row = conn.execute(
+            "SELECT 1 FROM jobs WHERE id = ? AND lease_owner = ? AND state = 'running'",
+            (job_id, worker_id),
+        ).fetchone()
+        return row is not None
+
+    @staticmethod
+    def _append(conn: sqlite3.Connection, job_id: str, message: Optional[dict]) -> None:
+        conn.execute(
+            "INSERT INTO job_events (job_id, seq, run, message) SELECT ?, COALESCE(MAX(seq), 0) + 1, (SELECT runs FROM jobs WHERE id = ?), ? FROM job_events WHERE job_id = ?",
+            (job_id, job_id, json.dumps(message) if message is not None else None, job_id),
+        )
+
+    def _end(self, conn: sqlite3.Connection, job_id: str, state: str, now: float) -> None:
+        conn.execute(
+            "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires_at = NULL, finished_at = ? WHERE id = ?",
+            (state, now, job_id),
+        )
+        self._append(conn, job_id, None)
+
+    def events_after(self, after: Dict[str, int]) -> Dict[str, List[StoredEvent]]:
+        """Events of the last run of each job with a sequence greater than `after[job id]`, in order"""
+        events: Dict[str, List[StoredEvent]] = {}
+        with self._lock, self._connect() as conn:
+            for job_id, sequence in after.items():
+                rows = conn.execute(
+                    """SELECT seq, run, message FROM job_events
+                       WHERE job_id = ? AND seq > ? AND run = (SELECT runs FROM jobs WHERE id = ?)
+                       ORDER BY seq""",
+                    (job_id, sequence, job_id),
+                ).fetchall()
+                if rows:
+                    events[job_id] = [
+                        (seq, run, json.loads(message) if message is not None else None)
+                        for seq, run, message in rows
+                    ]
+        return events
+
+    def purge(self, max_age: float = JOB_RETENTION_SECONDS) -> int:
+        """Remove jobs finished more than `max_age` seconds ago, with their events"""
+        with self._lock, self._connect() as conn:
+            expired = [
+                job_id
+                for (job_id,) in conn.execute(
+                    "SELECT id FROM jobs WHERE state IN ('done', 'failed') AND finished_at < ?",
+                    (time.time() - max_age,),
+                )
+            ]
+            conn.executemany("DELETE FROM job_events WHERE job_id = ?", [(job_id,) for job_id in expired])
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in expired])
+        if expired:
+            logger.debug(f"Purged {len(expired)} finished jobs")
+        return len(expired)
+
+    def count(self, state: str) -> int:
+        with self._lock, self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (state,)).fetchone()[0]
+
+
+class JobRelay:
+    """Relay the events of stored jobs to local Jobs, which clients of the API subscribe to"""
+
+    def __init__(
+        self,
+        store: JobStore,
+        registry: JobRegistry = job_registry,
+        interval: float = JOB_EVENTS_POLL_INTERVAL,
+    ) -> None:
+        self.store = store
+        self.registry = registry
+        self.interval = interval
+        # Unfinished jobs followed by this process, by id
+        self.jobs: Dict[str, Job] = {}
+        # Run of each followed job the relayed events belong to
+        self.runs: Dict[str, int] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    async def start_job(self, key: JobKey, params: dict) -> Tuple[Job, bool]:
+        """Queue a job for `key` or join the queued or running one
+
+        returns the local job and whether it was queued by this call
+        """
+        job_id, queued = await executor.run_io(self.store.enqueue, key, params)
+        return self.follow(job_id, key), queued
+
+    async def find(self, job_id: str) -> Optional[Job]:
+        """Local job of a stored job, followed from now on if no client of this process did yet"""
+        job = self.registry.find(job_id)
+        if job is not None:
+            return job
+        stored_job = await executor.run_io(self.store.find, job_id)
+        if stored_job is None:
+            return None
+        return self.follow(stored_job.id, stored_job.key)
+
+    def follow(self, job_id: str, key: JobKey) -> Job:
+        job = self.registry.find(job_id)
+        if job is None:
+            # Events already stored are relayed by the next poll, from the first one
+            job = self.registry.add(Job(key, job_id))
+            self.jobs[job_id] = job
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        return job
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self) -> None:
+        try:
+            while self.jobs:
+                try:
+                    await self.poll()
+                except Exception:
+                    logger.exception("Failed to relay job events")
+                await asyncio.sleep(self.interval)
+        finally:
+            self.task = None
+
+    async def poll(self) -> None:
+        """Relay the new events of every followed job"""
+        events = await executor.run_io(
+            self.store.events_after, {job_id: job.last_event_id for job_id, job in self.jobs.items()}
+        )
+        for job_id, job_events in events.items():
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            for sequence, run, message in job_events:
+                # Sequences of the local job follow the stored ones
+                if sequence <= job.last_event_id:
+                    continue
+                if self.runs.setdefault(job_id, run) != run:
+                    # The job was claimed again, messages of the interrupted run aren't replayed
+                    self.runs[job_id] = run
+                    job.restart()
+                if message is None:
+                    del self.jobs[job_id]
+                    self.runs.pop(job_id, None)
+                    self.registry.finish(job)
+                    break
+                # Events of the interrupted runs leave gaps in the sequences
+                job.last_event_id = sequence - 1
+                await job.send(**message)
+
+
+_job_store: Optional[JobStore] = None
+_job_relay: Optional[JobRelay] = None
+
+
+def get_job_store() -> JobStore:
+    """Job store shared by every analysis of the process"""
+    global _job_store
+    if _job_store is None:
+        _job_store = JobStore()
+    return _job_store
+
+
+def get_job_relay() -> JobRelay:
+    """Relay of the jobs followed by the clients of the process"""
+    global _job_relay
+    if _job_relay is None:
+        _job_relay = JobRelay(get_job_store())
+    return _job_relay
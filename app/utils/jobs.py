@@ -0,0 +1,167 @@
+"""
+Single-flight registry of running analyses.
+
+An analysis is identified by (normalized repository URL, commit, audit type). Requesting an
+analysis which is already running attaches the caller to it as an additional subscriber instead
+of starting a second one. Every message sent by a job gets a sequential event id and is kept in
+a replay buffer of the last JOB_REPLAY_BUFFER messages: late subscribers first get the messages
+already sent replayed, then the live stream, and a subscriber which lost its connection resumes
+after the last event it received.
+Finished jobs stay reachable by id for JOB_RETENTION_SECONDS so clients can still resume them.
+Jobs run by worker processes are relayed to local jobs of the registry (see job_store.py).
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+JOB_REPLAY_BUFFER: int = int(os.getenv("JOB_REPLAY_BUFFER", 10000))
+JOB_RETENTION_SECONDS: float = float(os.getenv("JOB_RETENTION_SECONDS", 300))
+
+JobKey = Tuple[str, str, str]
+# Sequential id of a message in its job, starting at 1
+Event = Tuple[int, dict]
+
+
+class Subscription:
+    """Messages of a job waiting to be delivered to one subscriber"""
+
+    def __init__(self, after: int = 0) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # Events up to this one were already delivered
+        self.after = after
+
+    def put(self, event: Optional[Event]) -> None:
+        # A relayed job may receive events the subscriber resumed after (see job_store.py)
+        if event is not None and event[0] <= self.after:
+            return
+        self.queue.put_nowait(event)
+
+    async def events(self, keepalive: Optional[float] = None) -> AsyncIterator[Optional[Event]]:
+        """Yield events until the job is finished
+
+        With `keepalive`, None is yielded when no event came for that many seconds.
+        """
+        while True:
+            try:
+                event = await asyncio.wait_for(self.queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if event is None:
+                return
+            yield event
+
+    async def messages(self) -> AsyncIterator[dict]:
+        """Yield messages until the job is finished"""
+        async for _, message in self.events():
+            yield message
+
+
+class Job:
+    """A running analysis, sends messages with the same signature as WebSocketAPI.send"""
+
+    def __init__(self, key: JobKey, id: Optional[str] = None) -> None:
+        self.key = key
+        self.id = id or uuid.uuid4().hex
+        self.history: Deque[Event] = deque(maxlen=JOB_REPLAY_BUFFER)
+        self.last_event_id = 0
+        self.subscriptions: List[Subscription] = []
+        self.finished = False
+        self.failed = False
+        self.task: Optional[asyncio.Task] = None
+
+    async def send(self, **message: Any) -> None:
+        if message.get("status") == "error":
+            self.failed = True
+        self.last_event_id += 1
+        event = (self.last_event_id, message)
+        self.history.append(event)
+        for subscription in self.subscriptions:
+            subscription.put(event)
+
+    def subscribe(self, after: int = 0) -> Subscription:
+        """Attach a subscriber, messages already sent after event `after` are queued first"""
+        subscription = Subscription(after)
+        for event in self.history:
+            subscription.put(event)
+        if self.finished:
+            subscription.put(None)
+        else:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def restart(self) -> None:
+        """Forget the messages sent so far, late subscribers only get the ones sent from now on"""
+        self.history.clear()
+        self.failed = False
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def finish(self) -> None:
+        self.finished = True
+        for subscription in self.subscriptions:
+            subscription.put(None)
+        self.subscriptions.clear()
+
+
+class JobRegistry:
+    def __init__(self) -> None:
+        self.jobs: Dict[JobKey, Job] = {}
+        # Running and recently finished jobs, by id
+        self.jobs_by_id: Dict[str, Job] = {}
+
+    def get_or_start(self, key: JobKey, run: Callable[[Job], Awaitable[Any]]) -> Tuple[Job, bool]:
+        """Return the running job for `key`, starting `run(job)` if there is none
+
+        returns the job and whether it was started by this call
+        """
+        job = self.jobs.get(key)
+        if job is not None:
+            logger.debug(f"Joining running job {job.id} for {key}")
+            return job, False
+        job = self.add(Job(key))
+        job.task = asyncio.create_task(self._run(job, run))
+        logger.debug(f"Started job {job.id} for {key}")
+        return job, True
+
+    def add(self, job: Job) -> Job:
+        self.jobs[job.key] = job
+        self.jobs_by_id[job.id] = job
+        return job
+
+    def finish(self, job: Job) -> None:
+        """End the messages of `job`, it stays reachable by id for JOB_RETENTION_SECONDS"""
+        job.finish()
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        asyncio.get_running_loop().call_later(
+            JOB_RETENTION_SECONDS, self.jobs_by_id.pop, job.id, None
+        )
+
+    def find(self, job_id: str) -> Optional[Job]:
+        """Running or recently finished job"""
+        return self.jobs_by_id.get(job_id)
+
+    async def _run(self, job: Job, run: Callable[[Job], Awaitable[Any]]) -> None:
+        try:
+            await run(job)
+        except Exception as error:
+            logger.exception(f"Job {job.id} failed")
+            await job.send(
+                status="error",
+                step_name="reviewing",
+                message=f"An error has occured during the analysis : {error}",
+            )
+        finally:
+            self.finish(job)
+
+
+job_registry = JobRegistry()
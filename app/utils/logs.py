@@ -0,0 +1,17 @@
+"""
+Logging of the API and of its worker processes, written to the same LOG_FILE.
+
+The API truncates the file when it starts, its workers append to it with their id in front of
+their messages. Nothing is configured on import: worker processes import main again, which must
+not truncate the file written by the API.
+"""
+
+import logging
+import os
+
+LOG_FILE: str = os.getenv("LOG_FILE", "app.log")
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+def configure_logging(format: str = LOG_FORMAT, filemode: str = "a") -> None:
+    logging.basicConfig(level=logging.DEBUG, format=format, filename=LOG_FILE, filemode=filemode)
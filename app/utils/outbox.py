@@ -0,0 +1,193 @@
+"""
+Write-behind persistence of analysis results to supabase.
+
+Analyses don't wait for supabase: they enqueue the values of their offer into an outbox table
+of the local SQLite database and go on. A background task flushes the outbox every
+OUTBOX_FLUSH_INTERVAL seconds, sending the due updates of a batch concurrently.
+
+- Updates of the same offer are coalesced, only the latest values are sent.
+- An entry is removed once supabase accepted it. Failed entries stay in the outbox and are
+  retried with exponential backoff, so results survive supabase outages and restarts.
+
+Point SUPABASE_URL at a local stand-in of the REST endpoint to exercise it.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional
+
+from utils import executor
+from utils.databases import update_offer
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DB_PATH: str = os.getenv("OUTBOX_DB_PATH", "file_data.db")
+OUTBOX_FLUSH_INTERVAL: float = float(os.getenv("OUTBOX_FLUSH_INTERVAL", 2))
+OUTBOX_BATCH_SIZE: int = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_MAX_RETRY_DELAY = 300.0
+
+
+@dataclass
+class OutboxEntry:
+    url: str
+    values: dict
+    # Incremented on every enqueue, an entry updated while it was sent is not removed
+    version: int
+    attempts: int
+
+
+class OffersOutbox:
+    """Pending updates of the `offers` table, stored in SQLite"""
+
+    def __init__(self, db_path: str = OUTBOX_DB_PATH) -> None:
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS offers_outbox
+                          (url TEXT PRIMARY KEY,
+                           payload TEXT,
+                           version INTEGER,
+                           attempts INTEGER,
+                           next_attempt_at REAL)"""
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Connection committed when the block succeeds, closed in any case"""
+        with closing(sqlite3.connect(self.db_path, timeout=30)) as conn, conn:
+            yield conn
+
+    def enqueue(self, url: str, values: dict) -> None:
+        """Record values to write to the offer of `url`, merged with the ones not sent yet"""
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT payload, version FROM offers_outbox WHERE url = ?", (url,)
+            ).fetchone()
+            payload, version = (json.loads(row[0]), row[1]) if row is not None else ({}, 0)
+            payload.update(values)
+            conn.execute(
+                "INSERT OR REPLACE INTO offers_outbox (url, payload, version, attempts, next_attempt_at) VALUES (?, ?, ?, 0, 0)",
+                (url, json.dumps(payload), version + 1),
+            )
+
+    def due(self, limit: int) -> List[OutboxEntry]:
+        """Entries to send now, oldest first"""
+        with self._lock, self._connect() as conn:
+            return [
+                OutboxEntry(url=url, values=json.loads(payload), version=version, attempts=attempts)
+                for url, payload, version, attempts in conn.execute(
+                    "SELECT url, payload, version, attempts FROM offers_outbox WHERE next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                    (time.time(), limit),
+                )
+            ]
+
+    def settle(self, sent: List[OutboxEntry], failed: List[OutboxEntry], retry_delay: float) -> None:
+        """Remove sent entries, schedule failed ones to be sent again"""
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "DELETE FROM offers_outbox WHERE url = ? AND version = ?",
+                [(entry.url, entry.version) for entry in sent],
+            )
+            conn.executemany(
+                "UPDATE offers_outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE url = ? AND version = ?",
+                [
+                    (
+                        time.time() + min(OUTBOX_MAX_RETRY_DELAY, retry_delay * 2**entry.attempts),
+                        entry.url,
+                        entry.version,
+                    )
+                    for entry in failed
+                ],
+            )
+
+    def __len__(self) -> int:
+        with self._lock, self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM offers_outbox").fetchone()[0]
+
+
+class OffersWriter:
+    """Background task flushing the outbox to supabase"""
+
+    def __init__(
+        self,
+        outbox: OffersOutbox,
+        update: Callable[[str, dict], object] = update_offer,
+        interval: float = OUTBOX_FLUSH_INTERVAL,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+    ) -> None:
+        self.outbox = outbox
+        self.update = update
+        self.interval = interval
+        self.batch_size = batch_size
+        self.task: Optional[asyncio.Task] = None
+
+    async def enqueue(self, url: str, **values) -> None:
+        """Durably record values for the offer of `url`, they are sent by the next flush"""
+        await executor.run_io(self.outbox.enqueue, url, values)
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background task after a last flush, what can't be sent stays in the outbox"""
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush the offers outbox")
+
+    async def flush(self) -> int:
+        """Send every due entry, returns the number of entries sent"""
+        sent_count = 0
+        while True:
+            entries = await executor.run_io(self.outbox.due, self.batch_size)
+            if not entries:
+                return sent_count
+            results = await asyncio.gather(
+                *(executor.run_io(self.update, entry.url, entry.values) for entry in entries),
+                return_exceptions=True,
+            )
+            sent, failed = [], []
+            for entry, result in zip(entries, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Failed to update offer {entry.url}, will retry: {result}")
+                    failed.append(entry)
+                else:
+                    sent.append(entry)
+            await executor.run_io(self.outbox.settle, sent, failed, self.interval)
+            sent_count += len(sent)
+            logger.debug(f"Flushed {len(sent)} offer updates, {len(failed)} failed")
+            if len(entries) < self.batch_size:
+                return sent_count
+
+
+_offers_writer: Optional[OffersWriter] = None
+
+
+def get_offers_writer() -> OffersWriter:
+    """Writer shared by every analysis of the process"""
+    global _offers_writer
+    if _offers_writer is None:
+        _offers_writer = OffersWriter(OffersOutbox())
+    return _offers_writer
@@ -0,0 +1,368 @@
+"""
+Analysis pipeline of a repository.
+
+The pipeline sends its progress through an emitter, any object with the signature of
+WebSocketAPI.send: a WebSocketAPI directly, a Job relaying messages to its subscribers, or the
+emitter of a worker process storing them for the API to relay (see workers.py).
+Blocking stages are awaited on the shared executor pools so the event loop keeps serving
+other connections.
+A repository submitted again at the same commit gets the stored report of its last analysis
+replayed instead (see analysis/reports.py).
+Messages name files `<repository name>/<path in the repository>`, the workspace the repository
+is cloned into stays internal.
+"""
+
+import functools
+import logging
+from typing import Optional, Tuple
+
+from utils import analysis
+from utils import executor
+from utils.analysis.audits import build_audit, get_audit_store, plan_incremental_audit, tree_blob_shas
+from utils.analysis.cache import CacheStats
+from utils.analysis.cloning import resolve_head
+from utils.analysis.mirrors import RepositoryTooLarge
+from utils.analysis.reports import Report, ReportRecorder, get_report_store
+from utils.analysis.urls import format_github_url, normalize_repository_url
+from utils.job_store import get_job_relay
+from utils.jobs import Job, job_registry
+from utils.outbox import get_offers_writer
+from utils.services import get_model
+from utils.workspaces import Workspace, get_workspace_manager
+
+logger = logging.getLogger(__name__)
+
+
+async def start_repository_analysis(
+    *, repository_url: str, audit_type: str
+) -> Tuple[Job, bool]:
+    """Start the analysis of the current HEAD of a repository, or join the one already running
+
+    `repository_url` is the URL submitted by the client, raises if the repository can't be reached.
+    returns the job and whether it was started by this call
+    """
+    # Make sure URL is in the right format
+    formatted_url = format_github_url(repository_url)
+    commit = await executor.run_io(resolve_head, formatted_url)
+    key = (normalize_repository_url(formatted_url), commit, audit_type)
+    params = {
+        "repository_url": formatted_url,
+        "commit": commit,
+        "audit_type": audit_type,
+        "offer_url": repository_url,
+    }
+    # The same analysis requested by several clients runs once and is streamed to all of them
+    if executor.ANALYSIS_WORKERS > 0:
+        # Run by a worker process, its messages are relayed from the job store
+        return await get_job_relay().start_job(key, params)
+    return job_registry.get_or_start(
+        key, functools.partial(replay_or_run_repository_analysis, **params)
+    )
+
+
+async def find_job(job_id: str) -> Optional[Job]:
+    """Running or recently finished job, with workers also the ones followed by other API processes"""
+    if executor.ANALYSIS_WORKERS > 0:
+        return await get_job_relay().find(job_id)
+    return job_registry.find(job_id)
+
+
+async def replay_or_run_repository_analysis(
+    emitter, *, repository_url: str, commit: str, audit_type: str, offer_url: str
+) -> None:
+    """Replay the stored report of `commit`, or analyse the repository and store its report"""
+    reports = get_report_store()
+    normalized_url = normalize_repository_url(repository_url)
+    # Creating the model imports the LLM client, kept off the event loop
+    version = await executor.run_io(lambda: get_model().version)
+    report = await executor.run_io(
+        reports.load, normalized_url, commit, audit_type, version
+    )
+    if report is not None:
+        await replay_report(emitter, report, offer_url=offer_url)
+        return
+
+    recorder = ReportRecorder(emitter)
+    await run_repository_analysis(
+        recorder,
+        repository_url=repository_url,
+        audit_type=audit_type,
+        offer_url=offer_url,
+    )
+    if recorder.complete:
+        await executor.run_io(
+            reports.save,
+            normalized_url,
+            audit_type,
+            version,
+            Report(commit=commit, messages=recorder.messages),
+        )
+
+
+async def replay_report(emitter, report: Report, *, offer_url: str) -> None:
+    await emitter.send(
+        status="success",
+        step_name="cloning",
+        message=f"Repository unchanged since its last analysis, replaying the report of commit {report.commit}",
+        data={"report": {"commit": report.commit, "createdAt": report.created_at}},
+    )
+    for message in report.messages:
+        await emitter.send(**message)
+        if message.get("type") == "repositoryScan":
+            # The offer may have been created after the report
+            await get_offers_writer().enqueue(
+                offer_url,
+                files_count=message["data"]["numberOfFiles"],
+                lines_count=message["data"]["totalLineCount"],
+            )
+
+
+async def run_repository_analysis(
+    emitter, *, repository_url: str, audit_type: str, offer_url: str
+) -> None:
+    """Clone, scan and review a repository
+
+    `repository_url` must be formatted with format_github_url, `offer_url` is the URL of the
+    offer as submitted by the client.
+    """
+    # Each analysis gets its own workspace, analyses of repositories with the same name don't collide
+    workspaces = get_workspace_manager()
+    workspace = await executor.run_io(
+        workspaces.create, repository_url.rstrip("/").split("/")[-1]
+    )
+    try:
+        await _run_repository_analysis(
+            emitter,
+            repository_url=repository_url,
+            audit_type=audit_type,
+            offer_url=offer_url,
+            workspace=workspace,
+        )
+    finally:
+        # Deleted in the background, the client does not wait for it
+        workspaces.release(workspace)
+
+
+def _for_client(workspace: Workspace, file_data: dict) -> dict:
+    """Copy of a file entry of the analysis with the path clients see"""
+    return {**file_data, "path": workspace.client_path(file_data["path"])}
+
+
+async def _run_repository_analysis(
+    emitter, *, repository_url: str, audit_type: str, offer_url: str, workspace: Workspace
+) -> None:
+    clone_dir = workspace.clone_dir
+    # Step 1: Clone the repository
+    await emitter.send(
+        status="pending",
+        step_name="cloning",
+        message="Started cloning repository",
+    )
+    try:
+        # The gitdb backend reads files from the object database, no checkout needed
+        clone_report = await executor.run_io(
+            analysis.clone_repo,
+            repository_url,
+            clone_dir,
+            checkout=analysis.SCAN_BACKEND == "worktree",
+            max_bytes=workspace.quota_bytes,
+        )
+        # Strategies other than mirror can only be checked once cloned
+        await executor.run_io(workspace.check_quota)
+    except RepositoryTooLarge as error:
+        await emitter.send(
+            status="error",
+            step_name="cloning",
+            message=f"The repository is too large to be analysed : {error}",
+        )
+        return
+    except Exception as error:
+        await emitter.send(
+            status="error",
+            step_name="cloning",
+            message=f"An error has occured while cloning the repository : {error}",
+        )
+        return
+    await emitter.send(
+        step_name="cloning",
+        status="success",
+        message=f"Successfully cloned repository: {repository_url}",
+        data={"clone": clone_report.as_dict()},
+    )
+
+    await emitter.send(
+        status="success",
+        step_name="identifying",
+        message="Started simple repository scan",
+    )
+    # Files unchanged since the last audit of this repository are carried forward, audits are
+    # stored by normalized URL like jobs and reports
+    audit_store = get_audit_store()
+    normalized_url = normalize_repository_url(repository_url)
+    previous_audit = await executor.run_io(
+        audit_store.load, normalized_url, audit_type
+    )
+    blob_shas = await executor.run_io(
+        tree_blob_shas, clone_report.git_dir, clone_report.commit
+    )
+    # Analyses made by another model are not carried forward
+    version = await executor.run_io(lambda: get_model().version)
+    incremental_plan = plan_incremental_audit(
+        previous_audit, blob_shas, str(clone_dir), version
+    )
+
+    # Step 2: Process the repository to count files, lines, identify main languages
+    # The scan fans line counting out to the CPU pool, only its coordination runs on a thread
+    source = await executor.run_io(analysis.open_file_source, clone_dir)
+    scan_result = await executor.run_io(
+        analysis.scan_repository,
+        clone_dir,
+        source=source,
+        known_line_counts=incremental_plan.known_line_counts,
+        # Secrets and dangerous patterns are security issues
+        patterns=audit_type == "security",
+    )
+    (
+        number_of_files,
+        total_line_count,
+        list_of_programming_languages,
+        ready_for_analysis,
+    ) = scan_result.as_tuple()
+
+    logger.debug(f"Number of files : {number_of_files}")
+    logger.debug(f"Total line count : {total_line_count}")
+    logger.debug(
+        f"Most common programming languages : {list_of_programming_languages}"
+    )
+    await emitter.send(
+        step_name="identifying",
+        status="success",
+        message="Repository scan complete",
+        type="repositoryScan",
+        data={
+            "numberOfFiles": number_of_files,
+            "totalLineCount": total_line_count,
+            "mostCommonProgrammingLanguages": list_of_programming_languages,
+            "timings": scan_result.timings,
+            "incremental": incremental_plan.as_dict(),
+            "excluded": scan_result.excluded,
+        },
+    )
+
+    await emitter.send(
+        step_name="identifying",
+        status="success",
+        message="Identified files relatives to project",
+        type="relativeFiles",
+        data={"relativeFiles": [_for_client(workspace, file_data) for file_data in ready_for_analysis]},
+    )
+    # Findings of the local pattern scanner are sent before GPT is asked anything, they are not
+    # part of the audit carried forward (only GPT results are)
+    for path, issues in scan_result.pattern_findings.items():
+        path = workspace.client_path(path)
+        await emitter.send(
+            step_name="identifying",
+            status="analyzing",
+            message=f"Patterns found in file: {path}",
+            type="inDepthAnalysis",
+            data={"issues": issues, "path": path, "source": "patterns"},
+        )
+    await emitter.send(
+        status="success",
+        step_name='reviewing',
+        message="Started in depth analysis")
+    # Step 3: Identify sensitive code (filter unnecessary files with AI)
+    # Hits and misses of the GPT analysis cache for this analysis
+    cache_stats = CacheStats()
+    sensitive_files = await executor.run_io(
+        analysis.get_sensitive_files,
+        ready_for_analysis,
+        cache_stats,
+        source,
+        scan_result.line_counts,
+        scan_result.pattern_findings,
+    )
+    await emitter.send(
+        status="success",
+        step_name='reviewing',
+        message="Identified sensitive files for in depth analysis",
+        type="sensitiveFiles",
+        data={
+            **sensitive_files,
+            "sensitiveFiles": [
+                _for_client(workspace, file_data)
+                for file_data in sensitive_files.get("sensitiveFiles", [])
+            ],
+        },
+    )
+    logger.debug(f"Files identified as relevent : {sensitive_files}")
+
+    # Step 4: Identify changes in the code (check for security issues with AI, and suggest first solutions)
+    # Results of unchanged files are carried forward, the others are analysed concurrently
+    # and each result is sent as soon as it is ready
+    in_depth_file_analysis = []
+    files_to_analyse = []
+    for file_data in sensitive_files.get("sensitiveFiles", []):
+        carried_result = incremental_plan.carried_results.get(str(file_data.get("path")))
+        if carried_result is None:
+            files_to_analyse.append(file_data)
+            continue
+        in_depth_result = {**carried_result, "path": file_data["path"], "fresh": False}
+        in_depth_file_analysis.append(in_depth_result)
+        client_result = _for_client(workspace, in_depth_result)
+        await emitter.send(
+            step_name="reviewing",
+            status="analyzing",
+            message=f"Unchanged file: {client_result['path']}",
+            type="inDepthAnalysis",
+            data=client_result,
+        )
+    async for in_depth_result in analysis.iter_in_depth_file_analysis(
+        list_files=files_to_analyse,
+        audit_type=audit_type,
+        cache_stats=cache_stats,
+        source=source,
+    ):
+        in_depth_result["fresh"] = True
+        in_depth_file_analysis.append(in_depth_result)
+        client_result = _for_client(workspace, in_depth_result)
+        await emitter.send(
+            step_name="reviewing",
+            status="analyzing",
+            message=f"Analysed file: {client_result['path']}",
+            type="inDepthAnalysis",
+            data=client_result,
+        )
+    await emitter.send(
+        step_name="reviewing",
+        status="success",
+        message="In depth analysis finished",
+        data={"cache": cache_stats.as_dict()},
+    )
+
+    # Step 5: Store the data in supabase database, written in the background
+    await get_offers_writer().enqueue(
+        offer_url,
+        files_count=number_of_files,
+        lines_count=total_line_count,
+    )
+
+    logger.debug(f"Changes in code : {in_depth_file_analysis}")
+
+    # Record this audit so the next one only reviews what changed
+    await executor.run_io(
+        audit_store.save,
+        normalized_url,
+        audit_type,
+        build_audit(
+            clone_report.commit,
+            blob_shas,
+            str(clone_dir),
+            scan_result.line_counts,
+            {
+                **incremental_plan.carried_results,
+                **{result["path"]: result for result in in_depth_file_analysis},
+            },
+            version,
+        ),
+    )
@@ -0,0 +1,51 @@
+"""
+Service container.
+
+Clients which are slow to import or to create (OpenAI, supabase) are created on first use and
+shared by the whole process. Importing a module never connects to anything or checks
+credentials, so the app starts fast and worker processes only pay for what they use.
+"""
+
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+    from utils.analysis.ml import ChatGPTApi
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_model: Optional["ChatGPTApi"] = None
+_supabase: Optional["Client"] = None
+
+
+def get_model() -> "ChatGPTApi":
+    """GPT client used by the analyses"""
+    global _model
+    with _lock:
+        if _model is None:
+            from utils.analysis.ml import ChatGPTApi
+
+            logger.debug("Loading GPT Model")
+            _model = ChatGPTApi()
+            logger.debug("Model loaded")
+        return _model
+
+
+def get_supabase() -> "Client":
+    """Supabase client, needs SUPABASE_URL and SUPABASE_KEY"""
+    global _supabase
+    with _lock:
+        if _supabase is None:
+            from supabase import create_client
+
+            url: str = os.environ.get("SUPABASE_URL", "")
+            key: str = os.environ.get("SUPABASE_KEY", "")
+            assert url != "", "No SUPABASE_URL detected"
+            assert key != "", "No SUPABASE_KEY detected"
+            _supabase = create_client(url, key)
+        return _supabase
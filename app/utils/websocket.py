@@ -1,10 +1,51 @@
+"""
+Messages sent to the client during an analysis.
+
+Protocol 1 (default) sends every message as its own JSON frame.
+
+Protocol 2 is requested by the client with `"protocol": 2` in its request:
+- frames are `{"v": 2, "messages": [...]}`, messages keep the fields of protocol 1. Messages are
+  buffered and sent together every WS_COALESCE_INTERVAL seconds, errors are sent at once
+- `relativeFiles` is split into pages of WS_FILES_PAGE_SIZE files, one frame each, with data
+  `{"page", "pages", "total", "languages", "prefixes", "files"}`
+- file lists (`relativeFiles` and `sensitiveFiles`) are dictionary encoded: each file is
+  `[prefix index, file name, language index]`, `languages` and `prefixes` hold the entries added
+  to the dictionaries by this message. Dictionaries grow for the whole request, the client
+  appends new entries to its own copy
+- frames are serialized with orjson
+
+Frames of both protocols are compressed when the client negotiates permessage-deflate, unless
+WS_PER_MESSAGE_DEFLATE is turned off (it costs CPU on servers close to their clients).
+"""
+
 import asyncio
 import datetime
 import logging
-from typing import Literal, Optional
+import os
+from typing import Dict, List, Literal, Optional, Tuple
+
+import orjson
 
 logger = logging.getLogger(__name__)
 
+WS_COALESCE_INTERVAL: float = float(os.getenv("WS_COALESCE_INTERVAL", 0.05))
+WS_FILES_PAGE_SIZE: int = int(os.getenv("WS_FILES_PAGE_SIZE", 1000))
+# Offer permessage-deflate to clients, read by main.py when starting uvicorn
+WS_PER_MESSAGE_DEFLATE: bool = os.getenv("WS_PER_MESSAGE_DEFLATE", "1").lower() in ("1", "true", "yes", "on")
+# A frame is sent as soon as this many messages are waiting
+WS_MAX_BATCH_MESSAGES = 200
+
+
+def message_payload(*, status, message, step_name, type=None, data=None) -> dict:
+    """Fields of a message as received by the client"""
+    payload = {"time":datetime.datetime.now().isoformat(),"status": status, "message": message, "stepName": step_name}
+    if type is not None:
+        payload["type"] = type
+    if data is not None:
+        payload["data"] = data
+    return payload
+
+
 class WebSocketAPI:
     def __init__(self, websocket):
         self.websocket = websocket
@@ -19,12 +60,9 @@ class WebSocketAPI:
         logger.debug(f"Sending success message: {message}")
         logger.debug(f"Type: {type}")
         logger.debug(f"Data: {data}")
-        payload = {"time":datetime.datetime.now().isoformat(),"status": status, "message": message, "stepName": step_name}
-        if type is not None:
-            payload["type"] = type
-        if data is not None:
-            payload["data"] = data
-        await self.send_json(payload)
+        await self.send_json(
+            message_payload(status=status, message=message, step_name=step_name, type=type, data=data)
+        )
         await self.yield_control()
 
     async def send_json(self, data):
@@ -32,3 +70,118 @@ class WebSocketAPI:
 
     async def yield_control(self):
         await asyncio.sleep(0)  # Yield control back to the event loop
+
+    async def flush(self):
+        """Send messages waiting to be sent, protocol 1 sends them immediately"""
+
+
+class FileListEncoder:
+    """Dictionary encoding of file lists, the dictionaries are shared by every message of a request"""
+
+    def __init__(self) -> None:
+        self.languages: Dict[Optional[str], int] = {}
+        self.prefixes: Dict[str, int] = {}
+
+    def encode(self, files: List[dict]) -> Tuple[List[Optional[str]], List[str], List[list]]:
+        """returns the languages and prefixes added to the dictionaries and the encoded files"""
+        new_languages: List[Optional[str]] = []
+        new_prefixes: List[str] = []
+        rows = []
+        for file in files:
+            prefix, _, name = str(file.get("path", "")).rpartition("/")
+            if prefix not in self.prefixes:
+                self.prefixes[prefix] = len(self.prefixes)
+                new_prefixes.append(prefix)
+            language = file.get("language")
+            if language not in self.languages:
+                self.languages[language] = len(self.languages)
+                new_languages.append(language)
+            rows.append([self.prefixes[prefix], name, self.languages[language]])
+        return new_languages, new_prefixes, rows
+
+
+class WebSocketAPIv2(WebSocketAPI):
+    """Protocol 2: coalesced, dictionary encoded and paginated messages"""
+
+    def __init__(self, websocket):
+        super().__init__(websocket)
+        self.files = FileListEncoder()
+        self.buffer: List[dict] = []
+        self._send_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def send(self,
+                   *,
+                   status: Literal['success','pending', 'analyzing','error'],
+                   message,
+                   step_name:Literal['connecting','cloning','identifying','reviewing'],
+                   type:Optional[Literal['relativeFiles','repositoryScan','sensitiveFiles','inDepthAnalysis']]=None,
+                   data=None):
+        payload = message_payload(status=status, message=message, step_name=step_name, type=type)
+        if type == "relativeFiles" and data is not None:
+            # Pages are big enough to get a frame each
+            await self.flush()
+            for page in self.paginate(data.get("relativeFiles", [])):
+                await self._send_frame([{**payload, "data": page}])
+            return
+        if type == "sensitiveFiles" and data is not None:
+            languages, prefixes, files = self.files.encode(data.get("sensitiveFiles", []))
+            data = {"languages": languages, "prefixes": prefixes, "files": files}
+        if data is not None:
+            payload["data"] = data
+        self.buffer.append(payload)
+        if status == "error" or len(self.buffer) >= WS_MAX_BATCH_MESSAGES:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                WS_COALESCE_INTERVAL, self._flush_later
+            )
+
+    def paginate(self, files: List[dict]) -> List[dict]:
+        pages = max(1, -(-len(files) // WS_FILES_PAGE_SIZE))
+        encoded_pages = []
+        for page in range(pages):
+            languages, prefixes, rows = self.files.encode(
+                files[page * WS_FILES_PAGE_SIZE : (page + 1) * WS_FILES_PAGE_SIZE]
+            )
+            encoded_pages.append(
+                {
+                    "page": page,
+                    "pages": pages,
+                    "total": len(files),
+                    "languages": languages,
+                    "prefixes": prefixes,
+                    "files": rows,
+                }
+            )
+        return encoded_pages
+
+    def _flush_later(self) -> None:
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        task.add_done_callback(self._log_flush_error)
+
+    @staticmethod
+    def _log_flush_error(task: asyncio.Future) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"Could not send buffered messages: {task.exception()}")
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.buffer = self.buffer, []
+        if batch:
+            await self._send_frame(batch)
+
+    async def _send_frame(self, messages: List[dict]):
+        # Frames leave in the order they were built, even when a timer flush runs concurrently
+        async with self._send_lock:
+            await self.websocket.send_text(orjson.dumps({"v": 2, "messages": messages}).decode())
+
+
+def create_websocket_api(websocket, protocol=1) -> WebSocketAPI:
+    """WebSocketAPI speaking the protocol requested by the client"""
+    if protocol == 2:
+        return WebSocketAPIv2(websocket)
+    return WebSocketAPI(websocket)
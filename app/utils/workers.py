@@ -0,0 +1,303 @@
+"""
+Worker processes running the analyses out of the API process.
+
+With ANALYSIS_WORKERS > 0 the API only queues analyses in the job store and relays their messages
+(see job_store.py). ANALYSIS_WORKERS worker processes claim the queued jobs and run up to
+WORKER_CONCURRENCY analyses each, with their own executor pools. A slow or crashing analysis
+no longer slows down the connections served by the API, workers scale independently of them,
+and queued analyses survive a restart of the API.
+
+- A worker renews the lease of its jobs while it runs them. It stops a job whose lease it lost,
+  the job was claimed again by another worker.
+- The WorkerPool of the API restarts workers which died and expires their leases, so their
+  jobs are retried at once rather than after JOB_LEASE_SECONDS.
+- A worker asked to stop puts its running jobs back in the queue, they are resumed from the
+  start by another worker. A worker whose API process is gone stops on its own.
+
+Every worker has its own GPT scheduler (see ratelimit.py). The OPENAI_RPM and OPENAI_TPM budget
+is split evenly between the ANALYSIS_WORKERS workers rather than coordinated through the job
+store: each worker enforces rpm/N and tpm/N, so together they stay within the account limits.
+Back-off after a 429 stays local to the worker which received it, the others only slow down
+when they receive 429s of their own.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import uuid
+from multiprocessing.process import BaseProcess
+from typing import Any, Dict, List, Optional
+
+from utils import executor
+from utils.analysis import ratelimit
+from utils.job_store import JOB_LEASE_SECONDS, JobStore, StoredJob, get_job_store
+from utils.logs import LOG_FORMAT, configure_logging
+from utils.outbox import get_offers_writer
+from utils.pipeline import replay_or_run_repository_analysis
+from utils.services import get_model
+from utils.workspaces import get_workspace_manager
+
+logger = logging.getLogger(__name__)
+
+# Analyses run at once by a worker, they mostly wait on git and GPT
+WORKER_CONCURRENCY: int = int(os.getenv("WORKER_CONCURRENCY", 4))
+# Delay between two claims when the queue is empty
+WORKER_POLL_INTERVAL: float = float(os.getenv("WORKER_POLL_INTERVAL", 0.05))
+# Delay between two checks of the worker processes by the API
+WORKER_CHECK_INTERVAL = 2.0
+# Time given to workers to put their jobs back before they are killed
+WORKER_STOP_TIMEOUT = 10.0
+
+
+class LeaseLost(Exception):
+    """Another worker claimed the job, this one must stop running it"""
+
+
+class JobEmitter:
+    """Emitter appending the messages of a job to its stored events
+
+    Messages sent while the previous ones are being written are written together, in one
+    transaction, so the analysis doesn't wait on SQLite for every message.
+    """
+
+    def __init__(self, store: JobStore, job: StoredJob, worker_id: str) -> None:
+        self.store = store
+        self.job = job
+        self.worker_id = worker_id
+        self.failed = False
+        self.lease_lost = False
+        self.pending: List[dict] = []
+        self._writer: Optional[asyncio.Task] = None
+
+    async def send(self, **message: Any) -> None:
+        if self.lease_lost:
+            raise LeaseLost(f"Job {self.job.id} was claimed by another worker")
+        if message.get("status") == "error":
+            self.failed = True
+        self.pending.append(message)
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write())
+
+    async def _write(self) -> None:
+        try:
+            while self.pending and not self.lease_lost:
+                messages, self.pending = self.pending, []
+                if not await executor.run_io(self.store.append_events, self.job.id, self.worker_id, messages):
+                    self.lease_lost = True
+        finally:
+            self._writer = None
+
+    async def flush(self) -> None:
+        """Wait until every message sent is stored, raises LeaseLost if they can't be"""
+        while self._writer is not None:
+            await asyncio.shield(self._writer)
+        if self.lease_lost:
+            raise LeaseLost(f"Job {self.job.id} was claimed by another worker")
+
+
+class Worker:
+    """Claim jobs from the store and run them, until stopped"""
+
+    def __init__(
+        self,
+        worker_id: str,
+        store: JobStore,
+        concurrency: int = WORKER_CONCURRENCY,
+        lease_seconds: float = JOB_LEASE_SECONDS,
+    ) -> None:
+        self.worker_id = worker_id
+        self.store = store
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.running: Dict[str, asyncio.Task] = {}
+        self.stopping = asyncio.Event()
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    async def run(self, parent_pid: Optional[int] = None) -> None:
+        offers_writer = get_offers_writer()
+        offers_writer.start()
+        try:
+            while not self.stopping.is_set():
+                if parent_pid is not None and os.getppid() != parent_pid:
+                    logger.warning(f"Worker {self.worker_id} lost its API process, stopping")
+                    break
+                job = None
+                if len(self.running) < self.concurrency:
+                    job = await executor.run_io(self.store.claim, self.worker_id, self.lease_seconds)
+                if job is not None:
+                    task = asyncio.create_task(self._run_job(job))
+                    self.running[job.id] = task
+                    task.add_done_callback(lambda _, job_id=job.id: self.running.pop(job_id, None))
+                    continue
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), WORKER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # Running jobs are put back in the queue
+            tasks = list(self.running.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await offers_writer.stop()
+
+    async def _run_job(self, job: StoredJob) -> None:
+        emitter = JobEmitter(self.store, job, self.worker_id)
+        analysis_task = asyncio.create_task(self._analyse(job, emitter))
+        try:
+            # The lease is renewed three times per period, a slow renewal doesn't lose it
+            while True:
+                done, _ = await asyncio.wait({analysis_task}, timeout=self.lease_seconds / 3)
+                if done:
+                    break
+                if not await executor.run_io(self.store.renew, job.id, self.worker_id, self.lease_seconds):
+                    logger.warning(f"Worker {self.worker_id} lost the lease of job {job.id}, stopping it")
+                    analysis_task.cancel()
+                    return
+        except asyncio.CancelledError:
+            analysis_task.cancel()
+            await asyncio.gather(analysis_task, return_exceptions=True)
+            await executor.run_io(self.store.release, job.id, self.worker_id)
+            logger.debug(f"Worker {self.worker_id} put job {job.id} back in the queue")
+            raise
+        failed = analysis_task.result()
+        if failed is not None:
+            await executor.run_io(self.store.finish, job.id, self.worker_id, failed)
+            logger.debug(f"Worker {self.worker_id} finished job {job.id}, failed: {failed}")
+
+    async def _analyse(self, job: StoredJob, emitter: JobEmitter) -> Optional[bool]:
+        """returns whether the analysis failed, None if another worker took the job over"""
+        try:
+            if job.attempts > 1:
+                await emitter.send(
+                    status="pending",
+                    step_name="cloning",
+                    message=f"The analysis was interrupted, restarting it (attempt {job.attempts} of {self.store.max_attempts})",
+                )
+            await replay_or_run_repository_analysis(emitter, **job.params)
+            await emitter.flush()
+        except LeaseLost as error:
+            logger.warning(str(error))
+            return None
+        except Exception as error:
+            logger.exception(f"Job {job.id} failed")
+            try:
+                await emitter.send(
+                    status="error",
+                    step_name="reviewing",
+                    message=f"An error has occured during the analysis : {error}",
+                )
+                await emitter.flush()
+            except LeaseLost:
+                return None
+        return emitter.failed
+
+
+def worker_main(worker_id: str, parent_pid: int, workers: int = 1) -> None:
+    """Entry point of a worker process, one of `workers` sharing the OpenAI limits"""
+    # Appended to the log of the API, which was truncated when it started
+    configure_logging(LOG_FORMAT.replace("%(message)s", f"worker {worker_id} - %(message)s"))
+    # Ctrl-C reaches the whole process group, the API stops its workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ratelimit.split_budget(workers)
+    asyncio.run(_serve(worker_id, parent_pid))
+
+
+async def _serve(worker_id: str, parent_pid: int) -> None:
+    worker = Worker(worker_id, get_job_store())
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, worker.stop)
+    # Creating the model imports the LLM client, done before the first job rather than during it
+    await executor.run_io(lambda: get_model().version)
+    logger.info(f"Worker {worker_id} started with pid {os.getpid()}")
+    try:
+        await worker.run(parent_pid)
+    finally:
+        executor.shutdown(wait=False)
+    logger.info(f"Worker {worker_id} stopped")
+
+
+class WorkerPool:
+    """Worker processes of the API process, restarted when they die"""
+
+    def __init__(self, processes: int = executor.ANALYSIS_WORKERS, store: Optional[JobStore] = None) -> None:
+        self.processes = processes
+        self.store = store or get_job_store()
+        # Workers are long lived, they start from a fresh interpreter rather than a copy of the API
+        self.context = multiprocessing.get_context("spawn")
+        self.workers: Dict[str, BaseProcess] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.task is not None:
+            return
+        for _ in range(self.processes):
+            self._spawn()
+        self.task = asyncio.create_task(self._watch())
+
+    def _spawn(self) -> None:
+        worker_id = uuid.uuid4().hex[:12]
+        # Workers have CPU pools of their own, daemonic processes can't have children
+        process = self.context.Process(
+            target=worker_main, args=(worker_id, os.getpid(), self.processes), name=f"analysis-worker-{worker_id}"
+        )
+        process.start()
+        self.workers[worker_id] = process
+        logger.debug(f"Started worker {worker_id} with pid {process.pid}")
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Failed to check the analysis workers")
+
+    async def check(self) -> List[str]:
+        """Restart dead workers and retry their jobs, returns the ids of the dead workers"""
+        dead = [worker_id for worker_id, process in self.workers.items() if not process.is_alive()]
+        for worker_id in dead:
+            process = self.workers.pop(worker_id)
+            expired = await executor.run_io(self.store.expire, worker_id)
+            logger.warning(
+                f"Worker {worker_id} died with exit code {process.exitcode}, retrying its {expired} jobs"
+            )
+            self._spawn()
+        if dead:
+            # Workspaces of the dead workers
+            await executor.run_io(get_workspace_manager().sweep)
+        await executor.run_io(self.store.purge)
+        return dead
+
+    async def stop(self) -> None:
+        """Stop the workers, their running jobs go back to the queue"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for process in self.workers.values():
+            process.terminate()
+        for worker_id, process in self.workers.items():
+            await executor.run_io(process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"Worker {worker_id} did not stop, killing it")
+                process.kill()
+                await executor.run_io(self.store.expire, worker_id)
+        self.workers.clear()
+
+
+_worker_pool: Optional[WorkerPool] = None
+
+
+def get_worker_pool() -> WorkerPool:
+    """Worker processes of the API process"""
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = WorkerPool()
+    return _worker_pool
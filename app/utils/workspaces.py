@@ -0,0 +1,164 @@
+"""
+Per-job workspaces.
+
+Every analysis clones into its own directory under WORKSPACE_ROOT, so repositories sharing a name
+never collide. Set WORKSPACE_TMPFS=1 to put the root on /dev/shm and keep clones in memory.
+
+The WORKSPACE_QUOTA_BYTES quota of a job is enforced softly. Mirror clones (the default strategy)
+measure the commit in the mirror and are rejected before anything is written to the workspace.
+The other strategies fetch straight into it, so their usage is only checked once the clone is
+done and a big repository fills the disk or memory for the duration of the clone.
+
+A workspace holds an owner file with the pid of the process using it. Released workspaces are
+renamed into a trash directory, which is instant, and deleted on the I/O pool so the client does
+not wait for it. On startup, workspaces whose owner is gone (the process crashed or was killed)
+and leftovers of the trash are removed.
+"""
+
+import logging
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Set
+
+from utils import executor
+from utils.analysis.mirrors import RepositoryTooLarge, directory_size
+
+logger = logging.getLogger(__name__)
+
+WORKSPACE_TMPFS: bool = os.getenv("WORKSPACE_TMPFS", "0").lower() in ("1", "true", "yes", "on")
+WORKSPACE_ROOT: str = os.getenv(
+    "WORKSPACE_ROOT",
+    "/dev/shm/git-repo-data" if WORKSPACE_TMPFS and os.path.isdir("/dev/shm") else "workspaces",
+)
+# Disk space a single job may use, bigger repositories are rejected
+WORKSPACE_QUOTA_BYTES: int = int(os.getenv("WORKSPACE_QUOTA_BYTES", 2 * 1024 * 1024 * 1024))
+
+OWNER_FILE = "owner.pid"
+# A workspace without owner file may be in creation by another process for this long
+OWNERLESS_GRACE_SECONDS = 60
+TRASH_DIR = ".trash"
+
+
+class WorkspaceQuotaExceeded(RepositoryTooLarge):
+    pass
+
+
+@dataclass
+class Workspace:
+    path: Path
+    quota_bytes: int
+    # Name of the repository cloned into it
+    name: str
+
+    @property
+    def clone_dir(self) -> Path:
+        """Directory the repository is cloned into, next to the owner file"""
+        return self.path / "repository"
+
+    def client_path(self, path: str) -> str:
+        """`<repository name>/<path in the repository>` of a file of the clone, as sent to clients
+
+        Paths under the workspace stay internal, they differ on every run.
+        """
+        return f"{self.name}/{Path(os.path.relpath(path, self.clone_dir)).as_posix()}"
+
+    def usage(self) -> int:
+        return directory_size(self.path)
+
+    def check_quota(self) -> int:
+        """Raise WorkspaceQuotaExceeded when the workspace uses more than its quota, returns its usage"""
+        usage = self.usage()
+        if usage > self.quota_bytes:
+            raise WorkspaceQuotaExceeded(
+                f"Repository uses {usage} bytes, more than the {self.quota_bytes} bytes allowed"
+            )
+        return usage
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process of another user
+        return True
+    return True
+
+
+class WorkspaceManager:
+    def __init__(self, root: str = WORKSPACE_ROOT, quota_bytes: int = WORKSPACE_QUOTA_BYTES) -> None:
+        self.root = Path(root)
+        self.quota_bytes = quota_bytes
+        self.trash = self.root / TRASH_DIR
+        self.trash.mkdir(parents=True, exist_ok=True)
+        # Workspaces of this process which were not released yet
+        self.active: Set[Path] = set()
+
+    def create(self, name: str) -> Workspace:
+        """New workspace, `name` only makes the directory easier to recognise"""
+        path = self.root / f"{name}-{uuid.uuid4().hex[:12]}"
+        path.mkdir(parents=True)
+        (path / OWNER_FILE).write_text(str(os.getpid()))
+        self.active.add(path)
+        logger.debug(f"Created workspace {path}")
+        return Workspace(path=path, quota_bytes=self.quota_bytes, name=name)
+
+    def release(self, workspace: Workspace) -> None:
+        """Move the workspace to the trash and delete it in the background"""
+        self.active.discard(workspace.path)
+        self._discard(workspace.path)
+
+    def _discard(self, path: Path) -> None:
+        trashed = self.trash / path.name
+        try:
+            path.rename(trashed)
+        except FileNotFoundError:
+            return
+        executor.get_io_pool().submit(self._delete, trashed)
+
+    @staticmethod
+    def _delete(path: Path) -> None:
+        shutil.rmtree(path, ignore_errors=True)
+        logger.debug(f"Deleted workspace {path.name}")
+
+    def _owner(self, path: Path) -> Optional[int]:
+        try:
+            return int((path / OWNER_FILE).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def sweep(self) -> int:
+        """Remove workspaces left behind by dead processes, returns how many were found"""
+        for path in self.trash.iterdir():
+            executor.get_io_pool().submit(self._delete, path)
+        orphans = 0
+        for path in self.root.iterdir():
+            if path == self.trash or path in self.active or not path.is_dir():
+                continue
+            owner = self._owner(path)
+            if owner is None and time.time() - path.stat().st_mtime < OWNERLESS_GRACE_SECONDS:
+                continue
+            # Other workspaces with our pid were left by a previous process which had the same pid
+            if owner is not None and owner != os.getpid() and process_alive(owner):
+                continue
+            self._discard(path)
+            orphans += 1
+        if orphans:
+            logger.info(f"Removing {orphans} orphaned workspaces")
+        return orphans
+
+
+_workspace_manager: Optional[WorkspaceManager] = None
+
+
+def get_workspace_manager() -> WorkspaceManager:
+    """Workspace manager shared by every analysis of the process"""
+    global _workspace_manager
+    if _workspace_manager is None:
+        _workspace_manager = WorkspaceManager()
+    return _workspace_manager
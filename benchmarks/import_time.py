@@ -0,0 +1,71 @@
+"""
+Measure the import cost of the app and of the modules CPU workers load.
+
+Each module is imported in a fresh interpreter with `-X importtime`, run from app/ like the
+service. Prints the total import time and the slowest top-level imports, or JSON with --json.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --json main utils.analysis.scanner
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+DEFAULT_MODULES = ["main", "utils.analysis.scanner", "utils.analysis.files_analyser"]
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def measure(module: str, top: int) -> Dict:
+    """Import `module` in a new interpreter, returns timings in milliseconds"""
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=APP_DIR,
+        capture_output=True,
+        text=True,
+    )
+    wall_time = (time.perf_counter() - start) * 1000
+    imports: List[Dict] = []
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        # Nested imports are indented, their time is included in their parent
+        if match and not match.group(3):
+            imports.append({"module": match.group(4), "cumulativeMs": int(match.group(2)) / 1000})
+    imports.sort(key=lambda entry: entry["cumulativeMs"], reverse=True)
+    return {
+        "module": module,
+        "ok": process.returncode == 0,
+        "error": process.stderr.strip().splitlines()[-1] if process.returncode else None,
+        "wallMs": round(wall_time, 1),
+        "importMs": round(sum(entry["cumulativeMs"] for entry in imports), 1),
+        "slowest": imports[:top],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to show")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = [measure(module, args.top) for module in args.modules]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        status = "" if result["ok"] else f" (failed: {result['error']})"
+        print(f"{result['module']}: {result['importMs']} ms imports, {result['wallMs']} ms wall{status}")
+        for entry in result["slowest"]:
+            print(f"    {entry['cumulativeMs']:>9.1f} ms  {entry['module']}")
+
+
+if __name__ == "__main__":
+    main()
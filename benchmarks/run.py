@@ -0,0 +1,299 @@
+"""
+Offline end-to-end benchmark of the analysis.
+
+Generates a synthetic repository, starts the stub OpenAI/supabase server and measures:
+- clone: analysis.clone_repo
+- scan: analysis.get_simple_repository_analysis
+- ws: the whole /ws/repositories/analysis flow, through the FastAPI test client
+
+Each stage runs --iterations times. The first iteration is reported separately as cold, later
+ones hit the mirror, analysis and audit caches. Stored reports are only replayed with
+--report-cache, otherwise every ws iteration runs the whole analysis. Results (p50/p95 latency, throughput, peak RSS)
+are printed and saved as JSON so versions can be compared.
+
+Nothing leaves the machine: the synthetic repository is served under https://github.com/bench/
+through git's url.<base>.insteadOf, every store lives in a temporary directory.
+
+    python benchmarks/run.py --files 2000 --iterations 5 --latency 0.5 --output results.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+APP_DIR = os.path.join(ROOT_DIR, "app")
+sys.path[:0] = [APP_DIR, BENCHMARKS_DIR]
+
+from stub_server import StubConfig, StubServer  # noqa: E402
+from synthetic_repo import RepoShape, generate_repository, parse_mix  # noqa: E402
+
+JWT_SECRET = "benchmark-secret"
+REPOSITORY_NAME = "synthetic"
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def peak_rss_kb() -> Dict[str, int]:
+    """Peak resident memory of this process and of its waited-for children (git, workers)"""
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def summarize(durations: List[float], units: Optional[Dict[str, float]] = None) -> dict:
+    """Latency percentiles of a stage in milliseconds and throughput of its median run
+
+    `units` are the amounts processed by one run, like {"files": 2000}.
+    """
+    warm = durations[1:] or durations
+    p50 = percentile(warm, 50)
+    return {
+        "iterations": len(durations),
+        "coldMs": round(durations[0] * 1000, 2),
+        "p50Ms": round(p50 * 1000, 2),
+        "p95Ms": round(percentile(warm, 95) * 1000, 2),
+        "meanMs": round(sum(warm) / len(warm) * 1000, 2),
+        "throughput": {
+            f"{unit}PerSecond": round(amount / p50, 2) if p50 > 0 else None
+            for unit, amount in (units or {}).items()
+        },
+        "peakRssKb": peak_rss_kb(),
+    }
+
+
+def configure_environment(work_dir: str, repos_dir: str, stub_url: str, report_cache: bool) -> None:
+    """Point the app at the stub server and temporary stores, must run before importing it"""
+    import jwt
+
+    os.environ.update(
+        {
+            "OPENAI_API_KEY": "stub",
+            "OPENAI_BASE_URL": f"{stub_url}/v1",
+            # The stub is not rate limited, the scheduler should not throttle it
+            "OPENAI_RPM": os.getenv("OPENAI_RPM", "1000000"),
+            "OPENAI_TPM": os.getenv("OPENAI_TPM", "1000000000"),
+            "SUPABASE_URL": stub_url,
+            # The supabase client only accepts keys shaped like JWTs
+            "SUPABASE_KEY": jwt.encode({"role": "service_role"}, JWT_SECRET, algorithm="HS256"),
+            "SUPABASE_JWT_SECRET": JWT_SECRET,
+            "WORKSPACE_ROOT": os.path.join(work_dir, "workspaces"),
+            "MIRROR_CACHE_DIR": os.path.join(work_dir, "mirrors"),
+            "ANALYSIS_CACHE_PATH": os.path.join(work_dir, "analysis_cache.db"),
+            "AUDIT_DB_PATH": os.path.join(work_dir, "audits.db"),
+            "OUTBOX_DB_PATH": os.path.join(work_dir, "file_data.db"),
+            "REPORT_CACHE_PATH": os.path.join(work_dir, "report_cache.db"),
+            "JOB_STORE_PATH": os.path.join(work_dir, "jobs.db"),
+            # Logs hold the tokens of the run, they stay in the temporary directory
+            "LOG_FILE": os.path.join(work_dir, "app.log"),
+            "REPORT_CACHE_MAX_AGE_HOURS": "24" if report_cache else "0",
+            "OUTBOX_FLUSH_INTERVAL": "0.2",
+            # Serve the synthetic repositories as GitHub ones
+            "GIT_CONFIG_COUNT": "1",
+            "GIT_CONFIG_KEY_0": f"url.file://{repos_dir}/.insteadOf",
+            "GIT_CONFIG_VALUE_0": "https://github.com/bench/",
+        }
+    )
+
+
+def timed(run: Callable[[int], None], iterations: int) -> List[float]:
+    durations = []
+    for iteration in range(iterations):
+        start = time.perf_counter()
+        run(iteration)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_clone(analysis, repository_url: str, work_dir: str, iterations: int, strategy: Optional[str]) -> List[float]:
+    def run(iteration: int) -> None:
+        clone_dir = os.path.join(work_dir, f"clone-{iteration}")
+        if strategy is None:
+            analysis.clone_repo(repository_url, clone_dir)
+        else:
+            analysis.clone_repo(repository_url, clone_dir, strategy=strategy)
+        shutil.rmtree(clone_dir, ignore_errors=True)
+
+    return timed(run, iterations)
+
+
+def bench_scan(analysis, repository_path: str, iterations: int) -> List[float]:
+    return timed(lambda iteration: analysis.get_simple_repository_analysis(repository_path), iterations)
+
+
+def bench_ws(app, repository_url: str, iterations: int) -> Dict[str, List[float]]:
+    """Run the websocket analysis, returns the durations of its milestones"""
+    import jwt
+    from fastapi.testclient import TestClient
+    from starlette.websockets import WebSocketDisconnect
+
+    token = jwt.encode({"sub": "benchmark", "aud": "authenticated"}, JWT_SECRET, algorithm="HS256")
+    milestones: Dict[str, List[float]] = {
+        "total": [],
+        "cloned": [],
+        "scanned": [],
+        "firstResult": [],
+        "review": [],
+    }
+    analysed_files: List[int] = []
+    with TestClient(app) as client:
+        for _ in range(iterations):
+            reached: Dict[str, float] = {}
+            results = 0
+            start = time.perf_counter()
+            with client.websocket_connect("/ws/repositories/analysis") as websocket:
+                websocket.send_json(
+                    {"repositoryURL": repository_url, "auditType": "security", "token": token}
+                )
+                while True:
+                    try:
+                        message = websocket.receive_json()
+                    except WebSocketDisconnect:
+                        break
+                    elapsed = time.perf_counter() - start
+                    if message["status"] == "error":
+                        raise RuntimeError(f"Analysis failed: {message['message']}")
+                    if message["stepName"] == "cloning" and message["status"] == "success":
+                        reached.setdefault("cloned", elapsed)
+                    kind = message.get("type")
+                    if kind == "repositoryScan":
+                        reached["scanned"] = elapsed
+                    elif kind == "sensitiveFiles":
+                        reached["reviewStart"] = elapsed
+                    elif kind == "inDepthAnalysis":
+                        reached.setdefault("firstResult", elapsed)
+                        results += 1
+                    elif message["message"] == "In depth analysis finished":
+                        reached["reviewEnd"] = elapsed
+            reached["total"] = time.perf_counter() - start
+            reached["review"] = reached.get("reviewEnd", reached["total"]) - reached.get("reviewStart", 0.0)
+            for name in milestones:
+                milestones[name].append(reached.get(name, reached["total"]))
+            analysed_files.append(results)
+    milestones["analysedFiles"] = analysed_files
+    return milestones
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=RepoShape.files)
+    parser.add_argument("--median-lines", type=int, default=RepoShape.median_lines)
+    parser.add_argument("--sigma", type=float, default=RepoShape.sigma)
+    parser.add_argument("--mix", type=parse_mix, default=None, help="languages and weights, Python=3,Go=1")
+    parser.add_argument("--seed", type=int, default=RepoShape.seed)
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--stages", default="clone,scan,ws", help="stages to run, comma separated")
+    parser.add_argument("--clone-strategy", default=None, help="clone strategy, CLONE_STRATEGY by default")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean latency of the stub LLM in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--output", default=None, help="JSON file to write, benchmarks/results/ by default")
+    parser.add_argument("--report-cache", action="store_true", help="replay stored reports in warm ws iterations")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    args = parser.parse_args()
+    stages = args.stages.split(",")
+    # Resolved before moving to the app directory
+    output = os.path.abspath(args.output) if args.output else None
+
+    shape = RepoShape(files=args.files, median_lines=args.median_lines, sigma=args.sigma, seed=args.seed)
+    if args.mix is not None:
+        shape.mix = args.mix
+
+    work_dir = tempfile.mkdtemp(prefix="git-repo-data-bench-")
+    repos_dir = os.path.join(work_dir, "repos")
+    repository_path = os.path.join(repos_dir, REPOSITORY_NAME)
+    stub = StubServer(StubConfig(args.latency, args.jitter, args.rate_limit_ratio)).start()
+    configure_environment(work_dir, repos_dir, stub.url, args.report_cache)
+    # The app runs from its own directory
+    os.chdir(APP_DIR)
+    try:
+        print(f"Generating {shape.files} files in {repository_path}")
+        repository = generate_repository(repository_path, shape)
+        units = {"files": repository["files"], "lines": repository["lines"]}
+
+        from utils import analysis, executor
+
+        results: Dict[str, dict] = {}
+        if "clone" in stages:
+            durations = bench_clone(
+                analysis, f"https://github.com/bench/{REPOSITORY_NAME}", work_dir, args.iterations, args.clone_strategy
+            )
+            results["clone"] = summarize(durations, {"bytes": repository["bytes"], **units})
+        if "scan" in stages:
+            results["scan"] = summarize(bench_scan(analysis, repository_path, args.iterations), units)
+        if "ws" in stages:
+            from main import app
+
+            milestones = bench_ws(app, f"github.com/bench/{REPOSITORY_NAME}", args.iterations)
+            analysed_files = milestones.pop("analysedFiles")
+            for name, durations in milestones.items():
+                stage_units = {"files": analysed_files[-1]} if name == "review" else {}
+                results[f"ws.{name}"] = summarize(durations, stage_units)
+        executor.shutdown(wait=True)
+
+        report = {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {
+                "iterations": args.iterations,
+                "cloneStrategy": args.clone_strategy or os.getenv("CLONE_STRATEGY", "mirror"),
+                "latency": args.latency,
+                "jitter": args.jitter,
+                "rateLimitRatio": args.rate_limit_ratio,
+                "reportCache": args.report_cache,
+                "shape": shape.as_dict(),
+            },
+            "repository": repository,
+            "stages": results,
+            "stub": stub.config.stats,
+            "peakRssKb": peak_rss_kb(),
+        }
+    finally:
+        stub.stop()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for name, summary in results.items():
+        throughput = ", ".join(f"{value} {unit}" for unit, value in summary["throughput"].items())
+        print(
+            f"{name:>16}: cold {summary['coldMs']} ms, p50 {summary['p50Ms']} ms, "
+            f"p95 {summary['p95Ms']} ms{', ' + throughput if throughput else ''}"
+        )
+    output = output or os.path.join(
+        BENCHMARKS_DIR, "results", f"{(report['revision'] or 'unknown')[:8]}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Local stand-in for the OpenAI chat completions API and the supabase REST API.
+
+- POST /v1/chat/completions answers after a configurable latency. Sensitive files requests get
+  every listed file back, in depth requests get one issue on the first line of the code.
+  A share of requests can be answered with 429 to exercise rate limiting.
+- PATCH /rest/v1/<table> accepts every update.
+- GET /stats returns the number of requests served.
+
+    python benchmarks/stub_server.py --port 8090 --latency 0.5 --jitter 0.2 --rate-limit-ratio 0.05
+
+then point OPENAI_BASE_URL at http://127.0.0.1:8090/v1 and SUPABASE_URL at http://127.0.0.1:8090.
+"""
+
+import argparse
+import ast
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class StubConfig:
+    def __init__(self, latency: float = 0.2, jitter: float = 0.0, rate_limit_ratio: float = 0.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.lock = threading.Lock()
+        self.stats = {"completions": 0, "rateLimited": 0, "updates": 0}
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.stats[name] += 1
+
+    def delay(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+
+def sensitive_files_answer(messages: list) -> dict:
+    try:
+        files = ast.literal_eval(messages[-1]["content"])
+    except (ValueError, SyntaxError):
+        files = []
+    return {"sensitiveFiles": files}
+
+
+def in_depth_answer(messages: list) -> dict:
+    code = messages[-1]["content"]
+    match = re.search(r"^(\d+)\. ", code, re.MULTILINE)
+    issue = {
+        "lineNumber": int(match.group(1)) if match else 1,
+        "initialCode": "value = compute()",
+        "solvingCode": "value = compute_safely()",
+        "comment": "Synthetic issue",
+        "suggestion": "Nothing to do, this is a benchmark",
+    }
+    path = re.search(r"^### File: (.+)$", code, re.MULTILINE)
+    if path:
+        issue["path"] = path.group(1)
+    return {"issues": [issue]}
+
+
+def make_handler(config: StubConfig):
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args) -> None:
+            pass
+
+        def _send_json(self, status: int, body, headers: Optional[dict] = None) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"null")
+
+        def do_GET(self) -> None:
+            if self.path == "/stats":
+                self._send_json(200, config.stats)
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self) -> None:
+            if not self.path.endswith("/chat/completions"):
+                self._send_json(404, {"error": "not found"})
+                return
+            request = self._read_json()
+            time.sleep(config.delay())
+            if random.random() < config.rate_limit_ratio:
+                config.count("rateLimited")
+                self._send_json(
+                    429,
+                    {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                    {"Retry-After": "0.1"},
+                )
+                return
+            config.count("completions")
+            messages = request["messages"]
+            if "sensitiveFiles" in messages[0]["content"]:
+                answer = sensitive_files_answer(messages)
+            else:
+                answer = in_depth_answer(messages)
+            content = json.dumps(answer)
+            prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+            self._send_json(
+                200,
+                {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "stub"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(content) // 4,
+                        "total_tokens": prompt_tokens + len(content) // 4,
+                    },
+                },
+            )
+
+        def do_PATCH(self) -> None:
+            if not self.path.startswith("/rest/v1/"):
+                self._send_json(404, {"error": "not found"})
+                return
+            self._read_json()
+            config.count("updates")
+            self._send_json(200, [])
+
+    return StubHandler
+
+
+class StubServer:
+    """Stub server running on a background thread"""
+
+    def __init__(self, config: StubConfig, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.config = config
+        self.server = ThreadingHTTPServer((host, port), make_handler(config))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubServer":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.2, help="mean latency of completions in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="standard deviation of the latency")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of completions answered with 429")
+    args = parser.parse_args()
+    server = StubServer(StubConfig(args.latency, args.jitter, args.rate_limit_ratio), args.host, args.port)
+    print(f"Stub server listening on {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Generate synthetic git repositories to benchmark the analysis.
+
+Files are spread over a directory tree, their languages follow a mix of languages of
+supported_extensions.csv (each language uses its first extension), their number of lines follows
+a log-normal distribution. A share of files is not source code (docs, data). Generation is
+deterministic for a given seed.
+
+    python benchmarks/synthetic_repo.py /tmp/repos/medium --files 2000 --mix Python=3,JavaScript=2,Go=1
+"""
+
+import argparse
+import csv
+import math
+import os
+import random
+import subprocess
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+SUPPORTED_EXTENSIONS_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "app",
+    "utils",
+    "analysis",
+    "config",
+    "supported_extensions.csv",
+)
+OTHER_EXTENSIONS = [".md", ".json", ".txt", ".yml"]
+
+
+@dataclass
+class RepoShape:
+    files: int = 500
+    # Log-normal distribution of the number of lines of a file
+    median_lines: int = 80
+    sigma: float = 1.0
+    max_lines: int = 20000
+    # Relative weight of each language
+    mix: Dict[str, float] = field(default_factory=lambda: {"Python": 3, "JavaScript": 2, "Go": 1})
+    # Share of files which are not source code
+    other_ratio: float = 0.1
+    files_per_directory: int = 20
+    depth: int = 4
+    seed: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "files": self.files,
+            "medianLines": self.median_lines,
+            "sigma": self.sigma,
+            "maxLines": self.max_lines,
+            "mix": self.mix,
+            "otherRatio": self.other_ratio,
+            "filesPerDirectory": self.files_per_directory,
+            "depth": self.depth,
+            "seed": self.seed,
+        }
+
+
+def language_extensions(path: str = SUPPORTED_EXTENSIONS_PATH) -> Dict[str, str]:
+    """First extension of each language"""
+    extensions: Dict[str, str] = {}
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            extensions.setdefault(row["name"], row["extension"])
+    return extensions
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """Parse `Python=3,JavaScript=2`"""
+    mix = {}
+    for entry in value.split(","):
+        language, _, weight = entry.partition("=")
+        mix[language.strip()] = float(weight or 1)
+    return mix
+
+
+def file_lines(rng: random.Random, shape: RepoShape) -> int:
+    lines = int(rng.lognormvariate(math.log(shape.median_lines), shape.sigma))
+    return max(1, min(shape.max_lines, lines))
+
+
+def file_content(rng: random.Random, number_of_lines: int) -> str:
+    lines = []
+    for number in range(number_of_lines):
+        kind = rng.random()
+        if kind < 0.1:
+            lines.append("")
+        elif kind < 0.2:
+            lines.append(f"// note {number}: {'x' * rng.randint(10, 100)}")
+        else:
+            lines.append(f"    value_{number} = compute({number}, {rng.randint(0, 10**6)})")
+    return "\n".join(lines) + "\n"
+
+
+def directory_for(index: int, shape: RepoShape) -> str:
+    """Spread files over a tree of at most `shape.depth` levels"""
+    parts = []
+    directory = index // shape.files_per_directory
+    for level in range(shape.depth):
+        if directory == 0:
+            break
+        parts.append(f"dir{level}_{directory % shape.files_per_directory}")
+        directory //= shape.files_per_directory
+    return os.path.join(*parts) if parts else ""
+
+
+def generate_repository(path: str, shape: RepoShape) -> dict:
+    """Create a git repository with one commit at `path`, returns what was generated"""
+    rng = random.Random(shape.seed)
+    extensions = language_extensions()
+    unknown = [language for language in shape.mix if language not in extensions]
+    if unknown:
+        raise ValueError(f"Unsupported languages: {unknown}")
+    languages: List[str] = list(shape.mix)
+    weights = [shape.mix[language] for language in languages]
+
+    os.makedirs(path, exist_ok=True)
+    total_lines = 0
+    total_bytes = 0
+    for index in range(shape.files):
+        if rng.random() < shape.other_ratio:
+            extension = rng.choice(OTHER_EXTENSIONS)
+        else:
+            extension = extensions[rng.choices(languages, weights)[0]]
+        directory = os.path.join(path, directory_for(index, shape))
+        os.makedirs(directory, exist_ok=True)
+        number_of_lines = file_lines(rng, shape)
+        content = file_content(rng, number_of_lines)
+        with open(os.path.join(directory, f"file{index}{extension}"), "w") as file:
+            file.write(content)
+        total_lines += number_of_lines
+        total_bytes += len(content)
+
+    git = ["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com"]
+    subprocess.run([*git, "init", "-q", "-b", "main"], cwd=path, check=True)
+    subprocess.run([*git, "add", "-A"], cwd=path, check=True)
+    subprocess.run([*git, "commit", "-q", "-m", "Synthetic repository"], cwd=path, check=True)
+    return {"files": shape.files, "lines": total_lines, "bytes": total_bytes}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--files", type=int, default=RepoShape.files)
+    parser.add_argument("--median-lines", type=int, default=RepoShape.median_lines)
+    parser.add_argument("--sigma", type=float, default=RepoShape.sigma)
+    parser.add_argument("--max-lines", type=int, default=RepoShape.max_lines)
+    parser.add_argument("--mix", type=parse_mix, default=None, help="languages and weights, Python=3,Go=1")
+    parser.add_argument("--other-ratio", type=float, default=RepoShape.other_ratio)
+    parser.add_argument("--seed", type=int, default=RepoShape.seed)
+    args = parser.parse_args()
+    shape = RepoShape(
+        files=args.files,
+        median_lines=args.median_lines,
+        sigma=args.sigma,
+        max_lines=args.max_lines,
+        other_ratio=args.other_ratio,
+        seed=args.seed,
+    )
+    if args.mix is not None:
+        shape.mix = args.mix
+    print(generate_repository(args.path, shape))
+
+
+if __name__ == "__main__":
+    main()
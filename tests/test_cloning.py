@@ -0,0 +1,170 @@
+import os
+from pathlib import Path
+
+import pytest
+from git import Actor, Repo
+
+from utils.analysis.cloning import clone_with_strategy, resolve_head
+from utils.analysis.mirrors import MirrorCache, RepositoryTooLarge, tree_size
+
+AUTHOR = Actor("Test", "test@example.com")
+
+
+def commit_files(repo: Repo, files: dict, message: str) -> str:
+    for path, content in files.items():
+        file_path = Path(repo.working_tree_dir) / path
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(content)
+    repo.index.add(list(files))
+    return repo.index.commit(message, author=AUTHOR, committer=AUTHOR).hexsha
+
+
+@pytest.fixture
+def work_repo(tmp_path):
+    repo = Repo.init(tmp_path / "work")
+    commit_files(repo, {"app.py": "print('first')\n"}, "first")
+    commit_files(repo, {"app.py": "print('second')\n", "lib/util.py": "x = 1\n", "notes.txt": "notes\n"}, "second")
+    return repo
+
+
+@pytest.fixture
+def bare_repo(tmp_path, work_repo):
+    """Local bare repository with two commits, cloned through a file:// URL"""
+    path = tmp_path / "remote.git"
+    bare = Repo.clone_from(work_repo.working_tree_dir, path, bare=True)
+    bare.git.config("uploadpack.allowFilter", "true")
+    work_repo.create_remote("remote", str(path))
+    return f"file://{path}"
+
+
+def push(work_repo: Repo, files: dict) -> str:
+    commit = commit_files(work_repo, files, "update")
+    work_repo.git.push("remote", "HEAD")
+    return commit
+
+
+@pytest.mark.parametrize("strategy", ["full", "shallow", "blobless", "sparse"])
+def test_clone_strategies_check_out_head(tmp_path, work_repo, bare_repo, strategy):
+    clone_dir = tmp_path / "clone"
+    report = clone_with_strategy(bare_repo, clone_dir, strategy)
+    assert report.strategy == strategy
+    assert report.commit == work_repo.head.commit.hexsha
+    assert report.bytes_transferred > 0
+    assert (clone_dir / "app.py").read_text() == "print('second')\n"
+    assert (clone_dir / "lib" / "util.py").exists()
+
+
+def test_shallow_clone_has_one_commit(tmp_path, bare_repo):
+    clone_dir = tmp_path / "clone"
+    clone_with_strategy(bare_repo, clone_dir, "shallow")
+    assert Repo(clone_dir).git.rev_list("--count", "HEAD") == "1"
+
+
+def test_sparse_clone_only_checks_out_supported_files(tmp_path, bare_repo):
+    clone_dir = tmp_path / "clone"
+    clone_with_strategy(bare_repo, clone_dir, "sparse")
+    assert (clone_dir / "app.py").exists()
+    assert not (clone_dir / "notes.txt").exists()
+
+
+def test_clone_without_checkout_only_writes_objects(tmp_path, work_repo, bare_repo):
+    clone_dir = tmp_path / "clone"
+    report = clone_with_strategy(bare_repo, clone_dir, "shallow", checkout=False)
+    assert not (clone_dir / "app.py").exists()
+    assert Repo(report.git_dir).head.commit.hexsha == work_repo.head.commit.hexsha
+
+
+def test_blobless_clone_needs_a_checkout(tmp_path, bare_repo):
+    with pytest.raises(ValueError):
+        clone_with_strategy(bare_repo, tmp_path / "clone", "blobless", checkout=False)
+
+
+def test_unknown_strategy(tmp_path, bare_repo):
+    with pytest.raises(ValueError):
+        clone_with_strategy(bare_repo, tmp_path / "clone", "rsync")
+
+
+def test_resolve_head(work_repo, bare_repo):
+    assert resolve_head(bare_repo) == work_repo.head.commit.hexsha
+
+
+def test_mirror_checkout_writes_head_without_git_dir(tmp_path, work_repo, bare_repo):
+    cache = MirrorCache(str(tmp_path / "mirrors"))
+    received, commit = cache.checkout(bare_repo, tmp_path / "checkout")
+    assert commit == work_repo.head.commit.hexsha
+    assert received > 0
+    assert (tmp_path / "checkout" / "lib" / "util.py").read_text() == "x = 1\n"
+    assert not (tmp_path / "checkout" / ".git").exists()
+    assert cache.mirror_path(bare_repo).is_dir()
+
+
+def test_mirror_checkout_writes_files_like_a_clone(tmp_path, work_repo, bare_repo):
+    work_dir = Path(work_repo.working_tree_dir)
+    (work_dir / "link").symlink_to("/etc/hostname")
+    work_repo.git.add("link")
+    push(
+        work_repo,
+        {
+            ".gitattributes": "tests/ export-ignore\nversion.txt export-subst\n",
+            "tests/test_app.py": "assert True\n",
+            "version.txt": "$Format:%H$\n",
+        },
+    )
+    cache = MirrorCache(str(tmp_path / "mirrors"))
+    cache.checkout(bare_repo, tmp_path / "checkout")
+    checkout = tmp_path / "checkout"
+    assert (checkout / "tests" / "test_app.py").exists()
+    assert (checkout / "version.txt").read_text() == "$Format:%H$\n"
+    assert os.readlink(checkout / "link") == "/etc/hostname"
+    # The checkout has its own index, the mirror has none
+    assert not (cache.mirror_path(bare_repo) / "index").exists()
+
+
+def test_mirror_is_fetched_incrementally(tmp_path, work_repo, bare_repo):
+    cache = MirrorCache(str(tmp_path / "mirrors"))
+    cache.checkout(bare_repo, tmp_path / "first")
+    commit = push(work_repo, {"app.py": "print('third')\n"})
+    _, checked_out = cache.checkout(bare_repo, tmp_path / "second")
+    assert checked_out == commit
+    assert (tmp_path / "second" / "app.py").read_text() == "print('third')\n"
+    # Same mirror for the same repository written differently
+    assert cache.mirror_path(bare_repo + "/") == cache.mirror_path(bare_repo)
+
+
+def test_mirror_clone_without_checkout(tmp_path, work_repo, bare_repo):
+    cache = MirrorCache(str(tmp_path / "mirrors"))
+    cache.clone(bare_repo, tmp_path / "clone")
+    assert Repo(tmp_path / "clone").head.commit.hexsha == work_repo.head.commit.hexsha
+    assert not (tmp_path / "clone" / "app.py").exists()
+
+
+def test_mirror_rejects_repositories_over_the_quota(tmp_path, work_repo, bare_repo):
+    cache = MirrorCache(str(tmp_path / "mirrors"))
+    push(work_repo, {"big.txt": "x" * 100_000})
+    with pytest.raises(RepositoryTooLarge):
+        cache.checkout(bare_repo, tmp_path / "checkout", max_bytes=50_000)
+    assert not (tmp_path / "checkout").exists()
+    with pytest.raises(RepositoryTooLarge):
+        cache.clone(bare_repo, tmp_path / "clone", max_bytes=1_000)
+    assert not (tmp_path / "clone").exists()
+    cache.checkout(bare_repo, tmp_path / "checkout", max_bytes=200_000)
+    assert (tmp_path / "checkout" / "big.txt").exists()
+
+
+def test_tree_size_sums_the_files_of_the_commit(bare_repo, tmp_path):
+    cache = MirrorCache(str(tmp_path / "mirrors"))
+    cache.update(bare_repo)
+    repo = Repo(cache.mirror_path(bare_repo))
+    expected = len("print('second')\n") + len("x = 1\n") + len("notes\n")
+    assert tree_size(repo, "HEAD") == expected
+
+
+def test_mirror_eviction_keeps_the_cache_in_budget(tmp_path, bare_repo, work_repo):
+    other_path = tmp_path / "other.git"
+    Repo.clone_from(work_repo.working_tree_dir, other_path, bare=True)
+    cache = MirrorCache(str(tmp_path / "mirrors"), max_bytes=1)
+    cache.update(bare_repo)
+    cache.update(f"file://{other_path}")
+    cache.evict(keep=cache.mirror_path(f"file://{other_path}"))
+    assert not cache.mirror_path(bare_repo).exists()
+    assert cache.mirror_path(f"file://{other_path}").exists()
@@ -0,0 +1,223 @@
+import asyncio
+import time
+
+import pytest
+
+from utils import workers
+from utils.analysis import ratelimit
+from utils.job_store import JobRelay, JobStore
+from utils.jobs import JobRegistry
+from utils.outbox import OffersOutbox, OffersWriter
+from utils.workers import Worker
+
+KEY = ("https://github.com/a/b", "0" * 40, "security")
+PARAMS = {"repository_url": "https://github.com/a/b", "commit": "0" * 40, "audit_type": "security", "offer_url": "a/b"}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.db"), max_attempts=2)
+
+
+@pytest.fixture
+def analysis(tmp_path, monkeypatch):
+    """Replace the analysis run by workers, which send their offer updates to a local outbox"""
+    writer = OffersWriter(OffersOutbox(str(tmp_path / "outbox.db")), lambda url, values: None)
+    monkeypatch.setattr(workers, "get_offers_writer", lambda: writer)
+
+    def replace(run):
+        monkeypatch.setattr(workers, "replay_or_run_repository_analysis", run)
+
+    return replace
+
+
+def messages(store, job_id):
+    return [message for _, _, message in store.events_after({job_id: 0}).get(job_id, [])]
+
+
+def test_a_key_has_one_active_job(store):
+    job_id, queued = store.enqueue(KEY, PARAMS)
+    assert queued
+    assert store.enqueue(KEY, PARAMS) == (job_id, False)
+    store.claim("w1")
+    assert store.enqueue(KEY, PARAMS) == (job_id, False)
+    store.finish(job_id, "w1", failed=False)
+    assert store.enqueue(KEY, PARAMS)[1]
+
+
+def test_a_running_job_is_not_claimed_twice(store):
+    job_id, _ = store.enqueue(KEY, PARAMS)
+    job = store.claim("w1", lease_seconds=30)
+    assert (job.id, job.state, job.attempts, job.params) == (job_id, "running", 1, PARAMS)
+    assert store.claim("w2") is None
+
+
+def test_an_expired_lease_is_claimed_again(store):
+    job_id, _ = store.enqueue(KEY, PARAMS)
+    store.claim("w1", lease_seconds=0.05)
+    time.sleep(0.06)
+    job = store.claim("w2", lease_seconds=30)
+    assert (job.id, job.attempts) == (job_id, 2)
+    # The first worker lost the job, its messages and renewals are refused
+    assert not store.renew(job_id, "w1")
+    assert not store.append_events(job_id, "w1", [{"message": "late"}])
+    assert not store.finish(job_id, "w1", failed=False)
+    assert store.renew(job_id, "w2")
+
+
+def test_renewed_leases_dont_expire(store):
+    store.enqueue(KEY, PARAMS)
+    job = store.claim("w1", lease_seconds=0.1)
+    for _ in range(3):
+        time.sleep(0.05)
+        assert store.renew(job.id, "w1", lease_seconds=0.1)
+    assert store.claim("w2") is None
+
+
+def test_expire_retries_the_jobs_of_a_dead_worker_at_once(store):
+    store.enqueue(KEY, PARAMS)
+    job = store.claim("w1", lease_seconds=30)
+    assert store.expire("w1") == 1
+    assert store.claim("w2").id == job.id
+
+
+def test_released_jobs_dont_use_an_attempt(store):
+    store.enqueue(KEY, PARAMS)
+    job = store.claim("w1")
+    store.release(job.id, "w1")
+    assert store.claim("w2").attempts == 1
+
+
+def test_jobs_fail_after_max_attempts(store):
+    job_id, _ = store.enqueue(KEY, PARAMS)
+    for worker_id in ("w1", "w2"):
+        store.claim(worker_id, lease_seconds=0.01)
+        time.sleep(0.02)
+    assert store.claim("w3") is None
+    assert store.count("failed") == 1
+    *_, error, end = messages(store, job_id)
+    assert error["status"] == "error"
+    assert end is None
+
+
+def test_only_the_last_run_is_replayed(store):
+    job_id, _ = store.enqueue(KEY, PARAMS)
+    store.claim("w1", lease_seconds=0.01)
+    store.append_events(job_id, "w1", [{"message": "scan"}, {"message": "result"}])
+    time.sleep(0.02)
+    store.claim("w2")
+    store.append_events(job_id, "w2", [{"message": "restart"}, {"message": "scan again"}])
+    events = store.events_after({job_id: 0})[job_id]
+    # Sequences keep increasing across runs, clients resume after the last one they received
+    assert [(seq, message["message"]) for seq, _, message in events] == [(3, "restart"), (4, "scan again")]
+
+
+def test_relay_forgets_the_interrupted_run(store):
+    async def main():
+        registry = JobRegistry()
+        relay = JobRelay(store, registry, interval=0.01)
+        job, queued = await relay.start_job(KEY, PARAMS)
+        assert queued
+        store.claim("w1", lease_seconds=0.01)
+        store.append_events(job.id, "w1", [{"message": "scan"}])
+        await relay.poll()
+        await asyncio.sleep(0.02)
+        store.claim("w2")
+        store.append_events(job.id, "w2", [{"message": "scan again"}])
+        store.finish(job.id, "w2", failed=False)
+        await relay.poll()
+        await relay.stop()
+        return job
+
+    job = asyncio.run(main())
+    assert job.finished
+    assert [(event_id, message["message"]) for event_id, message in job.history] == [(2, "scan again")]
+    late = job.subscribe()
+    assert late.queue.get_nowait() == (2, {"message": "scan again"})
+
+
+def test_purge_removes_finished_jobs_and_their_events(store):
+    job_id, _ = store.enqueue(KEY, PARAMS)
+    store.claim("w1")
+    store.append_events(job_id, "w1", [{"message": "scan"}])
+    store.finish(job_id, "w1", failed=False)
+    assert store.purge(max_age=60) == 0
+    assert store.purge(max_age=-1) == 1
+    assert store.find(job_id) is None
+    assert messages(store, job_id) == []
+
+
+def test_worker_runs_and_finishes_jobs(store, analysis):
+    async def run(emitter, **params):
+        await emitter.send(status="success", step_name="cloning", message=params["repository_url"])
+
+    analysis(run)
+    job_id, _ = store.enqueue(KEY, PARAMS)
+
+    async def main():
+        worker = Worker("w1", store, lease_seconds=1)
+        task = asyncio.create_task(worker.run())
+        while store.count("done") == 0:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+    asyncio.run(asyncio.wait_for(main(), 10))
+    assert messages(store, job_id) == [
+        {"status": "success", "step_name": "cloning", "message": PARAMS["repository_url"]},
+        None,
+    ]
+
+
+def test_stopped_worker_puts_its_jobs_back(store, analysis):
+    async def run(emitter, **params):
+        await asyncio.sleep(60)
+
+    analysis(run)
+    job_id, _ = store.enqueue(KEY, PARAMS)
+
+    async def main():
+        worker = Worker("w1", store, lease_seconds=30)
+        task = asyncio.create_task(worker.run())
+        while not worker.running:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+    asyncio.run(asyncio.wait_for(main(), 10))
+    job = store.claim("w2")
+    assert (job.id, job.attempts) == (job_id, 1)
+
+
+def test_worker_stops_a_job_claimed_by_another_worker(store, analysis):
+    async def run(emitter, **params):
+        while True:
+            await emitter.send(status="pending", step_name="reviewing", message="working")
+            await asyncio.sleep(0.01)
+
+    analysis(run)
+    job_id, _ = store.enqueue(KEY, PARAMS)
+
+    async def main():
+        worker = Worker("w1", store, lease_seconds=0.3)
+        task = asyncio.create_task(worker.run())
+        while not worker.running:
+            await asyncio.sleep(0.01)
+        store.expire("w1")
+        assert store.claim("w2", lease_seconds=30).id == job_id
+        while worker.running:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+    asyncio.run(asyncio.wait_for(main(), 10))
+    # Nothing the first worker sent after losing the job belongs to the new run
+    assert messages(store, job_id) == []
+
+
+def test_workers_share_the_openai_limits(monkeypatch):
+    monkeypatch.setattr(ratelimit, "_scheduler", None)
+    scheduler = ratelimit.split_budget(4)
+    assert ratelimit.get_scheduler() is scheduler
+    assert scheduler.requests.capacity == ratelimit.OPENAI_RPM / 4
+    assert scheduler.tokens.capacity == ratelimit.OPENAI_TPM / 4
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from dataclasses import replace
+
+import pytest
+
+from utils.outbox import OffersOutbox, OffersWriter
+
+
+class FakeOffers:
+    """Stand-in for the offers table of supabase, records every update"""
+
+    def __init__(self, failures: int = 0) -> None:
+        self.failures = failures
+        self.updates = []
+        self.on_update = None
+
+    def update(self, url: str, values: dict) -> None:
+        if self.on_update is not None:
+            self.on_update(url, values)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("supabase is down")
+        self.updates.append((url, values))
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return OffersOutbox(str(tmp_path / "outbox.db"))
+
+
+def test_updates_of_an_offer_are_coalesced(outbox):
+    offers = FakeOffers()
+    writer = OffersWriter(outbox, offers.update, interval=0.01)
+
+    async def main():
+        await writer.enqueue("https://github.com/a/b", files_count=1)
+        await writer.enqueue("https://github.com/a/b", lines_count=20)
+        await writer.enqueue("https://github.com/a/b", files_count=3)
+        await writer.enqueue("https://github.com/c/d", files_count=5)
+        return await writer.flush()
+
+    assert asyncio.run(main()) == 2
+    assert sorted(offers.updates) == [
+        ("https://github.com/a/b", {"files_count": 3, "lines_count": 20}),
+        ("https://github.com/c/d", {"files_count": 5}),
+    ]
+    assert len(outbox) == 0
+
+
+def test_entries_updated_while_sent_are_sent_again(outbox):
+    offers = FakeOffers()
+    writer = OffersWriter(outbox, offers.update, interval=0.01)
+
+    def enqueue_once(url, values):
+        offers.on_update = None
+        outbox.enqueue(url, {"lines_count": 40})
+
+    offers.on_update = enqueue_once
+
+    async def main():
+        await writer.enqueue("https://github.com/a/b", files_count=1)
+        await writer.flush()
+        assert len(outbox) == 1
+        await writer.flush()
+
+    asyncio.run(main())
+    assert offers.updates == [
+        ("https://github.com/a/b", {"files_count": 1}),
+        ("https://github.com/a/b", {"files_count": 1, "lines_count": 40}),
+    ]
+    assert len(outbox) == 0
+
+
+def test_failed_updates_are_retried_with_backoff(outbox):
+    offers = FakeOffers(failures=1)
+    writer = OffersWriter(outbox, offers.update, interval=0.05)
+
+    async def main():
+        await writer.enqueue("https://github.com/a/b", files_count=1)
+        assert await writer.flush() == 0
+        # Not due before its retry delay
+        assert outbox.due(10) == []
+        await asyncio.sleep(0.06)
+        return await writer.flush()
+
+    assert asyncio.run(main()) == 1
+    assert offers.updates == [("https://github.com/a/b", {"files_count": 1})]
+    assert len(outbox) == 0
+
+
+def test_retry_delay_doubles_on_every_failure(outbox):
+    outbox.enqueue("https://github.com/a/b", {"files_count": 1})
+    entry = outbox.due(10)[0]
+    for attempts in range(3):
+        before = time.time()
+        outbox.settle([], [replace(entry, attempts=attempts)], retry_delay=10)
+        with outbox._connect() as conn:
+            (next_attempt_at,) = conn.execute("SELECT next_attempt_at FROM offers_outbox").fetchone()
+        assert next_attempt_at == pytest.approx(before + 10 * 2**attempts, abs=1)
+
+
+def test_entries_survive_a_restart(tmp_path):
+    OffersOutbox(str(tmp_path / "outbox.db")).enqueue("https://github.com/a/b", {"files_count": 1})
+    offers = FakeOffers()
+    writer = OffersWriter(OffersOutbox(str(tmp_path / "outbox.db")), offers.update)
+    assert asyncio.run(writer.flush()) == 1
+    assert offers.updates == [("https://github.com/a/b", {"files_count": 1})]
+
+
+def test_flush_sends_every_batch(outbox):
+    offers = FakeOffers()
+    writer = OffersWriter(outbox, offers.update, batch_size=2)
+    for number in range(5):
+        outbox.enqueue(f"https://github.com/a/{number}", {"files_count": number})
+    assert asyncio.run(writer.flush()) == 5
+    assert len(offers.updates) == 5
+
+
+def test_stop_flushes_what_is_left(outbox):
+    offers = FakeOffers()
+    writer = OffersWriter(outbox, offers.update, interval=60)
+
+    async def main():
+        writer.start()
+        await writer.enqueue("https://github.com/a/b", files_count=1)
+        await writer.stop()
+
+    asyncio.run(main())
+    assert offers.updates == [("https://github.com/a/b", {"files_count": 1})]
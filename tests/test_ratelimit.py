@@ -0,0 +1,233 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+
+from utils.analysis import ratelimit
+from utils.analysis.backends import OpenAIBackend
+from utils.analysis.ratelimit import RateLimitedScheduler, TokenBucket
+
+MESSAGES = [{"role": "user", "content": "Find the issues"}]
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    """Chat completions answered with `statuses` in turn, then with 200"""
+
+    def __init__(self, statuses, retry_after=None):
+        super().__init__(("127.0.0.1", 0), FakeOpenAIHandler)
+        self.statuses = list(statuses)
+        self.retry_after = retry_after
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.requests.append(time.monotonic())
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if status == 200:
+            body = {
+                "id": "chatcmpl-test",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-test",
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": '{"issues": []}'}, "finish_reason": "stop"}
+                ],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+            }
+        else:
+            body = {"error": {"message": f"Error {status}", "type": "requests", "code": None}}
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if status == 429 and self.server.retry_after is not None:
+            self.send_header("Retry-After", str(self.server.retry_after))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def fake_openai():
+    """Start a fake OpenAI API answering with the given statuses"""
+    servers = []
+
+    def start(statuses=(), retry_after=None):
+        server = FakeOpenAI(statuses, retry_after)
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(ratelimit, "BACKOFF_BASE", 0.01)
+
+
+def backend(server, scheduler):
+    return OpenAIBackend(model="gpt-test", base_url=server.url, api_key="test", scheduler=scheduler)
+
+
+def test_rate_limited_calls_are_retried(fake_openai):
+    server = fake_openai([429, 429])
+    scheduler = RateLimitedScheduler(max_retries=3, max_concurrency=64)
+    initial_limit = scheduler.concurrency.limit
+    answer = asyncio.run(backend(server, scheduler).acomplete(MESSAGES))
+    assert json.loads(answer) == {"issues": []}
+    assert len(server.requests) == 3
+    # Both 429s came from the same burst, the limit is only halved once then grows on success
+    assert initial_limit / 2 < scheduler.concurrency.limit < initial_limit / 2 + 1
+
+
+def test_calls_fail_after_max_retries(fake_openai):
+    server = fake_openai([429, 429, 429, 429])
+    scheduler = RateLimitedScheduler(max_retries=2)
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(backend(server, scheduler).acomplete(MESSAGES))
+    assert len(server.requests) == 3
+
+
+def test_server_errors_are_retried(fake_openai):
+    server = fake_openai([503])
+    scheduler = RateLimitedScheduler(max_retries=1)
+    asyncio.run(backend(server, scheduler).acomplete(MESSAGES))
+    assert len(server.requests) == 2
+
+
+def test_client_errors_are_not_retried(fake_openai):
+    server = fake_openai([400])
+    scheduler = RateLimitedScheduler(max_retries=3)
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(backend(server, scheduler).acomplete(MESSAGES))
+    assert len(server.requests) == 1
+
+
+def test_retry_after_is_honoured(fake_openai):
+    server = fake_openai([429], retry_after=0.3)
+    scheduler = RateLimitedScheduler(max_retries=1)
+    asyncio.run(backend(server, scheduler).acomplete(MESSAGES))
+    first, second = server.requests
+    assert second - first >= 0.3
+
+
+def test_blocking_calls_are_retried(fake_openai):
+    server = fake_openai([429])
+    scheduler = RateLimitedScheduler(max_retries=1)
+    answer = backend(server, scheduler).complete(MESSAGES)
+    assert json.loads(answer) == {"issues": []}
+    assert len(server.requests) == 2
+
+
+def test_usage_corrects_the_token_reservation(fake_openai):
+    server = fake_openai()
+    scheduler = RateLimitedScheduler(tpm=100_000)
+    llm = backend(server, scheduler)
+    asyncio.run(llm.acomplete(MESSAGES))
+    # The estimate was reserved, only the 15 tokens used are kept
+    assert scheduler.tokens.capacity - scheduler.tokens.level == pytest.approx(15, abs=1)
+
+
+def test_requests_per_minute_are_enforced():
+    scheduler = RateLimitedScheduler(rpm=2, tpm=1_000_000)
+    assert scheduler._reserve(10) == 0
+    assert scheduler._reserve(10) == 0
+    # The bucket is empty, the next request waits for 1 / (2 / 60) seconds
+    assert scheduler._reserve(10) == pytest.approx(30, abs=0.1)
+
+
+def test_token_bucket_lets_oversized_requests_through_once_full():
+    bucket = TokenBucket(capacity=100, rate=100)
+    assert bucket.reserve(1_000) == 0
+    assert bucket.reserve(50) == pytest.approx(0.5, abs=0.01)
+
+
+def test_concurrency_limit_bounds_calls_in_flight():
+    scheduler = RateLimitedScheduler(min_concurrency=2, max_concurrency=2)
+    in_flight = []
+    peak = []
+
+    async def call():
+        in_flight.append(1)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+        return True
+
+    async def main():
+        return await asyncio.gather(*(scheduler.run(call, 10) for _ in range(6)))
+
+    assert all(asyncio.run(main()))
+    assert max(peak) == 2
+
+
+def test_rate_limits_seen_by_threads_are_applied_in_the_loop():
+    scheduler = RateLimitedScheduler(min_concurrency=1, max_concurrency=8)
+    concurrency = scheduler.concurrency
+
+    async def main():
+        async with concurrency:
+            thread = threading.Thread(target=concurrency.on_rate_limited)
+            thread.start()
+            thread.join()
+            # Queued on the loop, not applied by the thread
+            assert concurrency.limit == 2
+            await asyncio.sleep(0)
+            assert concurrency.limit == 1
+
+    asyncio.run(main())
+
+
+def test_concurrency_limit_moves_to_a_new_loop_once_the_first_is_closed():
+    scheduler = RateLimitedScheduler()
+
+    async def call():
+        return True
+
+    assert asyncio.run(scheduler.run(call, 10))
+    assert asyncio.run(scheduler.run(call, 10))
+    # Without a loop, feedback is applied right away
+    limit = scheduler.concurrency.limit
+    scheduler.concurrency.on_rate_limited()
+    assert scheduler.concurrency.limit == limit / 2
+
+
+def test_concurrency_limit_belongs_to_one_running_loop():
+    scheduler = RateLimitedScheduler()
+    errors = []
+
+    async def call():
+        return True
+
+    async def other_loop():
+        try:
+            await scheduler.run(call, 10)
+        except RuntimeError as error:
+            errors.append(error)
+
+    async def main():
+        async with scheduler.concurrency:
+            thread = threading.Thread(target=asyncio.run, args=(other_loop(),))
+            thread.start()
+            thread.join()
+
+    asyncio.run(main())
+    assert len(errors) == 1